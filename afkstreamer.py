@@ -1,9 +1,11 @@
 import logging
 import threading
+import collections
 import audio
 import util
 import manager
 import bootstrap
+import config
 
 import datetime
 
@@ -17,15 +19,145 @@ class Streamer(object):
     to the underlying :mod:`audio` module.
     """
 
-    def __init__(self, attributes):
+    def __init__(self, attributes, lookahead=None):
         super(Streamer, self).__init__()
         self.instance = None
         self.icecast_config = attributes
         self.np_thread = None
+        # (filename, song) handed out by supply_song that haven't started
+        # playing yet, in order
+        self.upcoming = collections.deque()
 
-        self.instance = audio.Manager(self.icecast_config, self.supply_song)
+        if lookahead is None:
+            lookahead = getattr(config, 'streamer_lookahead', 0)
+
+        self.cache = None
+        if getattr(config, 'streamer_cache_dir', None):
+            self.cache = audio.cache.SegmentCache(
+                config.streamer_cache_dir,
+                getattr(config, 'streamer_cache_size', 2 * 1024 ** 3))
+            manager.Song.add_update_hook(self.song_updated)
+
+        # Decoder workers shared by us and our channels
+        self.decoders = None
+        decoders = getattr(config, 'streamer_decoders', 0)
+        if decoders > 0:
+            self.decoders = audio.workers.DecoderPool(
+                decoders,
+                bits_per_sample=getattr(config, 'streamer_bits_per_sample',
+                                        16),
+                trim=getattr(config, 'streamer_trim_silence', False),
+                backends=getattr(config, 'streamer_decoder_backends', None))
+
+        self.instance = audio.Manager(self.icecast_config, self.supply_song,
+                                      lookahead=lookahead,
+                                      file_started=self.song_started,
+                                      profiles=self.profiles(attributes),
+                                      cache=self.cache,
+                                      archive_dir=getattr(config,
+                                          'streamer_archive_dir', None),
+                                      archive_retention=getattr(config,
+                                          'streamer_archive_retention',
+                                          None),
+                                      upcoming_files=self.upcoming_files,
+                                      relay_address=self.relay_address(),
+                                      relay_workers=getattr(config,
+                                          'streamer_relay_workers', None),
+                                      decoder_pool=self.decoders,
+                                      **self.manager_options())
+        if self.instance.relay is not None:
+            manager.Status().add_listener_source(self.relay_listeners)
         self.close_at_end = threading.Event()
 
+        self.channels = {}
+        for name, options in getattr(config, 'streamer_channels',
+                                     {}).items():
+            self.channels[name] = Channel(name, options, attributes, self)
+
+    @staticmethod
+    def manager_options():
+        """
+        Returns the keyword arguments of :class:`audio.Manager` that are
+        set from `config` the same way for us and our channels.
+        """
+        return {
+            'buffer_ms': getattr(config, 'streamer_buffer_ms', 0),
+            'passthrough': getattr(config, 'streamer_passthrough', False),
+            'collect_metrics': getattr(config, 'streamer_metrics', False),
+            'loudness_target': getattr(config, 'streamer_loudness_target',
+                                       None),
+            'crossfade_ms': getattr(config, 'streamer_crossfade_ms', 0),
+            'crossfade_curve': getattr(config, 'streamer_crossfade_curve',
+                                       'equal_power'),
+            'bits_per_sample': getattr(config, 'streamer_bits_per_sample',
+                                       16),
+            'trim_silence': getattr(config, 'streamer_trim_silence', False),
+            'underrun_ms': getattr(config, 'streamer_underrun_ms', 0),
+            'filler_file': getattr(config, 'streamer_filler_file', None),
+            'standby_encoders': getattr(config, 'streamer_standby_encoders',
+                                        False),
+            'readahead_files': getattr(config, 'streamer_readahead_files', 0),
+            'decoder_backends': getattr(config, 'streamer_decoder_backends',
+                                        None),
+        }
+
+    @staticmethod
+    def profiles(attributes, profiles=None):
+        """
+        Returns a list of :class:`audio.OutputProfile` built from
+        `profiles`, by default `config.streamer_profiles`, or None if there
+        is only one output.
+
+        Each entry is a dict with an optional 'icecast' dict that is
+        applied over `attributes`, optional 'compression' and 'mode'
+        keys for the encoder, an optional 'burst' and 'backlog' in
+        seconds.
+        """
+        if profiles is None:
+            profiles = getattr(config, 'streamer_profiles', None)
+        if not profiles:
+            return None
+        result = []
+        for profile in profiles:
+            icecast_config = dict(attributes)
+            icecast_config.update(profile.get('icecast', {}))
+            result.append(audio.OutputProfile(icecast_config,
+                                              profile.get('compression'),
+                                              profile.get('mode', 'j'),
+                                              profile.get('name'),
+                                              profile.get('burst'),
+                                              profile.get('backlog')))
+        return result
+
+    @staticmethod
+    def take_upcoming(upcoming, filename):
+        """
+        Removes and returns the song of the first entry for `filename` in
+        `upcoming`, a deque of (filename, song). Entries before it never
+        started playing and are dropped. Returns None if there is none.
+        """
+        if not any(name == filename for name, song in upcoming):
+            return None
+        while True:
+            name, song = upcoming.popleft()
+            if name == filename:
+                return song
+
+    @staticmethod
+    def relay_address():
+        """
+        Returns the (host, port) to relay the stream to listeners on from
+        `config.streamer_relay_port`, or None to not relay.
+        """
+        port = getattr(config, 'streamer_relay_port', None)
+        if not port:
+            return None
+        return (getattr(config, 'streamer_relay_host', '0.0.0.0'), port)
+
+    def relay_listeners(self):
+        """Returns the amount of listeners our own relay serves."""
+        return self.instance.relay_listeners()
+
     @property
     def connected(self):
         """
@@ -38,10 +170,16 @@ class Streamer(object):
             return False
 
     def start(self):
-        """Starts the audio pipeline and connects to icecast."""
+        """
+        Starts the audio pipeline and connects to icecast. Channels that
+        aren't running yet are started as well.
+        """
         self.queue = manager.Queue()
         self.close_at_end.clear()
         self.instance.start()
+        for channel in self.channels.values():
+            if not channel.running:
+                channel.start()
 
     def close(self, force=False):
         """Stop the audio pipeline and disconnects from icecast."""
@@ -70,18 +208,77 @@ class Streamer(object):
                     self.queue.clear()
                     song = self.queue.pop()
                 self.queue.clear_pops()
-                # update now playing
-                print datetime.datetime.now(), "np change"
-                if self.np_thread is not None:
-                    self.np_thread.join(0.0)
-                self.np_thread = threading.Thread(target=manager.NP.change, args=(song,))
-                self.np_thread.daemon = False
-                self.np_thread.start()
-                print datetime.datetime.now(), "np change done"
-
-                return (song.filename, song.metadata)
+                self.upcoming.append((song.filename, song))
+                return (song.filename, song.metadata, song.id)
         return (None, None)
 
+    def upcoming_files(self):
+        """Returns the filenames of the songs in the queue, in order."""
+        return [song.filename for song in self.queue]
+
+    def position(self):
+        """
+        Returns (filename, seconds) of how far into the song that is
+        playing the stream is, None if nothing is playing.
+        """
+        return self.instance.position()
+
+    def song_updated(self, song, changes):
+        """Drops cached audio of `song` when its file changed."""
+        if 'filename' in changes and song.id:
+            self.cache.invalidate(song.id)
+
+    def cache_stats(self):
+        """Returns the hit/miss statistics of the encoded track cache."""
+        return self.instance.cache_stats()
+
+    def pipeline_stats(self):
+        """
+        Returns the per stage timings and throughput of the audio pipeline,
+        these are only collected with `config.streamer_metrics` enabled.
+        """
+        return self.instance.pipeline_stats()
+
+    def song_started(self, filename, metadata):
+        """
+        Called by the audio pipeline when the first frame of `filename` is
+        played, this can be a while after :meth:`supply_song` returned it.
+        """
+        song = self.take_upcoming(self.upcoming, filename)
+        if song is None:
+            logger.warning("Started playing a file we didn't supply.")
+            return
+        if (self.close_at_end.is_set()):
+            # The song got prefetched before we were asked to stop.
+            self.shutdown(force=True)
+            return
+        # update now playing
+        print datetime.datetime.now(), "np change"
+        if self.np_thread is not None:
+            self.np_thread.join(0.0)
+        self.np_thread = threading.Thread(target=manager.NP.change,
+                                          args=(song,))
+        self.np_thread.daemon = False
+        self.np_thread.start()
+        print datetime.datetime.now(), "np change done"
+
+    def channel_names(self):
+        """Returns the names of our extra channels."""
+        return sorted(self.channels)
+
+    def channel_status(self):
+        """
+        Returns a dict of a dict per channel name, with if the channel is
+        connected, the metadata of what it plays and how far into it it is.
+        """
+        return dict((name, channel.status())
+                    for name, channel in self.channels.items())
+
+    def close_channels(self):
+        """Stops all our extra channels, :meth:`close` leaves them on."""
+        for channel in self.channels.values():
+            channel.close()
+
     def connect(self, *args, **kwargs):
         """
         .. deprecated:: 1.2
@@ -97,6 +294,103 @@ class Streamer(object):
         self.close(*args, **kwargs)
 
 
+class Channel(object):
+
+    """
+    An extra AFK stream played from the queue at `options['queue_url']`,
+    it is set up from `config.streamer_channels` by the :class:`Streamer`.
+
+    `options` can have an 'icecast' dict that is applied over
+    `attributes`, so at least the mount differs, 'profiles' like
+    `config.streamer_profiles` and a 'lookahead'. The decoder workers,
+    track cache and library of `streamer` are shared with it, and it
+    doesn't touch the now playing of the main stream. A channel keeps
+    running when a DJ takes over the main stream.
+    """
+
+    def __init__(self, name, options, attributes, streamer):
+        super(Channel, self).__init__()
+        self.name = name
+        self.queue_url = options.get('queue_url')
+        self.queue = None
+        self.running = False
+        # (filename, song) handed out by supply_song that haven't started
+        # playing yet, in order
+        self.upcoming = collections.deque()
+        self.playing = None
+
+        icecast_config = dict(attributes)
+        icecast_config.update(options.get('icecast', {}))
+        self.instance = audio.Manager(icecast_config, self.supply_song,
+                                      lookahead=options.get('lookahead',
+                                          getattr(config,
+                                                  'streamer_lookahead', 0)),
+                                      file_started=self.song_started,
+                                      profiles=Streamer.profiles(
+                                          icecast_config,
+                                          options.get('profiles')),
+                                      cache=streamer.cache,
+                                      upcoming_files=self.upcoming_files,
+                                      decoder_pool=streamer.decoders,
+                                      **Streamer.manager_options())
+
+    @property
+    def connected(self):
+        try:
+            return self.instance.connected()
+        except (AttributeError):
+            return False
+
+    def start(self):
+        """Starts the audio pipeline of this channel."""
+        self.queue = manager.Queue(self.queue_url)
+        self.running = True
+        self.instance.start()
+
+    def close(self):
+        """Stops the audio pipeline of this channel."""
+        self.running = False
+        self.instance.close()
+        logger.info("Closed channel %s.", self.name)
+
+    def supply_song(self):
+        """Returns a tuple of (filename, metadata) to be played next."""
+        try:
+            song = self.queue.pop()
+        except manager.QueueError:
+            self.queue.clear_pops()
+            return self.supply_song()
+        if (song.id == 0):
+            self.queue.clear()
+            song = self.queue.pop()
+        self.queue.clear_pops()
+        self.upcoming.append((song.filename, song))
+        return (song.filename, song.metadata, song.id)
+
+    def upcoming_files(self):
+        """Returns the filenames of the songs in the queue, in order."""
+        return [song.filename for song in self.queue]
+
+    def song_started(self, filename, metadata):
+        """
+        Called by the audio pipeline when the first frame of `filename` is
+        played on this channel.
+        """
+        self.playing = Streamer.take_upcoming(self.upcoming, filename)
+        logger.info("Channel %s playing %s.", self.name,
+                    metadata.encode('utf8') if metadata else '')
+
+    def status(self):
+        """
+        Returns a dict with if we are connected, the metadata of what we
+        play and how far into it we are.
+        """
+        position = self.instance.position()
+        return {'connected': self.connected,
+                'playing': self.playing.metadata if self.playing else None,
+                'position': position[1] if position else None}
+
+
 class StreamManager(util.BaseManager):
     socket = '/tmp/hanyuu_stream'
 
@@ -1,12 +1,32 @@
 import threading
+import collections
 import encoder
+import buffer
+import fanout
 import files
+import workers
+import loudness
+import crossfade
+import filler
+import tee
+import archive
+import relay
+import playout
+import readahead
+import pcm
+import mp3
+import cache
+import library
+import pacer
+import metrics
 import icecast
 import logging
 import garbage
 import audiotools
 
 import datetime
+import decimal
+import time
 
 # Remove this 
 logging.basicConfig(level=logging.DEBUG)
@@ -17,27 +37,232 @@ logger = logging.getLogger('audio')
 
 
 class Manager(object):
-    def __init__(self, icecast_config={}, next_file=lambda self: None):
+    """Wires a source, encoders and icecast connections together.
+    
+    Every file is decoded once, when more than one :class:`OutputProfile`
+    is given the PCM is fanned out to one encoder and icecast connection
+    per profile. Without `profiles` a single output is created from
+    `icecast_config`.
+    
+    With `collect_metrics` every stage records timings and throughput,
+    see :meth:`pipeline_stats`. With `decoders` files are decoded by that
+    many worker processes instead of in our own process, there should be
+    more of them than `lookahead`. A :class:`workers.DecoderPool` that is
+    shared with other managers can be given as `decoder_pool` instead.
+    With `loudness_target` in LUFS every analyzed track is brought to that
+    loudness. With `crossfade_ms` the end of every track is mixed into the
+    start of the next one, faded along `crossfade_curve`, see
+    :mod:`audio.crossfade`.
+    
+    All PCM is 44.1kHz stereo of `bits_per_sample` depth, 16 or 24, and
+    lame is told that depth. Files in that format are read without
+    converting them, the default of 16 is that of most. With `trim_silence`
+    the silence at the start and end of files is skipped. Which decoder
+    backend is used for what extension is set by `decoder_backends`, see
+    :func:`files.backend_names`. Tracks that need gain or trimming are
+    never sent as passthrough, and only cached once both are known.
+    
+    With `underrun_ms` every encoder plays filler once it got no PCM for
+    that long, the decoded `filler_file` or silence, see
+    :mod:`audio.filler`. With `standby_encoders` every encoder keeps a
+    spare process to take over when its current one fails.
+    
+    With `archive_dir` the main output is also written to a rolling
+    archive in that directory, see :mod:`audio.archive`. With
+    `relay_address`, a (host, port) tuple, it is served to listeners
+    directly by `relay_workers` processes, see :mod:`audio.relay`.
+    
+    With `readahead_files` the first that many files returned by
+    `upcoming_files` are read into the page cache before they are opened,
+    see :mod:`audio.readahead`.
+    
+    `file_started` is called when the first frame of a file is played,
+    not when it is handed to the encoder, see :mod:`audio.playout` and
+    :meth:`position`."""
+    def __init__(self, icecast_config={}, next_file=lambda self: None,
+                 lookahead=0, file_started=lambda filename, meta: None,
+                 buffer_ms=0, profiles=None, passthrough=False, cache=None,
+                 collect_metrics=False, decoders=0, loudness_target=None,
+                 crossfade_ms=0, crossfade_curve='equal_power',
+                 bits_per_sample=16, trim_silence=False, underrun_ms=0,
+                 filler_file=None, standby_encoders=False, archive_dir=None,
+                 archive_segment_seconds=None, archive_retention=None,
+                 readahead_files=0, upcoming_files=lambda: [],
+                 decoder_backends=None, relay_address=None,
+                 relay_workers=None, decoder_pool=None):
         super(Manager, self).__init__()
         
+        self.metrics = metrics.Metrics() if collect_metrics else metrics.NULL
+        self.bits_per_sample = bits_per_sample
+        self.trim_silence = trim_silence
+        self.decoder_backends = decoder_backends
+        
+        self.decoders = decoder_pool
+        # The amount of workers of the pool we own, it runs while we do.
+        self.decoder_workers = decoders if decoder_pool is None else 0
+        if self.decoder_workers > 0 or decoder_pool is not None:
+            self.metrics.gauge('decoders', lambda: (
+                self.decoders.stats() if self.decoders is not None else {}))
+        
+        self.readahead = None
+        if readahead_files > 0:
+            self.readahead = readahead.Readahead(upcoming_files,
+                                                 readahead_files)
+            self.metrics.gauge('readahead', self.readahead.stats)
+        
         self.started = threading.Event()
         
         self.next_file = next_file
+        self.file_started = file_started
+        
+        if not profiles:
+            profiles = [OutputProfile(icecast_config)]
+        
+        # The (bitrate, sample rate) of MP3 files we can send as is.
+        self.passthrough = None
+        # The cache.SegmentCache we record to and send from.
+        self.cache = None
+        if (passthrough or cache is not None) and len(profiles) > 1:
+            logger.warning("Passthrough and caching only work with a "
+                           "single output.")
+        elif passthrough or cache is not None:
+            if passthrough:
+                self.passthrough = profiles[0].passthrough_format()
+            self.cache = cache
+            # The encoder can only find the right spot with a buffer.
+            buffer_ms = buffer_ms or buffer.BufferedSource.capacity_ms
+        
+        crossfader = None
+        if crossfade_ms > 0:
+            if self.passthrough is not None or self.cache is not None:
+                # Both need the tracks to start and end where they do.
+                logger.warning("Crossfading doesn't work with passthrough "
+                               "or caching.")
+            elif not pcm.available():
+                logger.warning("NumPy is not available, not crossfading.")
+            else:
+                crossfader = crossfade.Crossfader(
+                    crossfade_ms / 1000.0, crossfade_curve,
+                    bits_per_sample=bits_per_sample)
+        
+        fill = None
+        if underrun_ms > 0:
+            if self.passthrough is not None or self.cache is not None:
+                # The encoder is idle while those play, it isn't an underrun.
+                logger.warning("Underrun filler doesn't work with "
+                               "passthrough or caching.")
+            else:
+                if filler_file:
+                    fill = filler.Filler.from_file(filler_file,
+                                                   bits_per_sample)
+                else:
+                    fill = filler.Filler(bits_per_sample=bits_per_sample)
+                # The encoders have to be able to wait on the source with
+                # a timeout, the source itself can block for longer.
+                buffer_ms = buffer_ms or buffer.BufferedSource.capacity_ms
         
         logger.debug("Creating source instance.")
-        self.source = UnendingSource(self.give_source)
+        self.source = UnendingSource(self.give_source,
+                                     lookahead=lookahead,
+                                     change_function=self.source_changed,
+                                     passthrough_function=
+                                         self.play_passthrough,
+                                     metrics=self.metrics.scope('source'),
+                                     crossfade=crossfader)
+        
+        self.loudness_target = loudness_target
+        pcm_source = self.source
+        # A crossfading source applies the gain itself, before mixing.
+        if loudness_target is not None and crossfader is None:
+            pcm_source = loudness.GainStage(self.source, bits_per_sample)
+        
+        # PCM stages between the source and the encoders, in start order.
+        self.stages = []
+        self.buffer = self.distributor = None
+        if len(profiles) > 1:
+            logger.debug("Creating distributor instance.")
+            self.distributor = fanout.Distributor(
+                pcm_source, buffer_ms or fanout.Distributor.capacity_ms,
+                bits_per_sample=bits_per_sample)
+            self.stages.append(self.distributor)
+            sources = [self.distributor.add_reader(profile.name)
+                       for profile in profiles]
+            chunk_size = fanout.FanoutReader.slice_size
+        elif buffer_ms > 0:
+            logger.debug("Creating buffer instance.")
+            self.buffer = buffer.BufferedSource(
+                pcm_source, buffer_ms, bits_per_sample=bits_per_sample)
+            self.stages.append(self.buffer)
+            sources = [self.buffer]
+            chunk_size = self.buffer.slice_size
+            self.metrics.gauge('buffer.ms', lambda: self.buffer.buffered_ms)
+        else:
+            sources = [pcm_source]
+            chunk_size = 4096
+        
+        logger.debug("Creating %d output(s).", len(profiles))
+        self.outputs = []
+        for i, (profile, source) in enumerate(zip(profiles, sources)):
+            scope = self.metrics.scope(profile.name or 'output{:d}'.format(i))
+            watchdog = None
+            if fill is not None:
+                watchdog = filler.Watchdog(fill, underrun_ms / 1000.0,
+                                           scope.scope('watchdog'))
+                scope.gauge('watchdog', watchdog.stats)
+            self.outputs.append(Output(profile, source, chunk_size, scope,
+                                       bits_per_sample, watchdog,
+                                       standby_encoders,
+                                       tee_stream=(i == 0 and
+                                                   bool(archive_dir or
+                                                        relay_address))))
+        
+        self.archive = None
+        if archive_dir:
+            logger.debug("Creating archive in %s.", archive_dir)
+            self.archive = archive.Archive(
+                self.outputs[0].tee.add_reader('archive'), archive_dir,
+                archive_segment_seconds, archive_retention)
         
-        logger.debug("Creating encoder instance.")
-        self.encoder = encoder.Encoder(self.source)
+        self.relay = None
+        if relay_address:
+            logger.debug("Relaying on %s:%d.", *relay_address)
+            self.relay = relay.Relay(
+                self.outputs[0].tee.add_reader('relay'), relay_address,
+                profiles[0].icecast_config.get('mount') or '/main.mp3',
+                relay_workers, profiles[0].icecast_config.get('name') or
+                u'R/a/dio')
+            self.metrics.gauge('relay_listeners', self.relay.listeners)
         
-        logger.debug("Creating icecast instance.")
-        self.icecast = icecast.Icecast(self.encoder, icecast_config)
+        # The first output is the main one, these are kept for backwards
+        # compatibility.
+        self.encoder = self.outputs[0].encoder
+        self.icecast = self.outputs[0].icecast
+        
+        self.playout = playout.Playout(self.encoder, self.icecast,
+                                       self.track_started)
         
     def start(self):
         if not self.started.is_set():
+            if self.decoder_workers > 0 and self.decoders is None:
+                logger.debug("Starting %d decoder worker(s).",
+                             self.decoder_workers)
+                self.decoders = workers.DecoderPool(
+                    self.decoder_workers,
+                    bits_per_sample=self.bits_per_sample,
+                    trim=self.trim_silence, backends=self.decoder_backends)
+            if self.readahead is not None:
+                self.readahead.start()
+            self.playout.start()
             self.source.start()
-            self.encoder.start()
-            self.icecast.start()
+            for stage in self.stages:
+                stage.start()
+            for i, output in enumerate(self.outputs):
+                # Only failing to connect the main output is fatal.
+                output.start(required=(i == 0))
+            if self.archive is not None:
+                self.archive.start()
+            if self.relay is not None:
+                self.relay.start()
             self.started.set()
         else:
             self.close()
@@ -48,14 +273,38 @@ class Manager(object):
         return self.icecast.connected()
     
     def give_source(self):
+        """Opens the next file returned by `next_file` and returns it.
+        
+        This can be called ahead of time by the prefetcher of the source,
+        so it should not touch anything that belongs to the file that is
+        currently playing. See :meth:`source_changed` for that."""
         print datetime.datetime.now(), "give_source"
-        filename, meta = self.next_file()
+        result = self.next_file()
+        filename, meta = result[:2]
+        # An optional track id, used as cache key.
+        track = result[2] if len(result) > 2 else None
         if filename is None:
-            self.close()
             return None
+        warm = (self.readahead is not None and
+                self.readahead.is_warm(filename))
+        gain = None
+        if self.loudness_target is not None:
+            gain = self.track_gain(filename)
+        cache_key = None
+        if self.cache is not None and track:
+            cache_key = self.cache_key(filename, gain)
         try:
             print datetime.datetime.now(), "audiofile start"
-            audiofile = files.AudioFile(filename)
+            opened = time.time()
+            with self.metrics.time('source.open'):
+                audiofile = self.open_file(filename, track, gain,
+                                           cache_key)
+            if self.readahead is not None:
+                # Tells how much warming up the files gains us.
+                self.metrics.observe('source.open_warm' if warm else
+                                     'source.open_cold',
+                                     time.time() - opened)
+                self.readahead.poke()
             print datetime.datetime.now(), "audiofile done"
         except (files.AudioError) as err:
             logger.exception("Unsupported file: " + filename.encode('utf8'))
@@ -64,72 +313,543 @@ class Manager(object):
             logger.exception("Failed opening file: " + filename.encode('utf8'))
             return self.give_source()
         else:
-            if hasattr(self, 'icecast'):
-                self.icecast.set_metadata(meta)
+            if getattr(audiofile, 'converted', False):
+                self.metrics.mark('source.converted')
+            audiofile.filename = filename
+            audiofile.metadata = meta
+            audiofile.track = track
+            audiofile.cache_key = cache_key
+            if self.loudness_target is not None:
+                audiofile.gain = gain
             return audiofile
+        
+    def open_file(self, filename, track=None, gain=None, cache_key=None):
+        """Opens `filename` from the cache under `cache_key` or as
+        passthrough file if it is an MP3 in the format we send and nothing
+        has to be done to its PCM, otherwise as a decoded
+        :class:`files.AudioFile`. `gain` is the gain it will be played
+        with."""
+        # Only the encoder knows how to send these, so it has to be up.
+        if self.started.is_set():
+            profile = self.outputs[0].profile
+            if cache_key is not None:
+                cached = self.cache.open(track, filename, cache_key,
+                                         profile.sample_rate)
+                if cached is not None:
+                    return cached
+            if (self.passthrough is not None and not self.trim_silence and
+                    gain in (None, 1.0) and
+                    filename.lower().endswith('.mp3')):
+                try:
+                    return mp3.PassthroughFile(filename, *self.passthrough)
+                except (mp3.PassthroughError, IOError) as err:
+                    logger.debug("Decoding %s: %s", filename.encode('utf8'),
+                                 err)
+        decoders = self.decoders # Gone when we are closed meanwhile
+        if decoders is not None:
+            decoded = decoders.open(filename)
+            if decoded is not None:
+                return decoded
+            logger.warning("All decoder workers are busy, decoding "
+                           "in process.")
+        return files.AudioFile(filename, self.bits_per_sample,
+                               self.trim_silence, self.decoder_backends)
+        
+    def track_gain(self, filename):
+        """Returns the gain for `filename` to reach our loudness target,
+        None if it wasn't analyzed."""
+        index = library.default()
+        analysis = index.loudness(filename) if index is not None else None
+        if analysis is None:
+            return None
+        return loudness.track_gain(analysis[0], analysis[1],
+                                   self.loudness_target)
+        
+    def cache_key(self, filename, gain=None):
+        """Returns the key `filename` played with `gain` is cached under,
+        None if it can't be cached yet because its loudness or silence
+        isn't known. The gain and edges are part of the key so entries
+        recorded with other ones are never used."""
+        key = self.outputs[0].profile.key
+        extra = ()
+        if self.loudness_target is not None:
+            if gain is None:
+                return None
+            extra += (round(gain, 4),)
+        if self.trim_silence:
+            index = library.default()
+            edges = index.edges(filename) if index is not None else None
+            if edges is None:
+                return None
+            extra += tuple(edges)
+        return (key,) + extra if extra else key
+        
+    def play_passthrough(self, source, position):
+        """Called by the source when it reaches a passthrough file, blocks
+        until the encoder is done sending it."""
+        self.encoder.split(position, source)
+        while not source.started.wait(1.0):
+            if not self.started.is_set():
+                return
+        self.source_changed(source)
+        while not source.finished.wait(1.0):
+            if not self.started.is_set():
+                return
+        
+    def source_changed(self, audiofile):
+        """Called by the source when `audiofile` becomes the file that
+        is playing. `audiofile` is None when we ran out of files."""
+        if audiofile is None:
+            self.close()
+            return
+        duration = 0.0
+        if getattr(audiofile, 'passthrough', False):
+            duration = float(audiofile.samples) / audiofile.sample_rate
+        elif self.cache is not None:
+            self.record(audiofile)
+        self.playout.track(self.source.position, audiofile, duration)
+        
+    def track_started(self, audiofile, started):
+        """Called by the playout when the first frame of `audiofile` is
+        played, at `started`."""
+        logger.debug("Started playing %s %.2f seconds ago.",
+                     audiofile.filename.encode('utf8'), time.time() - started)
+        for output in self.outputs:
+            output.icecast.set_metadata(audiofile.metadata)
+        if self.archive is not None:
+            self.archive.track_changed(audiofile.metadata)
+        if self.relay is not None:
+            self.relay.track_changed(audiofile.metadata)
+        try:
+            self.file_started(audiofile.filename, audiofile.metadata)
+        except:
+            logger.exception("File started callback failed.")
+        
+    def position(self):
+        """Returns (filename, seconds) of how far into the file that is
+        playing we are, or None if nothing is playing yet."""
+        current = self.playout.position()
+        if current is None:
+            return None
+        audiofile, seconds = current
+        return audiofile.filename, seconds
     
+    def record(self, audiofile):
+        """Gives `audiofile` its own encoder instance, and records the
+        output into the cache if it has a cache key, see
+        :meth:`cache_key`."""
+        recorder = None
+        cache_key = getattr(audiofile, 'cache_key', None)
+        if audiofile.track and cache_key is not None:
+            recorder = self.cache.writer(audiofile.track, audiofile.filename,
+                                         cache_key)
+        self.encoder.split(self.source.position, recorder=recorder)
+        
+    def relay_listeners(self):
+        """Returns the amount of listeners of our relay, 0 without one."""
+        if self.relay is None:
+            return 0
+        return self.relay.listeners()
+        
+    def cache_stats(self):
+        """Returns the statistics of the cache, None without a cache."""
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+        
+    def pipeline_stats(self):
+        """Returns a dict of the timings and throughput of every stage,
+        it is empty unless we were created with `collect_metrics`."""
+        return self.metrics.snapshot()
+        
     def close(self):
         self.started.clear()
         
         self.source.close()
         
-        self.encoder.close()
+        for stage in self.stages:
+            stage.close()
         
+        for output in self.outputs:
+            output.close()
+        
+        if self.archive is not None:
+            self.archive.close()
+        
+        if self.relay is not None:
+            self.relay.close()
+        
+        self.playout.close()
+        
+        if self.readahead is not None:
+            self.readahead.close()
+        
+        if self.decoder_workers > 0 and self.decoders is not None:
+            self.decoders.close()
+            self.decoders = None
+
+
+class OutputProfile(object):
+    """Describes one output of the :class:`Manager`: where to send it to
+    and the lame arguments to encode it with."""
+    def __init__(self, icecast_config, compression=None, mode='j',
+                 name=None, burst=None, backlog=None):
+        super(OutputProfile, self).__init__()
+        self.icecast_config = (icecast_config
+                               if isinstance(icecast_config,
+                                             icecast.IcecastConfig)
+                               else icecast.IcecastConfig(icecast_config))
+        self.compression = compression
+        self.mode = mode
+        self.name = name or self.icecast_config.get('mount')
+        # Seconds of audio sent without pacing on connect
+        self.burst = burst
+        # Seconds of audio kept while reconnecting
+        self.backlog = backlog
+        
+    @property
+    def key(self):
+        """A string that identifies the encoded output of this profile."""
+        arguments = self.compression or encoder.Encoder.default_compression
+        return " ".join(list(arguments) + ['-m', self.mode])
+        
+    @property
+    def sample_rate(self):
+        """Sample rate of the MP3 that this profile encodes."""
+        arguments = self.compression or encoder.Encoder.default_compression
+        if '--resample' in arguments:
+            khz = arguments[arguments.index('--resample') + 1]
+            return int(decimal.Decimal(khz) * 1000)
+        return 44100
+        
+    def passthrough_format(self):
+        """Returns a tuple of (bitrate, sample rate) of the MP3 that this
+        profile encodes, or None if it isn't constant bitrate."""
+        arguments = self.compression or encoder.Encoder.default_compression
+        if '--cbr' not in arguments or '-b' not in arguments:
+            return None
+        bitrate = int(arguments[arguments.index('-b') + 1])
+        return bitrate, self.sample_rate
+        
+        
+class Output(object):
+    """The encoder and icecast connection that belong to a profile.
+    
+    With `tee_stream` the encoded stream goes through a :class:`tee.Tee`,
+    more readers can be added to `tee` next to the icecast connection."""
+    def __init__(self, profile, source, chunk_size=4096,
+                 metrics=metrics.NULL, bits_per_sample=16, watchdog=None,
+                 standby=False, tee_stream=False):
+        super(Output, self).__init__()
+        self.profile = profile
+        
+        self.encoder = encoder.Encoder(source, chunk_size,
+                                       profile.compression, profile.mode,
+                                       metrics.scope('encoder'),
+                                       bits_per_sample, watchdog, standby)
+        self.tee = None
+        stream = self.encoder
+        if tee_stream:
+            self.tee = tee.Tee(self.encoder)
+            stream = self.tee.add_reader('icecast', required=True)
+        self.icecast = icecast.Icecast(stream, profile.icecast_config,
+                                       pacer.Pacer(profile.burst),
+                                       profile.backlog,
+                                       metrics.scope('icecast'))
+        
+    def start(self, required=True):
+        """Starts the encoder and icecast connection, failing to connect
+        is only raised when `required` is True. Otherwise we keep trying
+        in the background."""
+        self.encoder.start()
+        if self.tee is not None:
+            self.tee.start()
+        try:
+            self.icecast.start()
+        except (icecast.IcecastError) as err:
+            if required:
+                raise
+            logger.exception("Failed connecting output %s.",
+                             self.profile.name)
+            self.icecast.start(connect=False)
+            
+    def connected(self):
+        return self.icecast.connected()
+    
+    def close(self):
+        self.encoder.close()
+        if self.tee is not None:
+            self.tee.close()
         self.icecast.close()
 
 class UnendingSource(object):
-    def __init__(self, source_function):
+    """A source that never ends, it calls `source_function` for a new
+    source every time the current one runs out.
+    
+    When `lookahead` is higher than zero the next sources are opened on a
+    background thread while the current one is still playing, this makes
+    the switch at the end of a file instant. `change_function` is called
+    with the new source every time it becomes the current one.
+    
+    With a :class:`crossfade.Crossfader` as `crossfade` the last part of
+    every source is held back, and mixed with the start of the next one
+    when it becomes the current one. Passthrough sources are not mixed."""
+    def __init__(self, source_function, lookahead=0,
+                 change_function=lambda source: None,
+                 passthrough_function=None, metrics=metrics.NULL,
+                 crossfade=None):
         super(UnendingSource, self).__init__()
+        self.metrics = metrics
         self.source_function = source_function
+        self.change_function = change_function
+        self.passthrough_function = passthrough_function
+        self.lookahead = lookahead
+        self.prefetcher = None
+        self.crossfade = crossfade
         
         self.eof = False
+        # Amount of bytes we returned since starting
+        self.position = 0
+        # PCM read but not returned yet, the tail we crossfade from
+        self.held = bytearray()
+        self.skipping = False
         
     def start(self):
         """Starts the source"""
         self.eof = False
+        self.position = 0
+        self.held = bytearray()
+        self.skipping = False
         self.source = self.source_function()
+        if self.lookahead > 0:
+            self.prefetcher = Prefetcher(self.source_function,
+                                         self.lookahead)
+            self.prefetcher.start()
+        self.change_function(self.source)
         
     def initialize(self):
         """Sets the initial source from the source function."""
         self.start()
         
+    def next_source(self):
+        """Returns the next source, from the prefetcher if we have one."""
+        if self.prefetcher is None:
+            return self.source_function()
+        return self.prefetcher.get()
+        
     def change_source(self):
         """Calls the source function and returns the result if not None."""
         print datetime.datetime.now(), "change_source"
         self.source.close()
-        new_source = self.source_function()
+        new_source = self.next_source()
+        while getattr(new_source, 'passthrough', False):
+            # These don't go through us, we just wait for them to be sent.
+            if self.passthrough_function is None:
+                new_source.close()
+            else:
+                self.passthrough_function(new_source, self.position)
+            if self.eof:
+                return None
+            new_source = self.next_source()
+        self.change_function(new_source)
         if new_source is None:
             self.eof = True
         else:
             return new_source
     
-    def read(self, size=4096, timeout=10.0):
-        if self.eof:
-            return b''
+    def read_source(self, size, timeout):
+        """Reads from the current source, a failing MD5 check at the end of
+        a file counts as the end of it."""
         try:
-            data = self.source.read(size, timeout)
+            with self.metrics.time('read'):
+                return self.source.read(size, timeout)
         except (ValueError) as err:
             if err.message == 'MD5 mismatch at end of stream':
-                data = b''
-        if data == b'':
+                return b''
+            raise
+    
+    def read(self, size=4096, timeout=10.0):
+        if self.crossfade is not None:
+            return self.read_crossfaded(size, timeout)
+        while not self.eof:
+            data = self.read_source(size, timeout)
+            if data != b'':
+                self.position += len(data)
+                self.metrics.mark('bytes', len(data))
+                return data
+            # Read straight from the new source so the switch doesn't
+            # show up as an empty read to our consumer.
             self.source = self.change_source()
             if self.source == None:
                 self.eof = True
-                return b''
+        return b''
+    
+    def read_crossfaded(self, size, timeout):
+        """Like :meth:`read`, but keeps the last `crossfade.size` bytes of
+        the current source held back until we know if it ends there.
+        Returns whole frames unless only a partial one is left."""
+        hold = self.crossfade.size
+        frame_size = self.crossfade.frame_size
+        while len(self.held) < hold + frame_size and not self.eof:
+            data = b'' if self.skipping else self.read_source(size, timeout)
+            if data != b'':
+                self.held += loudness.apply_gain(
+                    data, getattr(self.source, 'gain', None),
+                    self.crossfade.bits_per_sample)
+                continue
+            self.skipping = False
+            self.source = self.change_source()
+            if self.source is None:
+                self.eof = True
+            else:
+                self.overlap(timeout)
+        if self.eof:
+            # Nothing left to mix with, let the tail out as is.
+            hold = 0
+        length = min(max(size - size % frame_size, frame_size),
+                     len(self.held) - hold)
+        if length >= frame_size:
+            length -= length % frame_size
+        data = bytes(self.held[:length])
+        del self.held[:len(data)]
+        self.position += len(data)
+        self.metrics.mark('bytes', len(data))
         return data
     
+    def overlap(self, timeout):
+        """Mixes the held tail of the last source with as much of the start
+        of the current source."""
+        frame_size = self.crossfade.frame_size
+        tail = len(self.held) // frame_size * frame_size
+        head = bytearray()
+        while len(head) < tail:
+            data = self.read_source(tail - len(head), timeout)
+            if data == b'':
+                break # Shorter than the tail, mix what there is.
+            head += loudness.apply_gain(data, getattr(self.source, 'gain',
+                                                      None),
+                                        self.crossfade.bits_per_sample)
+        length = min(tail, len(head)) // frame_size * frame_size
+        start = len(self.held) - length
+        self.held[start:] = self.crossfade.mix(bytes(self.held[start:]),
+                                               bytes(head[:length]))
+        self.held += head[length:]
+        self.metrics.mark('crossfades')
+    
     def skip(self):
+        if self.crossfade is not None:
+            # Fade into the next source on the next read.
+            self.skipping = True
+            return
         self.source = self.change_source()
         
     def close(self):
         self.eof = True
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
         
     def __getattr__(self, key):
         return getattr(self.source, key)
     
     
+class Prefetcher(object):
+    """Calls `source_function` on a background thread and keeps at most
+    `depth` opened sources around for :meth:`get` to return.
+    
+    A `source_function` that raises is retried after `retry_delay`, and
+    :meth:`get` falls back to calling `source_function` itself when the
+    background thread has nothing for it within `timeout` seconds. A
+    source the background thread is still opening then is returned first,
+    sources are never returned out of order."""
+    retry_delay = 1.0
+    timeout = 10.0
+    def __init__(self, source_function, depth=1):
+        super(Prefetcher, self).__init__()
+        self.source_function = source_function
+        self.depth = depth
+        
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        # Makes sure only one call to the source function happens at a time
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        
+    def start(self):
+        self.closed.clear()
+        self.thread = threading.Thread(target=self.run,
+                                       name="Source Prefetcher")
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def run(self):
+        while not self.closed.is_set():
+            with self.condition:
+                while (len(self.pending) >= self.depth and
+                       not self.closed.is_set()):
+                    self.condition.wait(1.0)
+            if self.closed.is_set():
+                break
+            try:
+                # It is queued before the lock is let go, so get can't
+                # open one directly in between.
+                with self.lock:
+                    source = self.source_function()
+                    with self.condition:
+                        closed = self.closed.is_set()
+                        if not closed:
+                            self.pending.append(source)
+                            self.condition.notify_all()
+            except:
+                logger.exception("Failed prefetching the next source.")
+                self.closed.wait(self.retry_delay)
+                continue
+            if closed:
+                if source is not None:
+                    source.close()
+                break
+            if source is None:
+                # The source function ran dry, nothing left to prefetch.
+                break
+            
+    def get(self):
+        """Returns the next prefetched source, waits for the background
+        thread if it is still opening it."""
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while (not self.pending and self.thread.is_alive() and
+                   time.time() < deadline):
+                self.condition.wait(0.5)
+            if self.pending:
+                source = self.pending.popleft()
+                self.condition.notify_all()
+                return source
+        logger.warning("Prefetcher had nothing ready, opening directly.")
+        with self.lock:
+            # The background thread might have been opening one, that
+            # comes first.
+            with self.condition:
+                if self.pending:
+                    source = self.pending.popleft()
+                    self.condition.notify_all()
+                    return source
+            return self.source_function()
+        
+    def close(self):
+        """Stops the background thread and closes any sources that were
+        prefetched but never used."""
+        with self.condition:
+            self.closed.set()
+            pending, self.pending = self.pending, collections.deque()
+            self.condition.notify_all()
+        for source in pending:
+            if source is not None:
+                source.close()
+    
+    
 import os
 import mutagen
+import library.catalog
 def test_dir(directory=u'/media/F/Music', files=None):
     files = set() if files is None else files
     for base, dir, filenames in os.walk(directory):
@@ -144,6 +864,10 @@ def test_dir(directory=u'/media/F/Music', files=None):
         if (filename.endswith('.flac') or
                 filename.endswith('.mp3') or
                 filename.endswith('.ogg')):
+            catalog = library.catalog.default()
+            meta = catalog.metadata(filename) if catalog else None
+            if meta is not None:
+                return (filename, meta)
             try:
                 meta = mutagen.File(filename, easy=True)
             except:
@@ -0,0 +1,233 @@
+"""Module that keeps a rolling archive of the stream on disk.
+
+The :class:`Archive` reads the encoded stream from a :class:`tee.TeeReader`
+and writes it in whole MP3 frames to segment files of `segment_seconds`
+of audio each, named after the time they start. Segments older than
+`retention` seconds are removed. The start of every segment and every
+track change is kept in a sqlite index in the same directory, so an
+aircheck of any time range can be cut out afterwards:
+
+    python -m audio.archive /path/to/archive "2016-01-01 20:00" 3600 out.mp3
+"""
+import os
+import sys
+import time
+import sqlite3
+import datetime
+import threading
+import logging
+
+import mp3
+
+
+logger = logging.getLogger('audio.archive')
+
+
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS segments (
+    name TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    size INTEGER NOT NULL
+)""", """CREATE TABLE IF NOT EXISTS boundaries (
+    time REAL NOT NULL,
+    segment TEXT NOT NULL,
+    offset REAL NOT NULL,
+    metadata TEXT
+)""", """CREATE INDEX IF NOT EXISTS boundaries_time ON boundaries (time)"""]
+
+
+def connect(directory):
+    """Returns a connection to the index of the archive in `directory`."""
+    connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                 timeout=10.0)
+    with connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+    return connection
+
+
+class Archive(object):
+    """Writes what `reader` returns into `directory`, see the module
+    docstring."""
+    segment_seconds = 300.0
+    retention = 7 * 24 * 3600.0
+    def __init__(self, reader, directory, segment_seconds=None,
+                 retention=None):
+        super(Archive, self).__init__()
+        self.reader = reader
+        self.directory = directory
+        if segment_seconds is not None:
+            self.segment_seconds = segment_seconds
+        if retention is not None:
+            self.retention = retention
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.frames = mp3.FrameSplitter()
+        self.file = None
+        self.segment = None # Name of the segment that is being written
+        self.started = self.duration = 0.0
+        self.size = 0
+        # Track changes that came in from another thread
+        self.pending = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+    def start(self):
+        self.closed.clear()
+        self.thread = threading.Thread(target=self.run,
+                                       name="Stream Archive")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        self.connection = connect(self.directory)
+        try:
+            while not self.closed.is_set():
+                data = self.reader.read(65536, 1.0)
+                if not data:
+                    continue
+                frames, duration = self.frames.feed(data)
+                if frames:
+                    self.write(frames, duration)
+        except:
+            logger.exception("Archive failed, not archiving anymore.")
+        finally:
+            self.reader.close()
+            self.end_segment()
+            self.connection.close()
+
+    def write(self, frames, duration):
+        if self.file is None or self.duration >= self.segment_seconds:
+            self.end_segment()
+            self.start_segment()
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO boundaries VALUES (?, ?, ?, ?)",
+                    [(changed, self.segment, self.duration, metadata)
+                     for changed, metadata in pending])
+        self.file.write(frames)
+        self.duration += duration
+        self.size += len(frames)
+
+    def start_segment(self):
+        self.started = time.time()
+        self.segment = '{:s}-{:03d}.mp3'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.gmtime(self.started)),
+            int(self.started * 1000) % 1000)
+        self.file = open(os.path.join(self.directory, self.segment), 'wb')
+        self.duration = 0.0
+        self.size = 0
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)",
+                (self.segment, self.started, 0.0, 0))
+        self.expire()
+
+    def end_segment(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        with self.connection:
+            self.connection.execute(
+                "UPDATE segments SET duration=?, size=? WHERE name=?",
+                (self.duration, self.size, self.segment))
+
+    def expire(self):
+        """Removes segments that are older than our retention."""
+        cutoff = time.time() - self.retention
+        names = [row[0] for row in self.connection.execute(
+            "SELECT name FROM segments WHERE started < ?", (cutoff,))]
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        with self.connection:
+            self.connection.execute("DELETE FROM segments WHERE started < ?",
+                                    (cutoff,))
+            self.connection.execute("DELETE FROM boundaries WHERE time < ?",
+                                    (cutoff,))
+
+    def track_changed(self, metadata):
+        """Called when a new track starts, it is stored with the position
+        the stream is at when we write the next frames."""
+        with self.lock:
+            self.pending.append((time.time(), metadata))
+
+    def close(self):
+        self.closed.set()
+
+
+def tracks(directory, start, end):
+    """Returns a list of (time, metadata) of the tracks that started
+    between `start` and `end`, unix timestamps."""
+    connection = connect(directory)
+    try:
+        return connection.execute(
+            "SELECT time, metadata FROM boundaries WHERE time >= ? AND "
+            "time < ? ORDER BY time", (start, end)).fetchall()
+    finally:
+        connection.close()
+
+
+def aircheck(directory, start, end, output):
+    """Writes the archived stream between `start` and `end`, unix
+    timestamps, to the file object `output`. Returns the seconds of audio
+    written, gaps in the archive are left out."""
+    connection = connect(directory)
+    try:
+        segments = connection.execute(
+            "SELECT name, started FROM segments WHERE started < ? AND "
+            "(started + duration > ? OR duration = 0) ORDER BY started",
+            (end, start)).fetchall()
+    finally:
+        connection.close()
+    written = 0.0
+    # Segments that are being written, or weren't ended, have no duration.
+    for name, started in segments:
+        splitter, position = mp3.FrameSplitter(), started
+        with open(os.path.join(directory, name), 'rb') as f:
+            while position < end:
+                data = f.read(65536)
+                if not data:
+                    break
+                frames = splitter.feed(data)[0]
+                # Cut at a frame that is about the right time, frames are
+                # short enough for the accuracy that is needed here.
+                offset = 0
+                while offset < len(frames) and position < end:
+                    header = mp3.parse_header(frames[offset:offset + 4])
+                    length = float(header.samples) / header.sample_rate
+                    if position + length > start:
+                        output.write(frames[offset:offset + header.length])
+                        written += length
+                    position += length
+                    offset += header.length
+    return written
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 5:
+        sys.exit("Usage: python -m audio.archive DIRECTORY 'YYYY-MM-DD "
+                 "HH:MM' SECONDS OUTPUT")
+    directory, moment, seconds, filename = sys.argv[1:]
+    start = time.mktime(datetime.datetime.strptime(
+        moment, '%Y-%m-%d %H:%M').timetuple())
+    end = start + float(seconds)
+    for changed, metadata in tracks(directory, start, end):
+        logger.info("%s %s", time.strftime('%H:%M:%S',
+                                           time.localtime(changed)),
+                    metadata)
+    with open(filename, 'wb') as output:
+        written = aircheck(directory, start, end, output)
+    logger.info("Wrote %.1f seconds of audio to %s.", written, filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,525 @@
+"""Offline benchmark of the audio pipeline.
+
+Drives a :class:`audio.Manager` end to end without a real icecast server:
+tracks are synthetic PCM or generated WAV files, lame can be replaced by a
+stand-in that emits silent MP3 frames and the stream is sent to a local
+sink that speaks the icecast source protocol. Run it with
+
+    python -m audio.benchmark --tracks 2000 --seconds 0.5 --unpaced
+
+It reports the time to the first byte at the sink, the realtime factor,
+CPU seconds per stream second, the gap at track switches and how much the
+memory grew.
+
+With `--decoders` the decoder backends are compared instead, each decodes
+the same files in a process of its own:
+
+    python -m audio.benchmark --decoders /music/*.flac"""
+import os
+import sys
+import math
+import wave
+import json
+import array
+import struct
+import shutil
+import logging
+import argparse
+import tempfile
+import time
+import resource
+import threading
+import multiprocessing
+import SocketServer
+import distutils.spawn
+
+import audio
+import encoder
+import files
+import metrics
+import mp3
+import pacer
+
+
+logger = logging.getLogger('audio.benchmark')
+
+
+STANDIN_LAME = '''#!{python}
+"""Stand-in for lame that turns raw PCM into silent MP3 frames."""
+import os
+import sys
+
+arguments = sys.argv[1:]
+def option(name, default):
+    if name in arguments:
+        return arguments[arguments.index(name) + 1]
+    return default
+
+BITRATES = [None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+            320]
+SAMPLE_RATES = [44100, 48000, 32000]
+
+bitrate = int(option('-b', '128'))
+sample_rate = int(float(option('--resample', option('-s', '44.1'))) * 1000)
+mono = option('-m', 'j') == 'm'
+bitwidth = int(option('--bitwidth', '16'))
+
+header = chr(0xFF) + chr(0xFB) + chr(
+    BITRATES.index(bitrate) << 4 | SAMPLE_RATES.index(sample_rate) << 2) + (
+    chr(0xC0) if mono else chr(0x40))
+frame = header + b'\\x00' * (144000 * bitrate // sample_rate - 4)
+frame_pcm = 1152 * 2 * bitwidth // 8
+
+pending = 0
+while True:
+    data = os.read(0, 65536)
+    if not data:
+        break
+    frames, pending = divmod(pending + len(data), frame_pcm)
+    output = frame * frames
+    try:
+        while output:
+            output = output[os.write(1, output):]
+    except OSError:
+        break
+'''
+
+
+def write_standin_lame(directory):
+    """Writes the stand-in lame script into `directory` and returns its
+    path."""
+    path = os.path.join(directory, 'lame')
+    with open(path, 'w') as script:
+        script.write(STANDIN_LAME.format(python=sys.executable))
+    os.chmod(path, 0755)
+    return path
+
+
+def generate_files(directory, count, seconds, sample_rate=44100):
+    """Writes `count` 16-bit stereo WAV files of a tone of `seconds` each
+    into `directory` and returns their paths."""
+    samples = array.array('h', [int(8000 * math.sin(2 * math.pi * 440 * i /
+                                                    sample_rate))
+                                for i in xrange(sample_rate)
+                                for channel in (0, 1)])
+    second = samples.tostring()
+    paths = []
+    for i in xrange(count):
+        path = os.path.join(directory, 'track{:05d}.wav'.format(i))
+        output = wave.open(path, 'wb')
+        output.setnchannels(2)
+        output.setsampwidth(2)
+        output.setframerate(sample_rate)
+        whole, part = divmod(int(seconds * sample_rate), sample_rate)
+        output.writeframes(second * whole + second[:part * 4])
+        output.close()
+        paths.append(path)
+    return paths
+
+
+class SyntheticFile(object):
+    """PCM of a tone in the format :class:`files.AudioFile` returns,
+    without touching the disk or audiotools."""
+    sample_rate = 44100
+    channels = 2
+    bits_per_sample = 24
+    block = None
+    def __init__(self, seconds):
+        super(SyntheticFile, self).__init__()
+        frame_size = self.channels * self.bits_per_sample // 8
+        self.remaining = int(seconds * self.sample_rate) * frame_size
+        if SyntheticFile.block is None:
+            SyntheticFile.block = self.tone()
+        self.offset = 0
+
+    @classmethod
+    def tone(cls):
+        """Returns one second of a 440Hz tone as 24-bit PCM."""
+        frames = []
+        for i in xrange(cls.sample_rate):
+            value = int(0x100000 * math.sin(2 * math.pi * 440 * i /
+                                             cls.sample_rate))
+            sample = struct.pack('<i', value)[:3]
+            frames.append(sample * cls.channels)
+        return b''.join(frames)
+
+    def read(self, size=4096, timeout=0.0):
+        size = min(size, self.remaining, len(self.block) - self.offset)
+        data = self.block[self.offset:self.offset + size]
+        self.offset = (self.offset + size) % len(self.block)
+        self.remaining -= size
+        return data
+
+    def close(self):
+        pass
+
+
+class UnpacedPacer(pacer.Pacer):
+    """Sends as fast as the pipeline can produce."""
+    def wait(self, duration):
+        self.sent += duration
+
+
+class Stream(object):
+    """What the sink received on one mount."""
+    def __init__(self):
+        super(Stream, self).__init__()
+        self.frames = mp3.FrameSplitter()
+        self.first_byte = None
+        self.last_byte = None
+        self.bytes = 0
+        self.seconds = 0.0
+        # Longest pause in arrivals since the last track switch, the
+        # longest per track is kept in switch_gaps.
+        self.switch_gap = None
+        self.switch_gaps = metrics.Histogram()
+        self.lock = threading.Lock()
+
+    def received(self, data, now):
+        with self.lock:
+            if self.first_byte is None:
+                self.first_byte = now
+            elif self.switch_gap is not None:
+                self.switch_gap = max(self.switch_gap, now - self.last_byte)
+            self.last_byte = now
+            self.bytes += len(data)
+            self.seconds += self.frames.feed(data)[1]
+
+    def switched(self):
+        with self.lock:
+            if self.switch_gap is not None:
+                self.switch_gaps.observe(self.switch_gap)
+            if self.first_byte is not None:
+                self.switch_gap = 0.0
+
+
+class SinkHandler(SocketServer.StreamRequestHandler):
+    """Handles one connection of libshout, either a source connection or
+    a metadata update."""
+    # Unbuffered, the stream data is read from the socket directly.
+    rbufsize = 0
+    response = ('HTTP/1.0 200 OK\r\nContent-Type: text/xml\r\n\r\n'
+                '<?xml version="1.0"?>\n<iceresponse><message>Metadata update '
+                'successful</message><return>1</return></iceresponse>\n')
+    def handle(self):
+        request = self.rfile.readline().split()
+        headers = {}
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if len(request) < 2:
+            return
+        method, path = request[:2]
+        sink = self.server
+        if method in ('SOURCE', 'PUT'):
+            if headers.get('expect', '').lower() == '100-continue':
+                self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+            else:
+                self.wfile.write('HTTP/1.0 200 OK\r\n\r\n')
+            self.wfile.flush()
+            stream = sink.stream(path)
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                stream.received(data, pacer.monotonic())
+        elif path.startswith('/admin/metadata'):
+            sink.metadata_updates += 1
+            self.wfile.write(self.response)
+        else:
+            self.wfile.write('HTTP/1.0 404 Not Found\r\n\r\n')
+
+
+class Sink(SocketServer.ThreadingTCPServer):
+    """A local server that accepts icecast source connections and keeps
+    a :class:`Stream` per mount."""
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, host='127.0.0.1', port=0):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port),
+                                                 SinkHandler)
+        self.streams = {}
+        self.metadata_updates = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name="Benchmark Sink")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stream(self, mount):
+        with self.lock:
+            return self.streams.setdefault(mount, Stream())
+
+    def switched(self):
+        """Called on every track switch."""
+        with self.lock:
+            streams = self.streams.values()
+        for stream in streams:
+            stream.switched()
+
+
+class BenchmarkManager(audio.Manager):
+    """A manager that plays synthetic tracks of `seconds` when `seconds`
+    is given, and files from disk otherwise."""
+    def __init__(self, icecast_config, next_file, seconds=None, **kwargs):
+        super(BenchmarkManager, self).__init__(icecast_config, next_file,
+                                               **kwargs)
+        self.seconds = seconds
+
+    def open_file(self, filename, track=None, gain=None, cache_key=None):
+        if self.seconds is not None:
+            return SyntheticFile(self.seconds)
+        return super(BenchmarkManager, self).open_file(filename, track, gain,
+                                                       cache_key)
+
+
+def rss():
+    """Returns the resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # Only the peak is available here.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cpu_time():
+    """Returns the CPU seconds used by us and our reaped children."""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def run(options):
+    """Runs one benchmark with the parsed `options` and returns a dict
+    with the results."""
+    workdir = tempfile.mkdtemp(prefix='audio-benchmark-')
+    try:
+        return measure(options, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure(options, workdir):
+    if options.lame:
+        encoder.LAME_BIN = options.lame
+    elif options.real_lame and distutils.spawn.find_executable('lame'):
+        encoder.LAME_BIN = 'lame'
+    else:
+        encoder.LAME_BIN = write_standin_lame(workdir)
+
+    if options.files:
+        paths = generate_files(workdir, min(options.tracks, options.files),
+                               options.seconds)
+        seconds = None
+    else:
+        paths = None
+        seconds = options.seconds
+
+    sink = Sink()
+    sink.start()
+    host, port = sink.server_address
+    profiles = [audio.OutputProfile({'host': host, 'port': port,
+                                     'password': 'hackme', 'format': 1,
+                                     'protocol': 0,
+                                     'mount': 'bench{:d}.mp3'.format(i)},
+                                    name='bench{:d}'.format(i))
+                for i in xrange(options.outputs)]
+
+    state = {'handed': 0, 'started': 0, 'memory': []}
+    done = threading.Event()
+
+    def next_file():
+        if state['handed'] >= options.tracks:
+            done.set()
+            return (None, None)
+        state['handed'] += 1
+        filename = (paths[state['handed'] % len(paths)] if paths
+                    else u'synthetic')
+        return (filename, u"Track {:d}".format(state['handed']))
+
+    def file_started(filename, metadata):
+        sink.switched()
+        state['started'] += 1
+        if state['started'] % options.sample_every == 0:
+            state['memory'].append((state['started'], rss()))
+
+    manager = BenchmarkManager({}, next_file, seconds,
+                               lookahead=options.lookahead,
+                               file_started=file_started,
+                               buffer_ms=options.buffer_ms,
+                               profiles=profiles, collect_metrics=True)
+    if options.unpaced:
+        for output in manager.outputs:
+            output.icecast.pacer = UnpacedPacer()
+
+    memory_start = rss()
+    cpu_start = cpu_time()
+    start = pacer.monotonic()
+    manager.start()
+    try:
+        if not done.wait(options.timeout):
+            logger.warning("Timed out after %d of %d tracks.",
+                           state['handed'], options.tracks)
+        # Let the last track reach the sink.
+        while manager.started.is_set() and (pacer.monotonic() - start <
+                                            options.timeout):
+            time.sleep(0.2)
+    finally:
+        if manager.started.is_set():
+            manager.close()
+    end = pacer.monotonic()
+    cpu = cpu_time() - cpu_start
+    sink.shutdown()
+
+    streams = {}
+    for mount, stream in sink.streams.items():
+        wall = (stream.last_byte or end) - (stream.first_byte or end)
+        streams[mount] = {
+            'time_to_first_byte': (stream.first_byte - start
+                                   if stream.first_byte else None),
+            'bytes': stream.bytes,
+            'stream_seconds': stream.seconds,
+            'realtime_factor': stream.seconds / wall if wall > 0 else None,
+            'switch_gap': stream.switch_gaps.snapshot(),
+            'skipped_bytes': stream.frames.skipped,
+        }
+    stream_seconds = max([stream.seconds
+                          for stream in sink.streams.values()] or [0.0])
+    memory_end = rss()
+    return {
+        'lame': encoder.LAME_BIN,
+        'tracks': state['started'],
+        'wall_seconds': end - start,
+        'cpu_per_stream_second': (cpu / stream_seconds
+                                  if stream_seconds else None),
+        'memory_start': memory_start,
+        'memory_end': memory_end,
+        'memory_growth_per_1000_tracks': ((memory_end - memory_start) *
+                                          1000.0 / state['started']
+                                          if state['started'] else None),
+        'memory_samples': state['memory'],
+        'metadata_updates': sink.metadata_updates,
+        'streams': streams,
+        'pipeline': manager.pipeline_stats(),
+    }
+
+
+def decode_all(name, paths, bits_per_sample, connection):
+    """Decodes `paths` with the backend `name` and sends the results over
+    `connection`, runs in a process of its own."""
+    frame_size = 2 * bits_per_sample // 8
+    decoded, failures = 0, 0
+    start = pacer.monotonic()
+    cpu_start = cpu_time()
+    for path in paths:
+        try:
+            decoder = files.BACKENDS[name](path, 44100, 2, bits_per_sample)
+        except files.AudioError:
+            failures += 1
+            continue
+        try:
+            while True:
+                data = decoder.read(65536)
+                if not data:
+                    break
+                decoded += len(data)
+        except (ValueError, IOError):
+            failures += 1
+        processes = decoder.processes()
+        decoder.close()
+        # Waited for here so their usage counts for our children.
+        for process in processes:
+            process.wait()
+    wall = pacer.monotonic() - start
+    cpu = cpu_time() - cpu_start
+    seconds = float(decoded // frame_size) / 44100
+    connection.send({
+        'files': len(paths) - failures,
+        'failures': failures,
+        'audio_seconds': seconds,
+        'wall_seconds': wall,
+        'realtime_factor': seconds / wall if wall > 0 else None,
+        'cpu_seconds': cpu,
+        'cpu_per_audio_second': cpu / seconds if seconds else None,
+        'max_rss': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'max_rss_children': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    })
+
+
+def compare_decoders(options):
+    """Decodes the same files with every backend and returns a dict of
+    the results per backend."""
+    workdir = tempfile.mkdtemp(prefix='audio-benchmark-')
+    try:
+        paths = options.paths or generate_files(workdir, options.files or 10,
+                                                options.seconds)
+        results = {}
+        for name in sorted(files.BACKENDS):
+            ours, theirs = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=decode_all,
+                                              args=(name, paths,
+                                                    options.bits_per_sample,
+                                                    theirs))
+            process.start()
+            theirs.close()
+            try:
+                results[name] = ours.recv()
+            except EOFError:
+                results[name] = None
+            process.join()
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+parser = argparse.ArgumentParser(description="Benchmark the audio pipeline "
+                                 "against a local icecast sink.")
+parser.add_argument('--tracks', type=int, default=100,
+                    help="amount of tracks to play")
+parser.add_argument('--seconds', type=float, default=2.0,
+                    help="length of every track in seconds")
+parser.add_argument('--files', type=int, default=0,
+                    help="generate this many WAV files and decode them "
+                    "instead of using synthetic PCM")
+parser.add_argument('--outputs', type=int, default=1,
+                    help="amount of outputs to fan out to")
+parser.add_argument('--lookahead', type=int, default=1)
+parser.add_argument('--buffer-ms', type=int, default=0)
+parser.add_argument('--unpaced', action='store_true',
+                    help="don't pace sending to realtime")
+parser.add_argument('--lame', help="path of the lame binary to use")
+parser.add_argument('--real-lame', action='store_true',
+                    help="use lame from the PATH if there is one instead of "
+                    "the stand-in")
+parser.add_argument('--sample-every', type=int, default=100,
+                    help="sample memory every this many tracks")
+parser.add_argument('--timeout', type=float, default=3600.0)
+parser.add_argument('--verbose', action='store_true')
+parser.add_argument('--decoders', action='store_true',
+                    help="compare the decoder backends on `paths`, or on "
+                    "generated WAV files, instead")
+parser.add_argument('--bits-per-sample', type=int, default=24)
+parser.add_argument('paths', nargs='*', help="files to decode with "
+                    "--decoders")
+
+
+def main():
+    options = parser.parse_args()
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    result = compare_decoders(options) if options.decoders else run(options)
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Module with the buffering stage that sits between the decoder and the
+encoder feeder.
+
+The buffer is a preallocated ring so the hot path doesn't allocate a new
+string for every chunk that passes through it."""
+import threading
+import logging
+import time
+
+
+logger = logging.getLogger('audio.buffer')
+
+
+class RingBuffer(object):
+    """A fixed size byte ring buffer that is safe to use from one writer
+    and one reader thread.
+
+    Reading is done in two steps, :meth:`peek` returns a memoryview into
+    the ring and :meth:`consume` releases it again. The writer never
+    touches a region that is peeked but not yet consumed."""
+    def __init__(self, capacity):
+        super(RingBuffer, self).__init__()
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+
+        self.start = 0 # Position of the first readable byte
+        self.size = 0 # Amount of readable bytes
+
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def free(self):
+        """Amount of bytes that can be written without blocking."""
+        return self.capacity - self.size
+
+    def write(self, data, timeout=None):
+        """Copies `data` into the ring, blocks while the ring is full.
+
+        Returns the amount of bytes written, this is less than the length
+        of `data` if the ring got closed or `timeout` ran out."""
+        data = memoryview(data)
+        offset = 0
+        with self.condition:
+            while offset < len(data):
+                if not self.free and not self.closed:
+                    self.condition.wait(timeout)
+                if self.closed or not self.free:
+                    break
+                end = (self.start + self.size) % self.capacity
+                length = min(len(data) - offset, self.free,
+                             self.capacity - end)
+                self.view[end:end + length] = data[offset:offset + length]
+                self.size += length
+                offset += length
+                self.condition.notify_all()
+        return offset
+
+    def offer(self, data, timeout=None):
+        """Copies all of `data` into the ring or nothing at all, waits at
+        most `timeout` seconds for enough space. Returns True if written.
+
+        Useful when dropping a partial chunk would break alignment."""
+        if len(data) > self.capacity:
+            return False
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.free < len(data) and not self.closed:
+                remaining = (None if deadline is None else
+                             deadline - time.time())
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if self.closed or self.free < len(data):
+                return False
+            return self.write(data) == len(data)
+
+    def peek(self, size, timeout=None):
+        """Returns a memoryview of at most `size` readable bytes, waits at
+        most `timeout` seconds for data to be available.
+
+        The view is only contiguous up to the end of the ring, so it can be
+        shorter than what is available. Call :meth:`consume` when done."""
+        with self.condition:
+            if not self.size and not self.closed:
+                self.condition.wait(timeout)
+            length = min(size, self.size, self.capacity - self.start)
+            return self.view[self.start:self.start + length]
+
+    def consume(self, size):
+        """Releases `size` bytes at the front of the ring."""
+        with self.condition:
+            size = min(size, self.size)
+            self.start = (self.start + size) % self.capacity
+            self.size -= size
+            self.condition.notify_all()
+
+    def read(self, size, timeout=None):
+        """Returns a copy of at most `size` bytes from the ring."""
+        view = self.peek(size, timeout)
+        data = view.tobytes()
+        self.consume(len(data))
+        return data
+
+    def clear(self):
+        """Drops everything that is in the ring."""
+        with self.condition:
+            self.start = 0
+            self.size = 0
+            self.condition.notify_all()
+
+    def close(self):
+        """Wakes up any waiting threads and stops accepting writes."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class BufferedSource(object):
+    """A source that decodes ahead of its consumer into a :class:`RingBuffer`.
+
+    A background thread reads from `source` and fills the ring, the
+    consumer drains it either with :meth:`read` or without copying
+    through :meth:`read_view` and :meth:`consume`. The capacity is given
+    in milliseconds of audio in the format of `source`."""
+    read_size = 16384 # What we read from the source per call
+    slice_size = 65536 # What consumers are advised to drain per call
+    capacity_ms = 2000
+    def __init__(self, source, capacity_ms=None, sample_rate=44100,
+                 channels=2, bits_per_sample=16):
+        super(BufferedSource, self).__init__()
+        self.source = source
+        self.capacity_ms = capacity_ms or self.capacity_ms
+
+        frame_size = channels * bits_per_sample // 8
+        frames = sample_rate * self.capacity_ms // 1000
+        self.ring = RingBuffer(max(frames, 1) * frame_size)
+
+        self.eof = threading.Event()
+        self.closed = threading.Event()
+
+    def start(self):
+        """Starts the thread that fills the buffer."""
+        self.eof.clear()
+        self.closed.clear()
+        self.ring = RingBuffer(self.ring.capacity)
+        self.thread = threading.Thread(target=self.run,
+                                       name="PCM Decoder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.closed.is_set():
+            try:
+                data = self.source.read(self.read_size)
+            except:
+                logger.exception("Failed reading from source.")
+                data = b''
+            if data == b'':
+                # The source only ends for good.
+                break
+            self.ring.write(data)
+        self.eof.set()
+        # Lets the consumer drain what is left without waiting.
+        self.ring.close()
+
+    def read_view(self, size=None, timeout=10.0):
+        """Returns a memoryview of at most `size` buffered bytes without
+        copying them. The bytes stay in the buffer until :meth:`consume`
+        is called."""
+        return self.ring.peek(size or self.slice_size, timeout)
+
+    def consume(self, size):
+        """Releases `size` bytes returned by :meth:`read_view`."""
+        self.ring.consume(size)
+
+    def read(self, size=4096, timeout=10.0):
+        """Returns at most `size` bytes, an empty string is returned on
+        timeout or when the source ended and the buffer is drained."""
+        return self.ring.read(size, timeout)
+
+    @property
+    def buffered_ms(self):
+        """Milliseconds of audio currently in the buffer."""
+        return self.capacity_ms * len(self.ring) // self.ring.capacity
+
+    def close(self):
+        self.closed.set()
+        self.ring.close()
+
+    def __getattr__(self, key):
+        return getattr(self.source, key)
@@ -0,0 +1,214 @@
+"""Module with an on-disk cache of encoded tracks.
+
+The first time a track plays its encoded output is written to disk, later
+plays send the cached MP3 as passthrough instead of decoding and encoding
+the file again."""
+import os
+import hashlib
+import tempfile
+import threading
+import logging
+
+import mp3
+
+
+logger = logging.getLogger('audio.cache')
+
+
+class SegmentCache(object):
+    """A directory of encoded tracks with least recently used eviction.
+
+    Entries are keyed by track id, the path, size and modification time of
+    the file and the encoder profile. A changed file therefore never hits
+    an old entry, :meth:`invalidate` removes all entries of a track.
+
+    `budget` is the maximum amount of bytes the directory may use."""
+    suffix = '.mp3'
+    def __init__(self, directory, budget=2 * 1024 ** 3):
+        super(SegmentCache, self).__init__()
+        self.directory = directory
+        self.budget = budget
+
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.stores = 0
+        self.evictions = self.invalidations = self.aborts = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = 0
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.part'):
+                # Left over from an interrupted recording.
+                os.remove(path)
+            elif name.endswith(self.suffix):
+                self.size += os.path.getsize(path)
+
+    def path(self, track, filename, profile):
+        """Returns the cache path for `filename` as track `track` encoded
+        with `profile`, a string describing the encoder arguments."""
+        stat = os.stat(filename)
+        key = repr((filename, stat.st_size, stat.st_mtime, profile))
+        if isinstance(filename, unicode):
+            key = key.encode('utf8')
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, "{:d}-{:s}{:s}".format(
+            track, digest, self.suffix))
+
+    def open(self, track, filename, profile, sample_rate=44100):
+        """Returns a :class:`CachedFile` for the entry or None on a miss."""
+        try:
+            path = self.path(track, filename, profile)
+            cached = CachedFile(path, sample_rate)
+        except (OSError, IOError, mp3.PassthroughError):
+            with self.lock:
+                self.misses += 1
+            return None
+        # Bump it to the front of the eviction order.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return cached
+
+    def writer(self, track, filename, profile):
+        """Returns a :class:`CacheWriter` that stores a new entry."""
+        try:
+            path = self.path(track, filename, profile)
+            return CacheWriter(self, path)
+        except (OSError, IOError):
+            logger.exception("Failed creating cache entry.")
+            return None
+
+    def store(self, writer):
+        """Called by a :class:`CacheWriter` with a complete entry."""
+        with self.lock:
+            # Another manager sharing the cache might have recorded the
+            # same track meanwhile, it gets replaced.
+            if os.path.exists(writer.path):
+                self.size -= os.path.getsize(writer.path)
+            os.rename(writer.partial, writer.path)
+            self.size += writer.size
+            self.stores += 1
+        self.evict()
+
+    def abort(self, writer):
+        with self.lock:
+            self.aborts += 1
+
+    def evict(self):
+        """Removes the least recently used entries until we are within
+        our budget."""
+        with self.lock:
+            if self.size <= self.budget:
+                return
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+            for _, size, path in entries:
+                if self.size <= self.budget:
+                    break
+                self.remove(path, size)
+                self.evictions += 1
+
+    def invalidate(self, track):
+        """Removes all entries of track id `track`."""
+        prefix = "{:d}-".format(track)
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix) and name.endswith(self.suffix):
+                    path = os.path.join(self.directory, name)
+                    self.remove(path, os.path.getsize(path))
+                    self.invalidations += 1
+
+    def remove(self, path, size):
+        """Internal method, call with the lock held."""
+        try:
+            os.remove(path)
+        except OSError:
+            logger.exception("Failed removing cache entry.")
+        else:
+            self.size -= size
+
+    def stats(self):
+        """Returns a dict with the hit, miss and size statistics."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'stores': self.stores, 'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'aborts': self.aborts, 'size': self.size,
+                    'budget': self.budget}
+
+
+class CachedFile(mp3.PassthroughFile):
+    """A cache entry opened for sending, the data it returns starts and
+    ends on a frame boundary."""
+    def __init__(self, path, sample_rate=44100):
+        super(CachedFile, self).__init__(path, None, sample_rate)
+
+
+class CacheWriter(object):
+    """Writes encoded data into a temporary file that becomes a cache
+    entry on :meth:`commit`, or is removed on :meth:`abort`. Every writer
+    has its own temporary file, so several can record the same entry."""
+    def __init__(self, cache, path):
+        super(CacheWriter, self).__init__()
+        self.cache = cache
+        self.path = path
+        fd, self.partial = tempfile.mkstemp(
+            '.part', os.path.basename(path) + '.', cache.directory)
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.done = False
+
+    def write(self, data):
+        if self.done:
+            return
+        if self.size + len(data) > self.cache.budget:
+            logger.warning("Track is larger than the cache budget.")
+            self.abort()
+            return
+        try:
+            self.file.write(data)
+        except (IOError, OSError):
+            logger.exception("Failed writing cache entry.")
+            self.abort()
+        else:
+            self.size += len(data)
+
+    def commit(self):
+        """Makes the written data available as cache entry."""
+        if self.done:
+            return
+        try:
+            self.file.close()
+            if self.size == 0:
+                raise IOError("Nothing was written.")
+            self.cache.store(self)
+        except (IOError, OSError):
+            logger.exception("Failed storing cache entry.")
+            self.abort()
+        else:
+            self.done = True
+
+    def abort(self):
+        """Throws away the written data."""
+        if self.done:
+            return
+        self.done = True
+        self.file.close()
+        try:
+            os.remove(self.partial)
+        except OSError:
+            pass
+        self.cache.abort(self)
@@ -0,0 +1,61 @@
+"""Module that mixes the end of a track into the start of the next one.
+
+The mixing is done with NumPy over whole overlaps at once, see
+:meth:`Crossfader.mix`. :class:`audio.UnendingSource` holds back the last
+`duration` seconds of every track to have a tail to mix with."""
+import logging
+
+import pcm
+from pcm import numpy
+
+
+logger = logging.getLogger('audio.crossfade')
+
+
+def linear(position):
+    """Returns the (fade out, fade in) gains at `position` from 0 to 1."""
+    return 1.0 - position, position
+
+
+def equal_power(position):
+    """Keeps the combined power constant for uncorrelated tracks."""
+    angle = position * numpy.pi / 2
+    return numpy.cos(angle), numpy.sin(angle)
+
+
+def exponential(position):
+    """Fades out quickly and in slowly, for tracks that end loud."""
+    return (1.0 - position) ** 2, 1.0 - (1.0 - position) ** 2
+
+
+CURVES = {'linear': linear, 'equal_power': equal_power,
+          'exponential': exponential}
+
+
+class Crossfader(object):
+    """Mixes overlaps of `duration` seconds with the named `curve`."""
+    def __init__(self, duration, curve='equal_power', sample_rate=44100,
+                 channels=2, bits_per_sample=16):
+        super(Crossfader, self).__init__()
+        if curve not in CURVES:
+            raise ValueError("Unknown crossfade curve: {!r}".format(curve))
+        self.curve = CURVES[curve]
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+        self.frame_size = channels * pcm.sample_size(bits_per_sample)
+        # Bytes of the tail that are held back for the overlap.
+        self.size = int(duration * sample_rate) * self.frame_size
+
+    def mix(self, tail, head):
+        """Returns `tail` faded out mixed with `head` faded in, both PCM
+        of the same whole number of frames."""
+        frames = len(tail) // self.frame_size
+        if not frames:
+            return b''
+        position = (numpy.arange(frames) + 0.5) / frames
+        fade_out, fade_in = self.curve(position)
+        bits = self.bits_per_sample
+        out = pcm.to_samples(tail, bits).reshape(-1, self.channels)
+        into = pcm.to_samples(head, bits).reshape(-1, self.channels)
+        mixed = out * fade_out[:, None] + into * fade_in[:, None]
+        return pcm.to_pcm(mixed.reshape(-1), bits)
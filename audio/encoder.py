@@ -1,10 +1,13 @@
 import subprocess
 import threading
+import collections
 import decimal
 import time
 import select
 import logging
 import garbage
+import metrics
+from pacer import monotonic
 
 import datetime
 
@@ -20,26 +23,176 @@ class Encoder(object):
     """An Encoder that handles the encoder process underneath.
     
     It is possible that the actual process to encode with is different
-    over time due to crashes or restarts
+    over time due to crashes or restarts. `metrics` records how long
+    writes to and reads from the encoder block. The PCM is expected to be
+    of `bits_per_sample` depth, by default that of the source. With a
+    :class:`filler.Watchdog` as `watchdog` filler is encoded while the
+    source has nothing for us.
+    
+    With `standby` a spare encoder process is kept running, it takes over
+    right away when an instance fails or is replaced and a new spare is
+    started in the background. The time it takes to have a new instance
+    running is recorded as `promotion`.
     """
-    def __init__(self, source):
+    default_compression = ['--cbr', '-b', '192', '--resample', '44.1']
+    def __init__(self, source, chunk_size=4096, compression=None, mode='j',
+                 metrics=metrics.NULL, bits_per_sample=None, watchdog=None,
+                 standby=False):
         super(Encoder, self).__init__()
         self.alive = threading.Event()
+        self.metrics = metrics
         
         self.source = source
-        self.compression = ['--cbr', '-b', '192', '--resample', '44.1']
-        self.mode = 'j'
+        self.chunk_size = chunk_size
+        self.compression = list(compression or self.default_compression)
+        self.mode = mode
+        self.bits_per_sample = bits_per_sample
+        self.watchdog = watchdog
         
         self.out_file = '-'
         
+        # Amount of PCM bytes written to encoder instances so far
+        self.position = 0
+        # (position, seconds) of audio that was encoded without being part
+        # of our source, filler and passthrough sources, in total up to
+        # that position. See stream_seconds.
+        self.inserted = collections.deque([(0, 0.0)], 4096)
+        # Passthrough sources waiting for the feeder to reach their position
+        self.splices = collections.deque()
+        # Readers that are read from before the current instance
+        self.segments = collections.deque()
+        self.lock = threading.Lock()
+        
+        self.standby = standby
+        # The spare EncoderInstance, its process is running but not fed
+        self.spare = None
+        self.spare_lock = threading.Lock()
+        
     def start(self):
         self.alive.clear()
+        self.position = 0
+        self.inserted = collections.deque([(0, 0.0)], 4096)
         self.start_instance()
+        self.insert(self.instance.delay_seconds())
         
     def close(self):
         """Closes the encoder."""
         self.alive.set() # Set ourself to closed so we don't restart instances
         self.instance.close()
+        with self.spare_lock:
+            spare, self.spare = self.spare, None
+        if spare is not None:
+            spare.discard()
+        with self.lock:
+            segments = list(self.segments)
+            segments.extend(source for _, source, _ in self.splices
+                            if source is not None)
+            recorders = [recorder for _, _, recorder in self.splices
+                         if recorder is not None]
+            self.segments.clear()
+            self.splices.clear()
+        for segment in segments:
+            self.end_segment(segment)
+        for recorder in recorders:
+            recorder.abort()
+            
+    def split(self, position, source=None, recorder=None):
+        """Ends the current encoder instance once the PCM up to byte
+        `position` of our source is written to it.
+        
+        `source` is played after the output of that instance without
+        encoding it, it should have `started` and `finished` events that
+        are set when we start and stop reading from it. The instance that
+        encodes the PCM after `position` passes its output to `recorder`."""
+        with self.lock:
+            self.splices.append((position, source, recorder))
+            
+    def insert(self, seconds):
+        """Accounts for `seconds` of audio that was played at our current
+        position without being part of our source."""
+        with self.lock:
+            position, total = self.inserted[-1]
+            if position == self.position:
+                self.inserted[-1] = (position, total + seconds)
+            else:
+                self.inserted.append((self.position, total + seconds))
+            
+    def stream_seconds(self, position):
+        """Returns how many seconds into our output the PCM at byte
+        `position` of our source is, or None if it wasn't written yet."""
+        if position > self.position:
+            return None
+        source = self.source
+        byte_rate = (source.sample_rate * getattr(source, 'channels', 2) *
+                     (self.bits_per_sample or source.bits_per_sample) // 8)
+        inserted = 0.0
+        with self.lock:
+            for at, total in reversed(self.inserted):
+                if at <= position:
+                    inserted = total
+                    break
+        return float(position) / byte_rate + inserted
+            
+    def delay_seconds(self):
+        """Returns the seconds of silence the current instance puts in
+        front of what it encodes."""
+        return self.instance.delay_seconds()
+            
+    def next_splice(self):
+        """Returns the PCM position of the next split or None."""
+        with self.lock:
+            return self.splices[0][0] if self.splices else None
+        
+    def splice(self, instance):
+        """Called by the feeder of `instance` once it wrote all PCM up to
+        the next split.
+        
+        The instance is finished so lame flushes its last frames, they are
+        read before the passthrough source and a new instance is started
+        for the PCM after it."""
+        with self.lock:
+            position, source, recorder = self.splices.popleft()
+            self.segments.append(instance)
+            if source is not None:
+                self.segments.append(source)
+            self.start_instance(recorder)
+        # Every instance adds its own silence around what it encodes.
+        inserted = instance.padding_seconds() + self.instance.delay_seconds()
+        if source is not None:
+            inserted += float(source.samples) / source.sample_rate
+        self.insert(inserted)
+        instance.finish()
+        
+    def read(self, size=4096, timeout=10.0):
+        """Reads encoded data, this includes passthrough sources at the
+        right place between the encoder output."""
+        while True:
+            with self.lock:
+                reader = self.segments[0] if self.segments else self.instance
+            with self.metrics.time('output_wait'):
+                data = reader.read(size, timeout)
+            if data and getattr(reader, 'recorder', None) is not None:
+                reader.recorder.write(data)
+            if data or reader is self.instance:
+                return data
+            if isinstance(reader, EncoderInstance) and not reader.finished:
+                return data # Timeout, the instance isn't done flushing.
+            with self.lock:
+                self.segments.popleft()
+                following = self.segments[0] if self.segments else None
+            self.end_segment(reader)
+            if following is not None and hasattr(following, 'started'):
+                following.started.set()
+                
+    def end_segment(self, segment):
+        """Cleans up a reader that we are done with."""
+        if isinstance(segment, EncoderInstance):
+            segment.process.stdout.close()
+            segment.end_recording()
+            GarbageInstance(segment)
+        else:
+            segment.close()
+            segment.finished.set()
         
     def restart(self):
         """Restarts the encoder process underneath."""
@@ -51,15 +204,48 @@ class Encoder(object):
         This registers the current instance for garbage collection and
         then starts a new instance for use.
         """
+        self.instance.end_recording()
         if not self.alive.is_set():
             GarbageInstance(self.instance)
             self.start_instance()
+            self.insert(self.instance.delay_seconds())
             
-    def start_instance(self):
-        """Called to create a new EncoderInstance"""
-        new = EncoderInstance(self)
+    def start_instance(self, recorder=None):
+        """Called to create a new EncoderInstance, the spare one is used if
+        we have one that is still alive."""
+        started = monotonic()
+        with self.spare_lock:
+            new, self.spare = self.spare, None
+        if new is not None and new.process.poll() is not None:
+            logger.warning("Spare encoder died, starting a new one.")
+            new.discard()
+            new = None
+        self.metrics.mark('cold_starts' if new is None else 'promotions')
+        if new is None:
+            new = EncoderInstance(self)
+        new.recorder = recorder
         new.start()
         self.instance = new
+        self.metrics.observe('promotion', monotonic() - started)
+        if self.standby and not self.alive.is_set():
+            thread = threading.Thread(target=self.start_spare,
+                                      name='Encoder Spare')
+            thread.daemon = True
+            thread.start()
+            
+    def start_spare(self):
+        """Starts the process of a spare instance."""
+        spare = EncoderInstance(self)
+        try:
+            spare.spawn()
+        except OSError:
+            logger.exception("Failed starting a spare encoder.")
+            return
+        with self.spare_lock:
+            if self.spare is None and not self.alive.is_set():
+                self.spare, spare = spare, None
+        if spare is not None:
+            spare.discard() # Closed or raced by another spare
         
     def __getattr__(self, key):
         """Since we are used as the source to other parts we require
@@ -71,43 +257,131 @@ class Encoder(object):
     
 class EncoderInstance(object):
     """Class that represents a subprocessed encoder."""
+    # Samples of silence lame puts in front of what it encodes
+    delay = 576
+    # Samples in an MP3 frame, lame pads its last frame with silence
+    frame_samples = 1152
     def __init__(self, encoder_manager):
         super(EncoderInstance, self).__init__()
         self.encoder_manager = encoder_manager
         
-        for key in ['source', 'compression', 'mode', 'out_file']:
+        for key in ['source', 'compression', 'mode', 'out_file',
+                    'chunk_size', 'metrics', 'bits_per_sample', 'watchdog']:
             setattr(self, key, getattr(self.encoder_manager, key))
         
         self.running = threading.Event()
+        # Set when we are finishing up for a passthrough source, the output
+        # is then read until the end by the encoder manager.
+        self.draining = False
+        self.finished = False
+        # Gets a copy of all our output when set, see Encoder.split
+        self.recorder = None
+        self.process = None
+        # Amount of PCM bytes written to our process
+        self.written = 0
         
     def run(self):
+        if hasattr(self.source, 'read_view'):
+            self.run_buffered()
         while not self.running.is_set():
-            data = self.source.read()
+            data = self.source.read(self.chunk_size, self.read_timeout)
             if data == b'':
+                if self.fill():
+                    continue
                 # EOF we just sleep and wait for a new source
-                time.sleep(0.3)
-            self.write(data)
+                time.sleep(0.3 if self.watchdog is None else
+                           self.watchdog.interval)
+            if self.write(data):
+                self.encoder_manager.position += len(data)
+                if data and self.watchdog is not None:
+                    self.watchdog.fed()
         try:
             self.process.stdin.close()
-            self.process.stdout.close()
-            self.process.wait()
+            if not self.draining:
+                self.process.stdout.close()
+                self.process.wait()
         except:
             logger.exception("Failed to cleanly shutdown encoder.")
             
-    def start(self):
-        self.running.clear()
+    def run_buffered(self):
+        """Feeds the encoder straight from the buffer of the source without
+        copying. Data is only released from the buffer once written, so a
+        replacement instance picks up where a failed write left off."""
+        manager = self.encoder_manager
+        while not self.running.is_set():
+            size = self.chunk_size
+            splice = manager.next_splice()
+            if splice is not None:
+                size = min(size, splice - manager.position)
+                if size <= 0:
+                    manager.splice(self)
+                    break
+            view = self.source.read_view(size, self.read_timeout)
+            if not len(view):
+                if self.fill():
+                    continue
+                if self.source.eof.is_set():
+                    # EOF we just sleep and wait for a new source
+                    time.sleep(0.3)
+                continue
+            if self.write(view):
+                self.source.consume(len(view))
+                manager.position += len(view)
+                if self.watchdog is not None:
+                    self.watchdog.fed()
+            
+    @property
+    def read_timeout(self):
+        """How long to wait for the source, short enough for the watchdog
+        to notice an underrun in time."""
+        return 10.0 if self.watchdog is None else self.watchdog.interval
+        
+    def fill(self):
+        """Writes filler if the watchdog says it's due, returns True if
+        it did. Filler doesn't count towards our position."""
+        if self.watchdog is None:
+            return False
+        data = self.watchdog.fill()
+        if not data or not self.write(data):
+            return False
+        self.encoder_manager.insert(float(len(data)) /
+                                    self.watchdog.filler.byte_rate)
+        return True
+            
+    def delay_seconds(self):
+        """Returns the seconds of silence we put in front of our output."""
+        return float(self.delay) / self.source.sample_rate
+        
+    def padding_seconds(self):
+        """Returns the seconds of silence our last frame is padded with,
+        given what was written to us so far."""
+        frame_size = (getattr(self.source, 'channels', 2) *
+                      (self.bits_per_sample or
+                       self.source.bits_per_sample) // 8)
+        samples = self.delay + self.written // frame_size
+        return float(-samples % self.frame_samples) / self.source.sample_rate
+        
+    def spawn(self):
+        """Starts the encoder process, it waits for PCM until we start
+        feeding it with :meth:`start`."""
         arguments = [LAME_BIN, '--quiet',
                      '--flush',
                      '-r',
                      '-s', str(decimal.Decimal(self.source.sample_rate) / 1000),
-                     '--bitwidth', str(self.source.bits_per_sample),
+                     '--bitwidth', str(self.bits_per_sample or
+                                       self.source.bits_per_sample),
                      '--signed', '--little-endian',
                      '-m', self.mode] + self.compression + ['-', self.out_file]
                      
         self.process = subprocess.Popen(args=arguments,
                                         stdin=subprocess.PIPE,
                                         stdout=subprocess.PIPE)
+        garbage.track(self.process, "lame")
         
+    def start(self):
+        self.running.clear()
+        if self.process is None:
+            self.spawn()
         self.thread = threading.Thread(target=self.run,
                                             name='Encoder Feeder')
         self.thread.daemon = True
@@ -117,8 +391,13 @@ class EncoderInstance(object):
         self.source = new_source
         
     def write(self, data):
+        """Writes `data` to the encoder process, returns True if it
+        was written."""
         try:
-            self.process.stdin.write(data)
+            with self.metrics.time('write'):
+                self.process.stdin.write(data)
+            self.written += len(data)
+            return True
         except (IOError, ValueError) as err:
             logger.exception("Write failed, restarting encoder.")
             self.close()
@@ -133,12 +412,40 @@ class EncoderInstance(object):
                                               [], [], timeout)
         if not reader:
             return b''
-        return reader[0].read(size)
+        data = reader[0].read(size)
+        if not data:
+            self.finished = True
+        return data
     
+    def end_recording(self):
+        """Commits the recording if all our output was read, otherwise
+        the recording is aborted."""
+        if self.recorder is None:
+            return
+        if self.draining and self.finished:
+            self.recorder.commit()
+        else:
+            self.recorder.abort()
+        self.recorder = None
+        
+    def finish(self):
+        """Stops feeding and lets the process flush and exit on its own."""
+        self.draining = True
+        self.running.set()
+        
     def close(self):
         self.running.set()
         self.encoder_manager.report_close()
         
+    def discard(self):
+        """Ends the process of an instance that was never started, it is
+        waited for by the reaper."""
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+        
         
 class GarbageInstance(garbage.Garbage):
     def collect(self):
@@ -0,0 +1,145 @@
+"""Module that decodes once and hands the PCM to several consumers.
+
+Each consumer gets its own :class:`buffer.RingBuffer`, a consumer that
+falls behind gets chunks dropped instead of stalling the others."""
+import threading
+import logging
+
+import buffer
+
+
+logger = logging.getLogger('audio.fanout')
+
+
+class Distributor(object):
+    """Reads PCM from `source` on a background thread and copies every
+    chunk into the buffer of each :class:`FanoutReader` it created.
+
+    A reader that can't take a chunk within `stall_timeout` seconds is
+    marked as lagging, chunks for a lagging reader are dropped until its
+    buffer drained below half. Chunks are handed out and dropped in whole
+    frames so the PCM stays frame aligned, whatever `source` returns."""
+    read_size = 16384
+    stall_timeout = 0.5
+    capacity_ms = 2000
+    def __init__(self, source, capacity_ms=None, sample_rate=44100,
+                 channels=2, bits_per_sample=16):
+        super(Distributor, self).__init__()
+        self.source = source
+
+        self.capacity_ms = capacity_ms or self.capacity_ms
+        self.format = (sample_rate, channels, bits_per_sample)
+        self.frame_size = channels * bits_per_sample // 8
+        # Bytes of a partial frame left over from the last read
+        self.remainder = b''
+
+        self.readers = []
+        self.closed = threading.Event()
+
+    def add_reader(self, name=None):
+        """Returns a new :class:`FanoutReader` that receives all PCM."""
+        reader = FanoutReader(self, name, self.capacity_ms, *self.format)
+        self.readers.append(reader)
+        return reader
+
+    def start(self):
+        """Starts the thread that reads the source."""
+        self.closed.clear()
+        self.remainder = b''
+        for reader in self.readers:
+            reader.reset()
+        self.thread = threading.Thread(target=self.run,
+                                       name="PCM Distributor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.closed.is_set():
+            try:
+                data = self.source.read(self.read_size)
+            except:
+                logger.exception("Failed reading from source.")
+                data = b''
+            if data == b'':
+                break
+            data = self.remainder + data
+            whole = len(data) - len(data) % self.frame_size
+            data, self.remainder = data[:whole], data[whole:]
+            if data:
+                self.distribute(data)
+        for reader in self.readers:
+            reader.finish()
+
+    def distribute(self, data):
+        """Hands `data` to every reader, see the class docstring for how
+        slow readers are treated."""
+        # If everyone is lagging we wait on all of them instead, otherwise
+        # we would race through the source dropping everything.
+        all_lagging = all(reader.lagging for reader in self.readers)
+        for reader in self.readers:
+            if reader.lagging and not all_lagging:
+                timeout = 0
+            else:
+                timeout = self.stall_timeout
+            if reader.ring.offer(data, timeout):
+                if reader.lagging and (len(reader.ring) <
+                                       reader.ring.capacity // 2):
+                    logger.info("Reader %s caught up.", reader.name)
+                    reader.lagging = False
+                continue
+            reader.dropped += len(data)
+            if not reader.lagging:
+                logger.warning("Reader %s is lagging, dropping audio.",
+                               reader.name)
+                reader.lagging = True
+
+    def close(self):
+        self.closed.set()
+        for reader in self.readers:
+            reader.finish()
+
+
+class FanoutReader(object):
+    """One consumer of a :class:`Distributor`.
+
+    It has the same reading interface as :class:`buffer.BufferedSource` so
+    it can be handed to an :class:`encoder.Encoder` as source."""
+    slice_size = buffer.BufferedSource.slice_size
+    def __init__(self, distributor, name, capacity_ms, sample_rate,
+                 channels, bits_per_sample):
+        super(FanoutReader, self).__init__()
+        self.distributor = distributor
+        self.name = name
+
+        frame_size = channels * bits_per_sample // 8
+        frames = sample_rate * capacity_ms // 1000
+        self.capacity = max(frames, 1) * frame_size
+
+        self.eof = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.ring = buffer.RingBuffer(self.capacity)
+        self.eof.clear()
+        self.lagging = False
+        self.dropped = 0
+
+    def finish(self):
+        """Called when no more data is coming."""
+        self.eof.set()
+        self.ring.close()
+
+    def read_view(self, size=None, timeout=10.0):
+        return self.ring.peek(size or self.slice_size, timeout)
+
+    def consume(self, size):
+        self.ring.consume(size)
+
+    def read(self, size=4096, timeout=10.0):
+        return self.ring.read(size, timeout)
+
+    def close(self):
+        self.finish()
+
+    def __getattr__(self, key):
+        return getattr(self.distributor.source, key)
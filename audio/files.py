@@ -1,10 +1,23 @@
 """Module that handles file access and decoding to PCM.
 
-It uses python-audiotools for the majority of the work done."""
+Decoding is done by a backend, python-audiotools unless another is picked
+for the extension of the file. The ffmpeg backend streams PCM out of an
+ffmpeg process instead, for codecs that audiotools is slow at or doesn't
+know. `python -m audio.benchmark --decoders` compares them."""
+import os
 import os.path
+import subprocess
+import logging
 import audiotools
 import audiotools.mp3
 import garbage
+import library
+import pcm
+import silence
+
+
+FFMPEG_BIN = 'ffmpeg'
+logger = logging.getLogger('audio.files')
 
 
 class AudioError(Exception):
@@ -17,41 +30,90 @@ class GarbageAudioFile(garbage.Garbage):
     def collect(self):
         """Tries to close the AudioFile resources when called."""
         try:
-            self.item._reader.close()
-        except (audiotools.DecodingError):
+            self.item.decoder.close()
+        except (audiotools.DecodingError, IOError, OSError):
             pass
-        # Hack to kill zombies below
-        import gc, subprocess
-        try:
-            [item.poll() for item in gc.get_referrers(subprocess.Popen)
-             if isinstance(item, subprocess.Popen)]
-        except:
-            logger.warning("Exception occured in hack.")
-        # Hack to kill zombies above
-        
+        # Any decoder processes are waited for by the reaper.
         return True
     
     
-class AudioFile(object):
-    """A Simple wrapper around the audiotools library.
+def child_processes(reader):
+    """Returns the decoder processes in the chain of audiotools readers
+    that ends with `reader`."""
+    processes, seen = [], set()
+    while reader is not None and id(reader) not in seen:
+        seen.add(id(reader))
+        process = getattr(reader, 'process', None)
+        if isinstance(process, subprocess.Popen):
+            processes.append(process)
+        reader = (getattr(reader, 'pcmreader', None) or
+                  getattr(reader, 'reader', None))
+    return processes
     
-    This opens the filename given wraps the file in a PCMConverter that
-    turns it into PCM of format 44.1kHz, Stereo, 24-bit depth."""
-    def __init__(self, filename):
-        super(AudioFile, self).__init__()
-        self._reader = self._open_file(filename)
+    
+class ResumedReader(object):
+    """Returns the frames in `pending` before reading on from `pcmreader`,
+    used for what was read too much while skipping."""
+    def __init__(self, pcmreader, pending):
+        super(ResumedReader, self).__init__()
+        self.pcmreader = pcmreader
+        self.pending = pending
         
-    def read(self, size=4096, timeout=0.0):
-        """Returns at most a string of size `size`.
+    def read(self, size):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            return pending
+        return self.pcmreader.read(size)
+    
+    def __getattr__(self, key):
+        return getattr(self.pcmreader, key)
+    
+    
+def skip(reader, frames):
+    """Skips the first `frames` PCM frames of `reader`, seeking if the
+    decoder can. Returns the reader to use from then on."""
+    if frames <= 0:
+        return reader
+    if hasattr(reader, 'seek'):
+        try:
+            frames -= reader.seek(frames)
+        except (IOError, ValueError, audiotools.DecodingError):
+            pass # Decode up to it instead, from wherever it stopped.
+    while frames > 0:
+        framelist = reader.read(min(frames, 4096))
+        if not framelist.frames:
+            break
+        if framelist.frames > frames:
+            return ResumedReader(reader, framelist.split(frames)[1])
+        frames -= framelist.frames
+    return reader
+    
+    
+class AudiotoolsDecoder(object):
+    """Decodes with the audiotools library.
+    
+    This opens the filename given and wraps the file in a PCMConverter that
+    turns it into PCM of format `sample_rate`, `channels` and
+    `bits_per_sample` depth. Files that are in that format already are read
+    without converting, `converted` tells which of the two happened. The
+    first `start` seconds are skipped."""
+    name = 'audiotools'
+    def __init__(self, filename, sample_rate=44100, channels=2,
+                 bits_per_sample=16, start=0.0):
+        super(AudiotoolsDecoder, self).__init__()
+        self.converted = False
+        self.file = None
+        self._reader = self._open_file(filename, sample_rate, channels,
+                                       bits_per_sample, start)
         
-        The `timeout` argument is unused. But kept in for compatibility with
-        other read methods in the `audio` module."""
+    def read(self, size=4096):
         return self._reader.read(size).to_bytes(False, True)
     
+    def processes(self):
+        return child_processes(self._reader)
+    
     def close(self):
-        """Registers self for garbage collection. This method does not
-        close anything and only registers itself for colleciton."""
-        GarbageAudioFile(self)
+        self._reader.close()
         
     def __getattr__(self, key):
         try:
@@ -63,7 +125,8 @@ class AudioFile(object):
         """Dummy progress function"""
         pass
 
-    def _open_file(self, filename):
+    def _open_file(self, filename, sample_rate, channels, bits_per_sample,
+                   start=0.0):
         """Open a file for reading and wrap it in several helpers."""
         _, ext = os.path.splitext(filename)
         if ext == '.mp3':
@@ -82,21 +145,190 @@ class AudioFile(object):
 
         
         self.file = reader
-        total_frames = reader.total_frames()
         
         # Wrap in a PCMReader because we want PCM
         reader = reader.to_pcm()
         
+        if start > 0:
+            reader = skip(reader, int(start * self.file.sample_rate()))
+        
+        if (self.file.sample_rate() == sample_rate and
+                self.file.channels() == channels and
+                self.file.bits_per_sample() == bits_per_sample):
+            # Already what we want, the frames can be used as they are.
+            return reader
+        self.converted = True
+        
+        # The index knows the length without scanning the file again.
+        index = library.default()
+        info = index.get(filename) if index is not None else None
+        if info is not None and info.total_frames:
+            total_frames = info.total_frames
+        else:
+            total_frames = self.file.total_frames()
+        
         
         # Wrap in a converter
-        reader = audiotools.PCMConverter(reader, sample_rate=44100,
-                                    channels=2,
+        reader = audiotools.PCMConverter(reader, sample_rate=sample_rate,
+                                    channels=channels,
                                     channel_mask=audiotools.ChannelMask(0x1 | 0x2),
-                                    bits_per_sample=24)
+                                    bits_per_sample=bits_per_sample)
         
         # And for file progress!
         reader = audiotools.PCMReaderProgress(reader, total_frames,
                                               self.progress)
         
         return reader
+    
+    
+class FFmpegDecoder(object):
+    """Decodes by streaming raw PCM out of an ffmpeg process, arguments are
+    those of :class:`AudiotoolsDecoder`.
+    
+    ffmpeg resamples on its own, so `converted` is never set."""
+    name = 'ffmpeg'
+    def __init__(self, filename, sample_rate=44100, channels=2,
+                 bits_per_sample=16, start=0.0):
+        super(FFmpegDecoder, self).__init__()
+        self.converted = False
+        self.frame_size = channels * bits_per_sample // 8
+        arguments = [FFMPEG_BIN, '-v', 'error', '-nostdin']
+        if start > 0:
+            arguments += ['-ss', '{:.6f}'.format(start)]
+        arguments += ['-i', filename,
+                      '-vn', '-f', 's{:d}le'.format(bits_per_sample),
+                      '-ar', str(sample_rate), '-ac', str(channels), '-']
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                self.process = subprocess.Popen(args=arguments,
+                                                stdout=subprocess.PIPE,
+                                                stderr=devnull)
+        except (OSError) as err:
+            raise AudioError("Can't run {:s}: {:s}".format(FFMPEG_BIN,
+                                                            str(err)))
+        # ffmpeg only tells it can't decode the file by exiting early.
+        self._pending = self.read(65536)
+        if not self._pending and self.process.wait() != 0:
+            raise AudioError("Unsupported file: " + filename.encode('utf8'))
+        
+    def read(self, size=4096):
+        size = max(size - size % self.frame_size, self.frame_size)
+        pending = getattr(self, '_pending', None)
+        if pending:
+            data, self._pending = pending[:size], pending[size:]
+            return data
+        return self.process.stdout.read(size)
+    
+    def processes(self):
+        return [self.process]
+    
+    def close(self):
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+    
+    
+BACKENDS = {
+    AudiotoolsDecoder.name: AudiotoolsDecoder,
+    FFmpegDecoder.name: FFmpegDecoder,
+}
+
+
+def backend_names(filename, backends=None):
+    """Returns the names of the backends to try for `filename` in order,
+    the one `backends` maps its extension to first. Extensions are given
+    lowercase with the dot, 'default' is used for the rest."""
+    backends = backends or {}
+    _, ext = os.path.splitext(filename)
+    first = backends.get(ext.lower(), backends.get('default', 'audiotools'))
+    if first not in BACKENDS:
+        logger.warning("Unknown decoder backend %r.", first)
+        first = 'audiotools'
+    return [first] + sorted(name for name in BACKENDS if name != first)
+    
+    
+class AudioFile(object):
+    """A file decoded to PCM of format 44.1kHz, Stereo, `bits_per_sample`
+    depth by one of the backends in :data:`BACKENDS`, see
+    :func:`backend_names` for how `backends` picks it. When that backend
+    can't open the file the others are tried.
+    
+    `converted` tells if the file had to be converted to that format.
+    
+    With `trim` the silence at the start and end of the file is skipped
+    if the track index knows where it is, otherwise it is looked for while
+    reading so it is known the next time."""
+    sample_rate = 44100
+    channels = 2
+    def __init__(self, filename, bits_per_sample=16, trim=False,
+                 backends=None):
+        super(AudioFile, self).__init__()
+        self.bits_per_sample = bits_per_sample
+        # Bytes left before the silence at the end, None if not trimming
+        self.remaining = None
+        self._filename = filename
+        self._detector = None
+        
+        index = library.default()
+        edges = index.edges(filename) if trim and index is not None else None
+        start = 0.0
+        if edges is not None:
+            start, end = edges
+            frame_size = self.channels * self.bits_per_sample // 8
+            self.remaining = (int(round((end - start) * self.sample_rate)) *
+                              frame_size)
+        elif (trim and pcm.available() and index is not None and
+                index.get(filename) is not None):
+            # Edges can only be stored for files that are indexed.
+            self._detector = silence.SilenceDetector(self.sample_rate,
+                                                     self.channels,
+                                                     self.bits_per_sample)
+        
+        self.decoder = self._open_file(filename, backends, start)
+        self.backend = self.decoder.name
+        self.converted = self.decoder.converted
+        for process in self.decoder.processes():
+            garbage.track(process, "decoder for " + repr(filename))
+        
+    def read(self, size=4096, timeout=0.0):
+        """Returns at most a string of size `size`.
+        
+        The `timeout` argument is unused. But kept in for compatibility with
+        other read methods in the `audio` module."""
+        data = self.decoder.read(size)
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        if self._detector is not None:
+            if data:
+                self._detector.feed(data)
+            else:
+                library.default().store_edges(self._filename,
+                                              *self._detector.result())
+                self._detector = None
+        return data
+    
+    def close(self):
+        """Registers self for garbage collection. This method does not
+        close anything and only registers itself for colleciton."""
+        GarbageAudioFile(self)
+        
+    def __getattr__(self, key):
+        if key == 'decoder':
+            raise AttributeError(key)
+        return getattr(self.decoder, key)
 
+    def _open_file(self, filename, backends=None, start=0.0):
+        """Returns a decoder from the first backend that can open the
+        file."""
+        error = None
+        for name in backend_names(filename, backends):
+            try:
+                return BACKENDS[name](filename, self.sample_rate,
+                                      self.channels, self.bits_per_sample,
+                                      start)
+            except (AudioError) as err:
+                logger.debug("Backend %s can't decode %s: %s", name,
+                             filename.encode('utf8'), err)
+                error = error or err
+        raise error
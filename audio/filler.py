@@ -0,0 +1,110 @@
+"""Module that keeps the stream going when the source stalls.
+
+An encoder that gets no PCM from its source for a while asks its
+:class:`Watchdog` for filler, which is silence or a jingle held in memory.
+The filler is handed out at the pace it plays at, so the listeners stay
+connected without a backlog of filler building up in front of the music
+that follows it."""
+import logging
+
+import files
+import metrics
+from pacer import monotonic
+
+
+logger = logging.getLogger('audio.filler')
+
+
+class Filler(object):
+    """Pre-rendered PCM that is played on a loop during an underrun, one
+    second of silence unless `data` is given."""
+    def __init__(self, data=None, sample_rate=44100, channels=2,
+                 bits_per_sample=16):
+        super(Filler, self).__init__()
+        self.byte_rate = sample_rate * channels * bits_per_sample // 8
+        self.frame_size = channels * bits_per_sample // 8
+        self.data = data or b'\x00' * self.byte_rate
+
+    @classmethod
+    def from_file(cls, filename, bits_per_sample=16):
+        """Returns a :class:`Filler` with all of `filename` decoded, or one
+        with silence if it can't be decoded."""
+        try:
+            audiofile = files.AudioFile(filename, bits_per_sample)
+        except files.AudioError:
+            logger.exception("Failed opening filler %r.", filename)
+            return cls(bits_per_sample=bits_per_sample)
+        pieces = []
+        try:
+            while True:
+                data = audiofile.read(65536)
+                if not data:
+                    break
+                pieces.append(data)
+        except ValueError as err:
+            if err.message != 'MD5 mismatch at end of stream':
+                logger.exception("Failed decoding filler %r.", filename)
+                pieces = []
+        finally:
+            audiofile.close()
+        return cls(b''.join(pieces), bits_per_sample=bits_per_sample)
+
+
+class Watchdog(object):
+    """Tells an encoder when to play `filler`, after `deadline` seconds
+    without PCM from its source.
+
+    The encoder calls :meth:`fed` for every write of real PCM and
+    :meth:`fill` when its source had nothing. Every underrun is logged and
+    counted in `metrics` as `underruns`."""
+    deadline = 2.0
+    interval = 0.1 # Seconds an encoder waits for its source before asking
+    lead = 0.5 # Seconds of filler handed out ahead of realtime
+    def __init__(self, filler, deadline=None, metrics=metrics.NULL):
+        super(Watchdog, self).__init__()
+        self.filler = filler
+        if deadline is not None:
+            self.deadline = deadline
+        self.metrics = metrics
+
+        self.last = monotonic()
+        self.offset = 0 # Where we are in the filler
+        self.started = None # When the current underrun started
+        self.due = 0.0 # Until when the filler handed out plays
+        self.underruns = 0
+
+    def fed(self):
+        """Called when real PCM was written, ends an underrun."""
+        now = monotonic()
+        if self.started is not None:
+            logger.info("Underrun ended after %.1f seconds.",
+                        now - self.started)
+            self.metrics.observe('underrun_seconds', now - self.started)
+            self.started = None
+        self.last = now
+
+    def fill(self):
+        """Returns filler to write when our source has been quiet for too
+        long and more is due, otherwise an empty string."""
+        now = monotonic()
+        if now - self.last < self.deadline:
+            return b''
+        if self.started is None:
+            self.started = self.due = now
+            self.underruns += 1
+            logger.warning("No audio for %.1f seconds, playing filler.",
+                           now - self.last)
+            self.metrics.mark('underruns')
+        if self.due > now + self.lead:
+            return b''
+        size = int(self.interval * self.filler.byte_rate)
+        size -= size % self.filler.frame_size
+        data = self.filler.data[self.offset:self.offset + size]
+        self.offset = (self.offset + len(data)) % len(self.filler.data)
+        self.due += float(len(data)) / self.filler.byte_rate
+        self.metrics.mark('filler_bytes', len(data))
+        return data
+
+    def stats(self):
+        return {'underruns': self.underruns,
+                'underrun': self.started is not None}
@@ -1,28 +1,72 @@
 import threading
 import time
+import random
+import collections
 import pylibshout
 import logging
+import mp3
+import metrics
+from pacer import Pacer
 
 
 logger = logging.getLogger('audio.icecast')
 
 class Icecast(object):
-    connecting_timeout = 5.0
-    def __init__(self, source, config):
+    """Sends the MP3 read from `source` to an icecast server.
+    
+    Sending is paced by `pacer`, a :class:`pacer.Pacer`, using the
+    duration of the frames that are sent.
+    
+    While the connection is down we keep reading the source at realtime
+    into a :class:`Backlog` of at most `backlog_max` seconds, which is sent
+    as soon as we are connected again. Reconnecting is done by a thread
+    of its own, so the backlog keeps filling while a connection attempt
+    blocks, and is retried with a jittered exponential backoff between
+    `backoff_min` and `backoff_max` seconds. `metrics` records the send
+    and pacing times."""
+    backoff_min = 0.5
+    backoff_max = 30.0
+    backlog_max = 10.0
+    def __init__(self, source, config, pacer=None, backlog_max=None,
+                 metrics=metrics.NULL):
         super(Icecast, self).__init__()
+        self.metrics = metrics
         self.config = (config if isinstance(config, IcecastConfig)
                        else IcecastConfig(config))
         self.source = source
+        self.pacer = pacer or Pacer()
+        self.frames = mp3.FrameSplitter()
+        self.backlog = Backlog(self.backlog_max if backlog_max is None
+                               else backlog_max)
+        
+        self.emitted = 0.0 # Seconds of audio we went through
+        self.attempts = 0 # Failed connection attempts in a row
+        self.next_attempt = 0.0
+        self.reconnects = 0
+        self.metrics.gauge('backlog', lambda: self.backlog.duration)
         
+        self.lock = threading.Lock() # Guards replacing and closing _shout
+        self.disconnected = threading.Event() # Set by the sending thread
+        self.fresh = False # Connected since the sending thread last looked
+        self._should_run = threading.Event()
         self._shout = self.setup_libshout()
     
-    def connect(self):
-        """Connect the libshout object to the configured server."""
+    def connect(self, shout=None):
+        """Connect the libshout object to the configured server, or
+        `shout` which then replaces it."""
+        shout = self._shout if shout is None else shout
         try:
-            self._shout.open()
+            shout.open()
         except (pylibshout.ShoutException) as err:
             logger.exception("Failed to connect to Icecast server.")
             raise IcecastError("Failed to connect to icecast server.")
+        with self.lock:
+            if self._should_run.is_set() and shout is not self._shout:
+                # Closed while we were connecting.
+                shout.close()
+                raise IcecastError("Closed while connecting.")
+            self._shout = shout
+            self.fresh = True
             
     def connected(self):
         """Returns True if the libshout object is currently connected to
@@ -41,65 +85,135 @@ class Icecast(object):
     def close(self):
         """Closes the libshout object and tries to join the thread if we are
         not calling this from our own thread."""
-        self._should_run.set()
-        try:
-            self._shout.close()
-        except (pylibshout.ShoutException) as err:
-            if err[0] == pylibshout.SHOUTERR_UNCONNECTED:
+        with self.lock:
+            self._should_run.set()
+            try:
+                self._shout.close()
+            except (pylibshout.ShoutException) as err:
+                if err[0] == pylibshout.SHOUTERR_UNCONNECTED:
+                    pass
+                else:
+                    logger.exception("Exception in pylibshout close call.")
+                    raise IcecastError("Exception in pylibshout close.")
+        self.join(5.0)
+        
+    def join(self, timeout):
+        """Waits at most `timeout` seconds for each of our threads, unless
+        it is the calling thread."""
+        for thread in (self._thread, self._reconnector):
+            try:
+                thread.join(timeout)
+            except (RuntimeError) as err:
                 pass
-            else:
-                logger.exception("Exception in pylibshout close call.")
-                raise IcecastError("Exception in pylibshout close.")
-        try:
-            self._thread.join(5.0)
-        except (RuntimeError) as err:
-            pass
         
     def run(self):
         while not self._should_run.is_set():
-            while self.connected():
-                if hasattr(self, '_saved_meta'):
-                    self.set_metadata(self._saved_meta)
-                    del self._saved_meta
-                    
-                buff = self.source.read(4096)
-                if not buff:
-                    # EOF
-                    self.close()
-                    logger.exception("Source EOF, closing ourself.")
-                    break
+            if hasattr(self, '_saved_meta') and self.connected():
+                self.set_metadata(self._saved_meta)
+                del self._saved_meta
+            if self.fresh:
+                # A new connection gets a burst again.
+                self.fresh = False
+                self.pacer.reset()
+                
+            buff = self.source.read(4096)
+            if not buff:
+                # EOF
+                self.close()
+                logger.error("Source EOF, closing ourself.")
+                break
+            buff, duration = self.frames.feed(buff)
+            if not buff:
+                continue # Not a whole frame yet
+            
+            if not self.connected():
+                self.backlog.append(buff, duration)
+                self.disconnected.set()
+            elif self.backlog:
+                self.backlog.append(buff, duration)
+                self.flush_backlog()
+            else:
                 try:
-                    self._shout.send(buff)
-                    self._shout.sync()
+                    with self.metrics.time('send'):
+                        self._shout.send(buff)
                 except (pylibshout.ShoutException) as err:
                     logger.exception("Failed sending stream data.")
-                    self.reboot_libshout()
-                    
-            if not self._should_run.is_set():
-                time.sleep(self.connecting_timeout)
+                    self.metrics.mark('send_errors')
+                    self.backlog.append(buff, duration)
+                    self.disconnected.set()
+            # Paced while disconnected as well, so the backlog is filled at
+            # the speed it would have been sent.
+            self.emitted += duration
+            with self.metrics.time('pace'):
+                self.pacer.wait(duration)
+            
+    def flush_backlog(self):
+        """Sends everything in the backlog, what can't be sent stays in it
+        for the next connection."""
+        while self.backlog:
+            frames, duration = self.backlog.peek()
+            try:
+                with self.metrics.time('send'):
+                    self._shout.send(frames)
+            except (pylibshout.ShoutException) as err:
+                logger.exception("Failed sending backlog.")
+                self.metrics.mark('send_errors')
+                self.disconnected.set()
+                return
+            self.backlog.popleft()
+            
+    def reconnect(self, stop):
+        """Reconnects whenever the sending thread finds the connection
+        down, until `stop` is set. Runs in its own thread."""
+        while not stop.is_set():
+            if not self.disconnected.wait(1.0) or stop.is_set():
+                continue
+            if not self.connected():
                 self.reboot_libshout()
+            if self.connected():
+                self.disconnected.clear()
+            else:
+                stop.wait(max(0.0, self.next_attempt - time.time()))
                 
-    def start(self):
-        """Starts the thread that reads from source and feeds it to icecast."""
-        if not self.connected():
-            self.connect()
+    def start(self, connect=True):
+        """Starts the thread that reads from source and feeds it to icecast.
+        
+        With `connect` False the thread is started without connecting
+        first, it will then try to connect on its own."""
         self._should_run = threading.Event()
+        if connect and not self.connected():
+            self.connect()
+        self.emitted = 0.0
         
         self._thread = threading.Thread(target=self.run)
         self._thread.name = "Icecast"
         self._thread.daemon = True
         self._thread.start()
+        
+        self._reconnector = threading.Thread(target=self.reconnect,
+                                             args=(self._should_run,))
+        self._reconnector.name = "Icecast Reconnector"
+        self._reconnector.daemon = True
+        self._reconnector.start()
             
     def switch_source(self, new_source):
         """Tries to change the source without disconnect from icecast."""
-        self._should_run.set() # Gracefully try to get rid of the thread
-        try:
-            self._thread.join(5.0)
-        except RuntimeError as err:
-            logger.exception("Got called from my own thread.")
+        self._should_run.set() # Gracefully try to get rid of the threads
+        if threading.current_thread() is self._thread:
+            logger.error("Got called from my own thread.")
+        self.join(5.0)
         self.source = new_source # Swap out our source
         self.start() # Start a new thread (so roundabout)
         
+    def played(self):
+        """Returns how many seconds of our source are played by now, what
+        was sent ahead of realtime doesn't count."""
+        return self.emitted - self.pacer.ahead
+        
+    def pacing(self):
+        """Returns the drift and jitter measurements of the pacer."""
+        return self.pacer.stats()
+        
     def set_metadata(self, metadata):
         try:
             self._shout.metadata = {'song': metadata} # Stupid library
@@ -119,18 +233,72 @@ class Icecast(object):
     def reboot_libshout(self):
         """Internal method
         
-        Tries to recreate the libshout object.
+        Tries to recreate the libshout object and connect it, if that fails
+        the next attempt is scheduled with :meth:`backoff`. The new object
+        only replaces the old one once it is connected.
         """
         try:
-            self._shout = self.setup_libshout()
+            shout = self.setup_libshout()
         except (IcecastError) as err:
             logger.exception("Configuration failed.")
             self.close()
+            return
         try:
-            self.connect()
+            self.connect(shout)
         except (IcecastError) as err:
             logger.exception("Connection failure.")
+            self.metrics.mark('connect_failures')
+            self.next_attempt = time.time() + self.backoff()
+            self.attempts += 1
+        else:
+            self.attempts = 0
+            self.reconnects += 1
+            self.metrics.mark('reconnects')
+            
+    def backoff(self):
+        """Returns the seconds to wait before the next connection attempt,
+        doubling for every failed attempt with the upper half jittered so
+        several outputs don't retry in lockstep."""
+        delay = min(self.backoff_max,
+                    self.backoff_min * 2 ** min(self.attempts, 16))
+        return delay / 2 + random.uniform(0, delay / 2)
+        
+    def stats(self):
+        """Returns a dict with the reconnect and backlog statistics."""
+        return {'connected': self.connected(), 'attempts': self.attempts,
+                'reconnects': self.reconnects,
+                'backlog': self.backlog.duration,
+                'backlog_dropped': self.backlog.dropped}
+            
+class Backlog(object):
+    """Encoded frames that could not be sent yet, the oldest are dropped
+    when there is more than `max_age` seconds of audio in it."""
+    def __init__(self, max_age):
+        super(Backlog, self).__init__()
+        self.max_age = max_age
+        self.chunks = collections.deque()
+        self.duration = 0.0
+        self.dropped = 0.0 # Seconds of audio trimmed off
+        
+    def append(self, frames, duration):
+        self.chunks.append((frames, duration))
+        self.duration += duration
+        while self.duration > self.max_age and self.chunks:
+            _, old = self.chunks.popleft()
+            self.duration -= old
+            self.dropped += old
             
+    def peek(self):
+        return self.chunks[0]
+        
+    def popleft(self):
+        frames, duration = self.chunks.popleft()
+        self.duration = self.duration - duration if self.chunks else 0.0
+        return frames, duration
+        
+    def __len__(self):
+        return len(self.chunks)
+        
 class IcecastConfig(dict):
     """Simple dict subclass that knows how to apply the keys to a
     libshout object.
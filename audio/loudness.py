@@ -0,0 +1,234 @@
+"""Module that measures the loudness of tracks and evens it out.
+
+The analysis follows EBU R128 / ITU-R BS.1770: K-weighted mean square over
+400ms blocks with 75% overlap, gated at -70 LUFS and 10 LU below the
+ungated loudness. The K-weighting is applied in the frequency domain on
+100ms sub-blocks, four of which make up a block, so all of it is done in
+bulk NumPy operations. Results are stored in the track index together with
+the silence edges of :mod:`audio.silence`, run this module to analyze
+everything in it that wasn't yet:
+
+    python -m audio.loudness
+"""
+import math
+import logging
+import multiprocessing
+
+import pcm
+from pcm import numpy
+import files
+import silence
+import library
+
+
+logger = logging.getLogger('audio.loudness')
+
+
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+
+def k_weighting(sample_rate, size):
+    """Returns the squared magnitude response of the K-weighting filter at
+    the frequencies of a real FFT of `size` samples."""
+    # Both stages as given by BS.1770, recalculated for `sample_rate`.
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20.0)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf_b = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0,
+               (vh - vb * k / q + k * k) / a0]
+    shelf_a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass_b = [1.0, -2.0, 1.0]
+    highpass_a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    z = numpy.exp(-1j * numpy.pi * numpy.arange(size // 2 + 1) * 2.0 / size)
+    def response(b, a):
+        return ((b[0] + b[1] * z + b[2] * z * z) /
+                (a[0] + a[1] * z + a[2] * z * z))
+    return numpy.abs(response(shelf_b, shelf_a) *
+                     response(highpass_b, highpass_a)) ** 2
+
+
+class LoudnessMeter(object):
+    """Measures the integrated loudness and sample peak of the PCM given
+    to :meth:`feed`."""
+    def __init__(self, sample_rate=44100, channels=2):
+        super(LoudnessMeter, self).__init__()
+        self.channels = channels
+        self.size = sample_rate // 10 # Samples per 100ms sub-block
+        self.weights = k_weighting(sample_rate, self.size)
+        # Parseval for a real FFT, everything but DC and Nyquist twice.
+        self.weights[1:-1 if self.size % 2 == 0 else None] *= 2
+        self.weights /= float(self.size) ** 2
+
+        self.pending = numpy.zeros((0, channels))
+        self.powers = [] # Mean square of every sub-block
+        self.peak = 0.0
+
+    def feed(self, data):
+        """Adds 24-bit interleaved PCM."""
+        samples = pcm.to_samples(data) / pcm.FULL_SCALE
+        if len(samples):
+            self.peak = max(self.peak, float(numpy.abs(samples).max()))
+        frames = numpy.concatenate([self.pending,
+                                    samples.reshape(-1, self.channels)])
+        whole = len(frames) // self.size * self.size
+        self.pending = frames[whole:]
+        if not whole:
+            return
+        blocks = frames[:whole].reshape(-1, self.size, self.channels)
+        spectrum = numpy.abs(numpy.fft.rfft(blocks, axis=1)) ** 2
+        power = (spectrum * self.weights[:, None]).sum(axis=1)
+        # Left and right count equally, summed over channels.
+        self.powers.append(power.sum(axis=1))
+
+    def result(self):
+        """Returns a tuple of (integrated loudness in LUFS, sample peak),
+        the loudness is None when everything is below the absolute gate."""
+        if not self.powers:
+            return None, self.peak
+        powers = numpy.concatenate(self.powers)
+        if len(powers) < 4:
+            blocks = powers[None, :].mean(axis=1)
+        else:
+            # Every 400ms block is four sub-blocks, stepping one at a time.
+            window = numpy.cumsum(numpy.concatenate([[0.0], powers]))
+            blocks = (window[4:] - window[:-4]) / 4.0
+        def loudness(power):
+            return -0.691 + 10 * numpy.log10(numpy.maximum(power, 1e-20))
+        blocks = blocks[loudness(blocks) > ABSOLUTE_GATE]
+        if not len(blocks):
+            return None, self.peak
+        gate = loudness(blocks.mean()) + RELATIVE_GATE
+        blocks = blocks[loudness(blocks) > gate]
+        return float(loudness(blocks.mean())), self.peak
+
+
+def analyze(filename):
+    """Decodes `filename` and returns a tuple of (filename, loudness,
+    peak, silence edges), the edges are None if it failed."""
+    try:
+        audiofile = files.AudioFile(filename, 24)
+    except files.AudioError:
+        logger.exception("Failed opening %r.", filename)
+        return filename, None, None, None
+    meter = LoudnessMeter(audiofile.sample_rate, audiofile.channels)
+    detector = silence.SilenceDetector(audiofile.sample_rate,
+                                       audiofile.channels)
+    try:
+        while True:
+            data = audiofile.read(65536)
+            if not data:
+                break
+            meter.feed(data)
+            detector.feed(data)
+    except ValueError as err:
+        if err.message != 'MD5 mismatch at end of stream':
+            logger.exception("Failed decoding %r.", filename)
+            return filename, None, None, None
+    finally:
+        audiofile.close()
+    loudness, peak = meter.result()
+    return filename, loudness, peak, detector.result()
+
+
+def analyze_index(index, processes=None):
+    """Analyzes every file in `index` that has no loudness yet with a pool
+    of `processes` processes. Returns the amount analyzed."""
+    filenames = index.unanalyzed()
+    if not filenames:
+        return 0
+    pool = multiprocessing.Pool(processes)
+    analyzed = 0
+    try:
+        for filename, loudness, peak, edges in pool.imap_unordered(
+                analyze, filenames):
+            if edges is None:
+                continue
+            # Silent files have no loudness, but do have edges.
+            index.store_loudness(filename, loudness, peak)
+            index.store_edges(filename, *edges)
+            analyzed += 1
+    finally:
+        pool.close()
+        pool.join()
+    return analyzed
+
+
+def track_gain(loudness, peak, target, ceiling=-1.0):
+    """Returns the linear gain that brings a track of `loudness` to
+    `target` LUFS, limited so its `peak` stays below `ceiling` dBFS."""
+    gain = 10 ** ((target - loudness) / 20.0)
+    if peak:
+        gain = min(gain, 10 ** (ceiling / 20.0) / peak)
+    return gain
+
+
+def apply_gain(data, gain, bits_per_sample=16):
+    """Returns the PCM in `data` multiplied by `gain` as one array
+    operation, samples that would still clip are clipped. Bytes after the
+    last whole sample are returned as they are."""
+    if gain is None or gain == 1.0 or not data or numpy is None:
+        return data
+    whole = len(data) - len(data) % pcm.sample_size(bits_per_sample)
+    if whole < len(data):
+        logger.debug("Not applying gain to %d bytes of a partial sample.",
+                     len(data) - whole)
+    if not whole:
+        return data
+    return pcm.to_pcm(pcm.to_samples(data[:whole], bits_per_sample) * gain,
+                      bits_per_sample) + data[whole:]
+
+
+class GainStage(object):
+    """Applies the `gain` attribute of the file that is playing to the PCM
+    read from `source`, an :class:`audio.UnendingSource`. Reads are
+    returned in whole samples, the rest is kept for the next read."""
+    def __init__(self, source, bits_per_sample=16):
+        super(GainStage, self).__init__()
+        self.source = source
+        self.bits_per_sample = bits_per_sample
+        self.remainder = b''
+        if not pcm.available():
+            logger.warning("NumPy is not available, not applying gain.")
+
+    def read(self, size=4096, timeout=10.0):
+        sample_size = pcm.sample_size(self.bits_per_sample)
+        while True:
+            data = self.source.read(size, timeout)
+            if not data:
+                # Nothing is coming to complete the sample with.
+                data, self.remainder = self.remainder, b''
+                return data
+            data = self.remainder + data
+            whole = len(data) - len(data) % sample_size
+            data, self.remainder = data[:whole], data[whole:]
+            if data:
+                break
+        # The source returns data of a single file per read, and is
+        # switched to that file by the time it returns.
+        return apply_gain(data, getattr(self.source, 'gain', None),
+                          self.bits_per_sample)
+
+    def __getattr__(self, key):
+        return getattr(self.source, key)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    index = library.default()
+    if index is None:
+        raise SystemExit("config.track_index is not set.")
+    if numpy is None:
+        raise SystemExit("NumPy is required for loudness analysis.")
+    logger.info("Analyzed %d file(s).", analyze_index(index))
+
+
+if __name__ == '__main__':
+    main()
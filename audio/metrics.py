@@ -0,0 +1,196 @@
+"""Module with counters and histograms of the audio pipeline.
+
+Every stage times the calls it makes into the stage next to it, a
+snapshot of all of them tells where the time goes when the stream
+stutters. A disabled :class:`NullMetrics` is used by default, its methods
+do nothing."""
+import bisect
+import collections
+import threading
+
+from pacer import monotonic
+
+
+class Histogram(object):
+    """Counts observed values, mostly durations in seconds, in buckets
+    that double in size from `smallest` up."""
+    smallest = 0.00001
+    buckets = 25
+    def __init__(self):
+        super(Histogram, self).__init__()
+        self.edges = [self.smallest * 2 ** i for i in xrange(self.buckets)]
+        self.counts = [0] * (self.buckets + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.edges, value)] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """Returns the upper edge of the bucket that holds quantile `q`,
+        call with the lock held."""
+        wanted, seen = q * self.count, 0
+        for edge, count in zip(self.edges, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(edge, self.max)
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            if not self.count:
+                return {'count': 0}
+            return {'count': self.count, 'total': self.total,
+                    'mean': self.total / self.count,
+                    'min': self.min, 'max': self.max,
+                    'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                    'p99': self.quantile(0.99)}
+
+
+class Meter(object):
+    """Counts an amount, like bytes, and its rate per second over the last
+    `window` seconds."""
+    window = 10
+    def __init__(self):
+        super(Meter, self).__init__()
+        self.total = 0
+        self.seconds = collections.deque()
+        self.lock = threading.Lock()
+
+    def mark(self, amount=1):
+        second = int(monotonic())
+        with self.lock:
+            self.total += amount
+            if self.seconds and self.seconds[-1][0] == second:
+                self.seconds[-1][1] += amount
+            else:
+                self.seconds.append([second, amount])
+                while self.seconds[0][0] <= second - self.window:
+                    self.seconds.popleft()
+
+    def snapshot(self):
+        start = int(monotonic()) - self.window
+        with self.lock:
+            recent = sum(amount for second, amount in self.seconds
+                         if second > start)
+            return {'total': self.total,
+                    'rate': float(recent) / self.window}
+
+
+class Timer(object):
+    """Context manager that observes how long its block took."""
+    def __init__(self, histogram):
+        super(Timer, self).__init__()
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(monotonic() - self.start)
+
+
+class Metrics(object):
+    """A named collection of histograms, meters and gauges.
+
+    Names are dotted, :meth:`scope` returns a view that prefixes all names
+    and shares the collection, so several outputs can be told apart."""
+    enabled = True
+    def __init__(self, prefix='', store=None):
+        super(Metrics, self).__init__()
+        self.prefix = prefix
+        self.store = store if store is not None else {}
+        self.lock = threading.Lock()
+
+    def scope(self, name):
+        """Returns a view of us with all names prefixed by `name`."""
+        view = Metrics(self.prefix + name + '.', self.store)
+        view.lock = self.lock
+        return view
+
+    def get(self, name, kind):
+        """Returns the `kind` registered as `name`, created if needed."""
+        name = self.prefix + name
+        try:
+            return self.store[name]
+        except KeyError:
+            with self.lock:
+                return self.store.setdefault(name, kind())
+
+    def time(self, name):
+        """Returns a context manager that times its block into the
+        histogram `name`."""
+        return Timer(self.get(name, Histogram))
+
+    def observe(self, name, value):
+        self.get(name, Histogram).observe(value)
+
+    def mark(self, name, amount=1):
+        self.get(name, Meter).mark(amount)
+
+    def gauge(self, name, function):
+        """Registers `function` to be called for the value of `name` when
+        a snapshot is taken."""
+        with self.lock:
+            self.store[self.prefix + name] = function
+
+    def snapshot(self):
+        """Returns a dict of all names and their current values."""
+        with self.lock:
+            items = self.store.items()
+        result = {}
+        for name, item in items:
+            if not name.startswith(self.prefix):
+                continue
+            try:
+                value = (item.snapshot() if hasattr(item, 'snapshot')
+                         else item())
+            except Exception as err:
+                value = repr(err)
+            result[name] = value
+        return result
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class NullMetrics(Metrics):
+    """Metrics that are thrown away."""
+    enabled = False
+    timer = NullTimer()
+    def scope(self, name):
+        return self
+
+    def time(self, name):
+        return self.timer
+
+    def observe(self, name, value):
+        pass
+
+    def mark(self, name, amount=1):
+        pass
+
+    def gauge(self, name, function):
+        pass
+
+    def snapshot(self):
+        return {}
+
+
+NULL = NullMetrics()
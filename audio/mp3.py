@@ -0,0 +1,141 @@
+"""Module that splits MP3 streams into frames.
+
+This is used to send MP3 files that are already in the format we stream
+in as they are, without decoding and encoding them again. The frame
+headers are parsed by :mod:`library.mp3`."""
+import os
+import threading
+import logging
+
+from library.mp3 import MONO, parse_header, id3v2_size, is_info_frame
+
+
+logger = logging.getLogger('audio.mp3')
+
+
+class FrameSplitter(object):
+    """Splits an MP3 byte stream that comes in arbitrary pieces into whole
+    frames, and tells how much audio time they contain.
+
+    Bytes that aren't part of a frame are dropped, the amount is kept in
+    `skipped`."""
+    def __init__(self):
+        super(FrameSplitter, self).__init__()
+        self.pending = b''
+        self.skipped = 0
+
+    def feed(self, data):
+        """Returns a tuple of (frames, duration) for all whole frames that
+        are complete with `data` added. Incomplete frames are kept until
+        the next call."""
+        data = self.pending + data
+        offset, start, parts, duration = 0, 0, [], 0.0
+        while len(data) - offset >= 4:
+            header = parse_header(data[offset:offset + 4])
+            if header is None:
+                # Lost sync, look for the next possible frame start.
+                if offset > start:
+                    parts.append(data[start:offset])
+                resync = data.find('\xFF', offset + 1)
+                if resync == -1:
+                    resync = len(data)
+                self.skipped += resync - offset
+                offset = start = resync
+                continue
+            if offset + header.length > len(data):
+                break
+            offset += header.length
+            duration += float(header.samples) / header.sample_rate
+        if offset > start:
+            parts.append(data[start:offset])
+        self.pending = data[offset:]
+        return b''.join(parts), duration
+
+
+class PassthroughFile(object):
+    """An MP3 file that is sent as is instead of being decoded.
+
+    Opening scans all frame headers, :class:`mp3.PassthroughError` is
+    raised when the file doesn't consist of frames in the format given.
+    A `bitrate` of None accepts any bitrate. Reading returns the raw frame
+    data without tags."""
+    passthrough = True
+    def __init__(self, filename, bitrate, sample_rate):
+        super(PassthroughFile, self).__init__()
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        try:
+            self.start, self.end, self.frames = self.scan(bitrate,
+                                                          sample_rate)
+        except:
+            self.file.close()
+            raise
+        self.file.seek(self.start)
+        self.position = self.start
+
+        self.sample_rate = sample_rate
+        self.samples = self.frames * 1152
+
+        # Set by the encoder when it starts and stops sending us.
+        self.started = threading.Event()
+        self.finished = threading.Event()
+
+    def scan(self, bitrate, sample_rate):
+        """Walks the frame headers and returns the start and end offset
+        of the audio frames and the amount of frames."""
+        self.file.seek(0)
+        start = id3v2_size(self.file.read(10))
+        self.file.seek(start)
+        frame = self.file.read(1024)
+        header = parse_header(frame)
+        if header is None:
+            raise PassthroughError("No frame header at start of file.")
+        if is_info_frame(frame, header):
+            start += header.length
+
+        offset, frames, length = start, 0, 0
+        while True:
+            self.file.seek(offset)
+            header = parse_header(self.file.read(4))
+            if header is None:
+                # Trailing tags or garbage, we stop here.
+                break
+            if (header.version != 1 or header.sample_rate != sample_rate or
+                    bitrate not in (None, header.bitrate) or
+                    header.channel_mode == MONO):
+                raise PassthroughError("Frame {:d} is not {!s}kbps {:d}Hz "
+                                       "stereo.".format(frames, bitrate,
+                                                        sample_rate))
+            length = header.length
+            offset += length
+            frames += 1
+        # The last frame might be truncated, in which case we drop it.
+        if offset > os.fstat(self.file.fileno()).st_size:
+            offset -= length
+            frames -= 1
+        if frames <= 0:
+            raise PassthroughError("File contains no audio frames.")
+        return start, offset, frames
+
+    @property
+    def length(self):
+        """Length in seconds."""
+        return float(self.samples) / self.sample_rate
+
+    def read(self, size=4096, timeout=0.0):
+        """Returns at most `size` bytes of frame data, an empty string
+        once all frames are read."""
+        size = min(size, self.end - self.position)
+        if size <= 0:
+            return b''
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class PassthroughError(Exception):
+    """Raised when a file can't be sent without encoding."""
+    pass
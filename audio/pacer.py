@@ -0,0 +1,99 @@
+"""Module that paces sending audio to realtime.
+
+It uses the duration of the MP3 frames that are sent and a monotonic
+clock, instead of leaving the timing to libshout."""
+import time
+import logging
+
+
+logger = logging.getLogger('audio.pacer')
+
+
+def _monotonic_clock():
+    """Returns a function that reads CLOCK_MONOTONIC, or time.time if we
+    can't get at it."""
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        library = ctypes.CDLL(ctypes.util.find_library('rt') or
+                              ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = library.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            spec = timespec()
+            if clock_gettime(1, ctypes.byref(spec)) != 0: # CLOCK_MONOTONIC
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError, TypeError):
+        logger.warning("No monotonic clock available, using time.time.")
+        return time.time
+
+monotonic = getattr(time, 'monotonic', None) or _monotonic_clock()
+
+
+class Pacer(object):
+    """Keeps the amount of audio sent `burst` seconds ahead of realtime.
+
+    Call :meth:`reset` when a connection is made, the first `burst`
+    seconds are then sent without waiting. After that :meth:`wait` sleeps
+    until the audio sent so far is due. If we fall more than `max_lag`
+    seconds behind, because the source stalled, the clock is reset instead
+    of bursting everything out to catch up."""
+    burst = 2.0
+    max_lag = 5.0
+    def __init__(self, burst=None, max_lag=None):
+        super(Pacer, self).__init__()
+        if burst is not None:
+            self.burst = burst
+        if max_lag is not None:
+            self.max_lag = max_lag
+        self.lag_resets = 0 # Times we fell too far behind
+        self.reset()
+
+    def reset(self):
+        """Starts over, like a fresh connection."""
+        self.start = monotonic()
+        self.sent = 0.0
+        self.jitter = 0.0 # Moving average of how late we woke up
+        self.max_jitter = 0.0
+
+    def wait(self, duration):
+        """Accounts for `duration` seconds of audio that was just sent and
+        sleeps until more may be sent."""
+        self.sent += duration
+        due = self.start + self.sent - self.burst
+        now = monotonic()
+        if due > now:
+            time.sleep(due - now)
+            late = monotonic() - due
+            self.jitter += (late - self.jitter) / 16.0
+            self.max_jitter = max(self.max_jitter, late)
+        elif now - due > self.max_lag:
+            logger.warning("Fell %.1f seconds behind, resetting pacing.",
+                           now - due)
+            self.reset()
+            self.lag_resets += 1
+
+    @property
+    def ahead(self):
+        """How many seconds of the audio sent isn't due yet."""
+        return max(self.sent - (monotonic() - self.start), 0.0)
+
+    @property
+    def drift(self):
+        """How many seconds we are ahead of where we want to be, negative
+        means we fell behind."""
+        return (self.sent - (monotonic() - self.start)) - self.burst
+
+    def stats(self):
+        """Returns a dict of the pacing measurements."""
+        return {'sent': self.sent, 'drift': self.drift,
+                'jitter': self.jitter, 'max_jitter': self.max_jitter,
+                'lag_resets': self.lag_resets, 'burst': self.burst}
@@ -0,0 +1,55 @@
+"""Module with NumPy helpers for the 16 or 24-bit interleaved PCM that
+flows between the source and the encoder.
+
+NumPy is optional, :data:`numpy` is None without it and the stages that
+need it pass the audio through untouched."""
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger('audio.pcm')
+
+
+SAMPLE_SIZE = 3 # Bytes per 24-bit sample
+FULL_SCALE = float(2 ** 23)
+MINIMUM = -2 ** 23
+MAXIMUM = 2 ** 23 - 1
+
+
+def available():
+    """Returns True if NumPy could be imported."""
+    return numpy is not None
+
+
+def sample_size(bits_per_sample):
+    """Returns the amount of bytes per sample."""
+    return bits_per_sample // 8
+
+
+def to_samples(data, bits_per_sample=24):
+    """Returns the little endian samples in `data` as an int32 array.
+    `data` has to be a whole number of samples."""
+    if bits_per_sample == 16:
+        return numpy.frombuffer(data, dtype='<i2').astype(numpy.int32)
+    raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, SAMPLE_SIZE)
+    # Put every sample in the top three bytes of an int32, the arithmetic
+    # shift then takes care of the sign.
+    padded = numpy.zeros((len(raw), 4), dtype=numpy.uint8)
+    padded[:, 1:] = raw
+    return padded.view('<i4').reshape(-1) >> 8
+
+
+def to_pcm(samples, bits_per_sample=24):
+    """Returns `samples`, any numeric array, as little endian PCM. Values
+    are rounded and clipped to the range of `bits_per_sample`."""
+    if samples.dtype.kind == 'f':
+        samples = numpy.rint(samples)
+    if bits_per_sample == 16:
+        return numpy.clip(samples, -2 ** 15, 2 ** 15 - 1).astype(
+            '<i2').tobytes()
+    clipped = numpy.clip(samples, MINIMUM, MAXIMUM).astype('<i4')
+    return clipped.view(numpy.uint8).reshape(-1, 4)[:, :SAMPLE_SIZE].tobytes()
@@ -0,0 +1,94 @@
+"""Module that tells when tracks are actually heard.
+
+A track is handed to the encoder well before anyone hears it, it waits in
+the lookahead, the buffer, the encoder and is sent ahead of realtime by
+the pacer. :class:`Playout` follows the PCM position a track started at
+through the encoder to what icecast sent and calls back once its first
+frame is due, and knows how far into the current track we are."""
+import time
+import threading
+import collections
+import logging
+
+
+logger = logging.getLogger('audio.playout')
+
+
+class Playout(object):
+    """Follows tracks from the source through `encoder` and `icecast` and
+    calls `started` with the track and the time it started playing at.
+
+    The position is as accurate as the MP3 frames icecast is paced with,
+    listeners that are buffering are behind that."""
+    interval = 0.05
+    # Seconds an MP3 decoder lags behind the frames it gets, the delay of
+    # the encoder instances is part of the stream seconds already.
+    decoder_delay = 529 / 44100.0
+    def __init__(self, encoder, icecast, started=lambda item, when: None):
+        super(Playout, self).__init__()
+        self.encoder = encoder
+        self.icecast = icecast
+        self.started = started
+
+        # (PCM position, item, duration) of tracks that aren't playing yet
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.current = None # (stream seconds, item) of the playing track
+        self.closed = threading.Event()
+
+    def start(self):
+        self.closed.clear()
+        with self.lock:
+            self.pending.clear()
+            self.current = None
+        self.thread = threading.Thread(target=self.run, name="Playout")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def track(self, position, item, duration=0.0):
+        """Called when the source starts `item` at PCM byte `position`.
+        Passthrough sources are encoded after their position, their
+        `duration` in seconds has to be given."""
+        with self.lock:
+            self.pending.append((position, item, duration))
+
+    def run(self):
+        while not self.closed.wait(self.interval):
+            try:
+                self.check()
+            except:
+                logger.exception("Failed checking the playout position.")
+
+    def check(self):
+        """Calls `started` for the tracks that started playing by now."""
+        played = self.icecast.played()
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                position, item, duration = self.pending[0]
+                start = self.encoder.stream_seconds(position)
+                if start is None:
+                    return
+                if duration:
+                    # The instance after a passthrough source starts
+                    # with its own delay.
+                    start -= duration + self.encoder.delay_seconds()
+                start += self.decoder_delay
+                if start > played:
+                    return
+                self.pending.popleft()
+                self.current = (start, item)
+            self.started(item, time.time() - (played - start))
+
+    def position(self):
+        """Returns (item, seconds) of the track that is playing, or None
+        if nothing started yet."""
+        with self.lock:
+            if self.current is None:
+                return None
+            start, item = self.current
+        return item, max(self.icecast.played() - start, 0.0)
+
+    def close(self):
+        self.closed.set()
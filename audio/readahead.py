@@ -0,0 +1,148 @@
+"""Module that warms upcoming files into the page cache.
+
+On slow or networked storage the first read of a new file can stall for
+long enough to starve the encoders. :class:`Readahead` asks for the files
+that are going to be played next and has the kernel read them ahead of
+time, with posix_fadvise where we have it and plain sequential reads
+otherwise."""
+import os
+import threading
+import collections
+import logging
+
+
+logger = logging.getLogger('audio.readahead')
+
+
+POSIX_FADV_WILLNEED = 3
+
+
+def _fadvise_function():
+    """Returns posix_fadvise from the C library, or None if we can't get
+    at it."""
+    advise = getattr(os, 'posix_fadvise', None)
+    if advise is not None:
+        return advise
+    try:
+        import ctypes
+        import ctypes.util
+
+        library = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = library.posix_fadvise
+        function.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                             ctypes.c_longlong, ctypes.c_int]
+
+        def posix_fadvise(fd, offset, length, advice):
+            error = function(fd, offset, length, advice)
+            if error:
+                raise OSError(error, os.strerror(error))
+        return posix_fadvise
+    except (ImportError, OSError, AttributeError, TypeError):
+        return None
+
+posix_fadvise = _fadvise_function()
+
+
+class Readahead(object):
+    """Warms the first `count` filenames returned by `upcoming_function`
+    into the page cache, at most `budget` bytes of them.
+
+    The list is fetched on a background thread whenever :meth:`poke` is
+    called and every `interval` seconds. With `sequential` or without
+    posix_fadvise files are read through in `chunk_size` pieces instead."""
+    count = 3
+    budget = 256 * 1024 ** 2
+    interval = 30.0
+    chunk_size = 1024 ** 2
+    def __init__(self, upcoming_function, count=None, budget=None,
+                 sequential=False):
+        super(Readahead, self).__init__()
+        self.upcoming_function = upcoming_function
+        if count is not None:
+            self.count = count
+        if budget is not None:
+            self.budget = budget
+        self.sequential = sequential or posix_fadvise is None
+
+        # Files we warmed and their size, oldest first
+        self.warmed = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = threading.Event()
+        self.failures = 0
+
+    def start(self):
+        self.closed.clear()
+        self.thread = threading.Thread(target=self.run,
+                                       name="Readahead")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.closed.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.closed.is_set():
+                break
+            try:
+                filenames = list(self.upcoming_function())[:self.count]
+            except Exception:
+                logger.exception("Failed getting the upcoming files.")
+                continue
+            for filename in filenames:
+                if self.closed.is_set():
+                    break
+                self.warm(filename, filenames)
+
+    def poke(self):
+        """Has the upcoming files looked at again, call this when one of
+        them started playing."""
+        self.wakeup.set()
+
+    def is_warm(self, filename):
+        with self.lock:
+            return filename in self.warmed
+
+    def warm(self, filename, upcoming=()):
+        """Warms `filename` if it fits the budget, files we warmed before
+        that aren't in `upcoming` are given up to make room."""
+        with self.lock:
+            if filename in self.warmed:
+                return
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            self.failures += 1
+            return
+        with self.lock:
+            for old in list(self.warmed):
+                if sum(self.warmed.values()) + size <= self.budget:
+                    break
+                if old not in upcoming:
+                    del self.warmed[old]
+            if sum(self.warmed.values()) + size > self.budget:
+                logger.debug("Not warming %r, over budget.", filename)
+                return
+        try:
+            with open(filename, 'rb') as f:
+                if self.sequential:
+                    while f.read(self.chunk_size) and not self.closed.is_set():
+                        pass
+                else:
+                    posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+        except (IOError, OSError):
+            logger.exception("Failed warming %r.", filename)
+            self.failures += 1
+            return
+        with self.lock:
+            self.warmed[filename] = size
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.warmed),
+                    'bytes': sum(self.warmed.values()),
+                    'failures': self.failures}
+
+    def close(self):
+        self.closed.set()
+        self.wakeup.set()
@@ -0,0 +1,581 @@
+"""Module that serves the encoded stream to listeners over HTTP.
+
+The :class:`Relay` writes the stream into a ring in shared memory, worker
+processes that each bind the listening port with SO_REUSEPORT serve the
+listeners from that ring with an asyncore loop of their own. The stream is
+kept once for all of them, every listener is handed what it is missing
+straight from the ring.
+
+Listeners that ask for it get ICY metadata interleaved, and every new
+listener gets a burst of what was sent last so the player starts at once.
+The amount of listeners is kept per worker in the shared memory as well,
+see :meth:`Relay.listeners`. The workers are new interpreters like those
+of :mod:`audio.workers`, the ring is handed to them as a descriptor.
+
+The stream comes from a reader of a :class:`tee.Tee` or, to run the relay
+on its own, from a mount of another server:
+
+    python -m audio.relay http://localhost:8000/main.mp3 8080 /main.mp3
+"""
+import os
+import sys
+import mmap
+import time
+import errno
+import struct
+import socket
+import signal
+import urlparse
+import asyncore
+import threading
+import multiprocessing
+import _multiprocessing
+import logging
+
+import workers
+import garbage
+
+
+logger = logging.getLogger('audio.relay')
+
+
+# SO_REUSEPORT is missing from the socket module of Python 2.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+POSITION = struct.Struct('<Q')     # Bytes written
+GENERATION = struct.Struct('<I')   # Odd while the metadata is written
+METADATA = struct.Struct('<H')     # Length of the metadata that follows
+COUNT = struct.Struct('<I')        # Listeners of a worker
+GENERATION_OFFSET = POSITION.size
+METADATA_OFFSET = GENERATION_OFFSET + GENERATION.size
+METADATA_SIZE = 4000
+COUNTS_OFFSET = 4096
+DATA_OFFSET = 8192
+MAX_WORKERS = (DATA_OFFSET - COUNTS_OFFSET) // COUNT.size
+
+
+class Ring(object):
+    """The stream and its metadata in shared memory, written by one
+    process and read by many. Workers map the ring of their parent from
+    the descriptor `fileno`."""
+    def __init__(self, capacity, fileno=None):
+        super(Ring, self).__init__()
+        self.capacity = capacity
+        self.file = None
+        if fileno is None:
+            self.file, self.memory = workers.shared_memory(DATA_OFFSET +
+                                                           capacity)
+        else:
+            self.memory = mmap.mmap(fileno, DATA_OFFSET + capacity)
+
+    @property
+    def position(self):
+        return POSITION.unpack_from(self.memory, 0)[0]
+
+    def write(self, data):
+        position = self.position
+        data = data[-self.capacity:]
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        start = DATA_OFFSET + offset
+        self.memory[start:start + first] = data[:first]
+        if first < len(data):
+            rest = len(data) - first
+            self.memory[DATA_OFFSET:DATA_OFFSET + rest] = data[first:]
+        # Readers only look at what is before the position.
+        POSITION.pack_into(self.memory, 0, position + len(data))
+
+    def read(self, position, size):
+        """Returns (position, data) of at most `size` bytes from
+        `position`, skipped ahead if that was overwritten already."""
+        end = self.position
+        position = max(position, end - self.capacity)
+        size = min(size, end - position)
+        if size <= 0:
+            return position, b''
+        offset = position % self.capacity
+        first = min(size, self.capacity - offset)
+        start = DATA_OFFSET + offset
+        data = self.memory[start:start + first]
+        if first < size:
+            data += self.memory[DATA_OFFSET:DATA_OFFSET + size - first]
+        # The writer can have passed us while we were copying.
+        overwritten = self.position - self.capacity - position
+        if overwritten > 0:
+            return position + overwritten, data[overwritten:]
+        return position, data
+
+    def generation(self):
+        return GENERATION.unpack_from(self.memory, GENERATION_OFFSET)[0]
+
+    def set_metadata(self, metadata):
+        metadata = metadata.encode('utf8', 'replace')[:METADATA_SIZE]
+        generation = self.generation()
+        GENERATION.pack_into(self.memory, GENERATION_OFFSET, generation + 1)
+        METADATA.pack_into(self.memory, METADATA_OFFSET, len(metadata))
+        start = METADATA_OFFSET + METADATA.size
+        self.memory[start:start + len(metadata)] = metadata
+        GENERATION.pack_into(self.memory, GENERATION_OFFSET, generation + 2)
+
+    def metadata(self):
+        """Returns the metadata as bytes."""
+        while True:
+            generation = self.generation()
+            length = METADATA.unpack_from(self.memory, METADATA_OFFSET)[0]
+            start = METADATA_OFFSET + METADATA.size
+            metadata = self.memory[start:start + length]
+            # Try again if it was being written while we read it.
+            if generation % 2 == 0 and generation == self.generation():
+                return metadata
+            time.sleep(0.001)
+
+    def set_count(self, worker, count):
+        COUNT.pack_into(self.memory, COUNTS_OFFSET + worker * COUNT.size,
+                        count)
+
+    def count(self, worker):
+        return COUNT.unpack_from(self.memory,
+                                 COUNTS_OFFSET + worker * COUNT.size)[0]
+
+
+class IcyInterleaver(object):
+    """Puts a metadata block after every `metaint` bytes of the stream,
+    the title is only sent again when it changed."""
+    def __init__(self, metaint):
+        super(IcyInterleaver, self).__init__()
+        self.metaint = metaint
+        self.remaining = metaint # Bytes until the next block
+        self.sent = None # Title we sent last
+
+    @staticmethod
+    def block(title):
+        title = title.replace("'", "\\'")[:4000]
+        text = "StreamTitle='{:s}';".format(title)
+        length = -(-len(text) // 16)
+        return chr(length) + text.ljust(length * 16, '\x00')
+
+    def feed(self, data, title):
+        """Returns `data` with metadata of `title`, bytes, put in."""
+        pieces = []
+        while len(data) >= self.remaining:
+            pieces.append(data[:self.remaining])
+            data = data[self.remaining:]
+            if title != self.sent:
+                pieces.append(self.block(title))
+                self.sent = title
+            else:
+                pieces.append('\x00')
+            self.remaining = self.metaint
+        pieces.append(data)
+        self.remaining -= len(data)
+        return b''.join(pieces)
+
+
+class Client(asyncore.dispatcher):
+    """One listener, it asks for the stream with an HTTP request first."""
+    max_request = 8192
+    def __init__(self, sock, worker):
+        asyncore.dispatcher.__init__(self, sock, map=worker.map)
+        self.worker = worker
+        self.request = b'' # None once we responded
+        self.buffer = bytearray()
+        self.position = None # In the ring, None until we are streaming
+        self.interleaver = None
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if self.request is None or not data:
+            return # Listeners have nothing more to say.
+        self.request += data
+        if b'\r\n\r\n' in self.request:
+            request, self.request = self.request, None
+            self.respond(request.split(b'\r\n\r\n', 1)[0])
+        elif len(self.request) > self.max_request:
+            self.close()
+
+    def respond(self, request):
+        lines = request.split(b'\r\n')
+        parts = lines[0].split()
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(b':')
+            headers[key.strip().lower()] = value.strip()
+        relay = self.worker.relay
+        if len(parts) < 2 or parts[0] not in (b'GET', b'HEAD'):
+            self.buffer += b'HTTP/1.0 405 Method Not Allowed\r\n\r\n'
+            self.worker.finish(self)
+            return
+        if parts[1].split(b'?')[0] != relay.mount:
+            self.buffer += b'HTTP/1.0 404 Not Found\r\n\r\n'
+            self.worker.finish(self)
+            return
+        response = [b'HTTP/1.0 200 OK',
+                    b'Content-Type: audio/mpeg',
+                    b'Cache-Control: no-cache',
+                    b'icy-name: ' + relay.name.encode('utf8')]
+        if headers.get(b'icy-metadata') == b'1':
+            self.interleaver = IcyInterleaver(relay.metaint)
+            response.append(b'icy-metaint: {:d}'.format(relay.metaint))
+        self.buffer += b'\r\n'.join(response) + b'\r\n\r\n'
+        if parts[0] == b'HEAD':
+            self.worker.finish(self)
+            return
+        self.position = max(self.worker.ring.position - relay.burst, 0)
+        self.worker.listening(self)
+
+    def feed(self, data, title):
+        """Adds the stream from our position, `data`, to what we send."""
+        if self.interleaver is not None:
+            data = self.interleaver.feed(data, title)
+        self.buffer += data
+        if len(self.buffer) > self.worker.relay.backlog:
+            logger.debug("Dropping a listener that fell behind.")
+            self.close()
+
+    def writable(self):
+        return bool(self.buffer)
+
+    def handle_write(self):
+        sent = self.send(bytes(self.buffer[:65536]))
+        del self.buffer[:sent]
+        if not self.buffer and self.worker.finishing(self):
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        logger.debug("Listener connection failed.", exc_info=True)
+        self.close()
+
+    def close(self):
+        self.worker.gone(self)
+        asyncore.dispatcher.close(self)
+
+
+class Server(asyncore.dispatcher):
+    """The listening socket of a worker."""
+    def __init__(self, sock, worker):
+        asyncore.dispatcher.__init__(self, sock, map=worker.map)
+        self.worker = worker
+        # The socket was listening before we got it.
+        self.accepting = True
+
+    def handle_accept(self):
+        try:
+            accepted = self.accept()
+        except socket.error:
+            return
+        if accepted is None:
+            return # Another worker was quicker.
+        sock, address = accepted
+        if len(self.worker.clients) >= self.worker.relay.max_clients:
+            sock.close()
+            return
+        Client(sock, self.worker)
+
+
+class Worker(object):
+    """What runs in a worker process, number `index` of the relay."""
+    interval = 0.05 # Seconds between looks at the ring
+    read_size = 65536
+    def __init__(self, relay, index, sock):
+        super(Worker, self).__init__()
+        self.relay = relay
+        self.index = index
+        self.ring = relay.ring
+        self.map = {}
+        self.clients = set()
+        self.done = set() # Clients to close once their buffer is sent
+        self.server = Server(sock, self)
+
+    def listening(self, client):
+        self.clients.add(client)
+
+    def finish(self, client):
+        self.done.add(client)
+
+    def finishing(self, client):
+        return client in self.done
+
+    def gone(self, client):
+        self.clients.discard(client)
+        self.done.discard(client)
+
+    def run(self):
+        parent = os.getppid()
+        while os.getppid() == parent:
+            # select() can't watch descriptors past FD_SETSIZE.
+            asyncore.loop(self.interval, map=self.map, count=1,
+                          use_poll=True)
+            title = self.ring.metadata()
+            for client in list(self.clients):
+                position, data = self.ring.read(client.position,
+                                                self.read_size)
+                client.position = position + len(data)
+                if data:
+                    client.feed(data, title)
+            self.ring.set_count(self.index, len(self.clients))
+
+
+def listening_socket(address, reuse_port=True):
+    """Returns a socket listening on `address`, bound with SO_REUSEPORT
+    when `reuse_port` is True."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(128)
+    sock.setblocking(0)
+    return sock
+
+
+class Settings(object):
+    """What a worker process knows of the :class:`Relay` that started it,
+    see :meth:`Relay.settings`."""
+    def __init__(self, **settings):
+        super(Settings, self).__init__()
+        self.__dict__.update(settings)
+
+
+def child():
+    """The entry point of a worker process started by :meth:`Relay.start`.
+    Its connection is stdin, the settings, the ring and the shared socket
+    if there is one come in over that."""
+    logging.basicConfig(level=logging.INFO)
+    connection = _multiprocessing.Connection(os.dup(0))
+    index, settings, shared = connection.recv()
+    relay = Settings(**settings)
+    fd = _multiprocessing.recvfd(connection.fileno())
+    relay.ring = Ring(relay.capacity, fd)
+    os.close(fd)
+    sock = None
+    if shared:
+        fd = _multiprocessing.recvfd(connection.fileno())
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        sock.setblocking(0)
+    serve(relay, index, sock)
+
+
+def serve(relay, index, sock):
+    """The main of a worker process, binds its own socket unless `sock`
+    is given."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if sock is None:
+        sock = listening_socket(relay.address)
+    try:
+        Worker(relay, index, sock).run()
+    except:
+        logger.exception("Relay worker failed.")
+    finally:
+        relay.ring.set_count(index, 0)
+
+
+class Relay(object):
+    """Serves what `reader` returns on `address` at `mount`, from
+    `workers` processes, one per core by default.
+
+    Every new listener gets `burst` bytes that were sent before it came,
+    listeners that are `backlog` bytes behind are dropped. The ring keeps
+    `capacity` bytes."""
+    capacity = 4 * 1024 ** 2
+    burst = 64 * 1024
+    backlog = 1024 ** 2
+    metaint = 16000
+    max_clients = 5000 # Per worker
+    def __init__(self, reader, address, mount='/main.mp3', workers=None,
+                 name=u'R/a/dio', burst=None, capacity=None):
+        super(Relay, self).__init__()
+        self.reader = reader
+        self.address = address
+        if not mount.startswith('/'):
+            mount = '/' + mount
+        self.mount = mount.encode('utf8')
+        self.workers = min(workers or multiprocessing.cpu_count(),
+                           MAX_WORKERS)
+        if isinstance(name, bytes):
+            name = name.decode('utf8', 'replace')
+        self.name = name
+        if burst is not None:
+            self.burst = burst
+        if capacity is not None:
+            self.capacity = capacity
+        self.ring = Ring(self.capacity)
+
+        self.processes = []
+        self.closed = threading.Event()
+
+    def start(self):
+        self.closed.clear()
+        # Check the port is ours to take before there are workers.
+        try:
+            shared = listening_socket(self.address)
+            shared.close()
+            shared = None
+        except socket.error as err:
+            if err.errno != errno.ENOPROTOOPT:
+                raise
+            logger.warning("No SO_REUSEPORT, the relay workers share one "
+                           "socket.")
+            shared = listening_socket(self.address, reuse_port=False)
+        # Forking the threaded streamer could leave a lock held in the
+        # worker, they are new interpreters instead.
+        self.processes = []
+        try:
+            for i in xrange(self.workers):
+                process, connection = workers.interpreter(
+                    'import audio.relay; audio.relay.child()')
+                self.processes.append(process)
+                connection.send((i, self.settings(), shared is not None))
+                _multiprocessing.sendfd(connection.fileno(),
+                                        self.ring.file.fileno())
+                if shared is not None:
+                    _multiprocessing.sendfd(connection.fileno(),
+                                            shared.fileno())
+                connection.close()
+        finally:
+            if shared is not None:
+                shared.close()
+        self.thread = threading.Thread(target=self.run, name="Stream Relay")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.closed.is_set():
+                data = self.reader.read(65536, 1.0)
+                if data:
+                    self.ring.write(data)
+        except:
+            logger.exception("Relay failed, not relaying anymore.")
+        finally:
+            self.reader.close()
+
+    def settings(self):
+        """Returns a dict of what a worker needs to know of us."""
+        return {'address': self.address, 'mount': self.mount,
+                'name': self.name, 'burst': self.burst,
+                'backlog': self.backlog, 'metaint': self.metaint,
+                'max_clients': self.max_clients,
+                'capacity': self.capacity}
+
+    def track_changed(self, metadata):
+        self.ring.set_metadata(metadata)
+
+    def listeners(self):
+        """Returns the amount of listeners over all workers."""
+        return sum(self.ring.count(i) for i in xrange(self.workers))
+
+    def close(self):
+        self.closed.set()
+        for i, process in enumerate(self.processes):
+            if process.poll() is None:
+                process.terminate()
+            garbage.track(process, "relay worker")
+            self.ring.set_count(i, 0)
+        self.processes = []
+
+
+class MountReader(object):
+    """Reads the stream of a mount of an icecast server at `url`, with
+    its metadata handed to `track_changed`."""
+    def __init__(self, url, track_changed=lambda metadata: None):
+        super(MountReader, self).__init__()
+        self.url = urlparse.urlsplit(url)
+        self.track_changed = track_changed
+        self.sock = None
+        self.pending = b''
+        self.metaint = self.remaining = 0
+
+    def connect(self):
+        self.sock = socket.create_connection((self.url.hostname,
+                                              self.url.port or 80), 10.0)
+        self.sock.sendall('GET {:s} HTTP/1.0\r\nHost: {:s}\r\nUser-Agent: '
+                          'Hanyuu-sama\r\nIcy-MetaData: 1\r\n\r\n'.format(
+                              self.url.path or '/', self.url.hostname))
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error("Connection closed in the headers.")
+            response += data
+        headers, self.pending = response.split(b'\r\n\r\n', 1)
+        self.metaint = 0
+        for line in headers.split(b'\r\n')[1:]:
+            key, _, value = line.partition(b':')
+            if key.strip().lower() == b'icy-metaint':
+                self.metaint = int(value)
+        self.remaining = self.metaint
+
+    def receive(self, size):
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            return data
+        data = self.sock.recv(size)
+        if not data:
+            raise socket.error("Connection closed.")
+        return data
+
+    def receive_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            data += self.receive(size - len(data))
+        return data
+
+    def read(self, size=4096, timeout=10.0):
+        """Returns the stream without metadata, reconnecting when it was
+        lost. An empty string is returned on timeout."""
+        try:
+            if self.sock is None:
+                self.connect()
+            self.sock.settimeout(timeout)
+            if self.metaint and self.remaining == 0:
+                length = ord(self.receive_exactly(1)) * 16
+                if length:
+                    block = self.receive_exactly(length).rstrip(b'\x00')
+                    title = block.partition(b"StreamTitle='")[2]
+                    self.track_changed(title.rpartition(b"';")[0].decode(
+                        'utf8', 'replace').replace(u"\\'", u"'"))
+                self.remaining = self.metaint
+            data = self.receive(min(size, self.remaining) if self.metaint
+                                else size)
+            self.remaining -= len(data)
+            return data
+        except socket.timeout:
+            return b''
+        except (socket.error, ValueError):
+            logger.warning("Lost the mount, reconnecting.", exc_info=True)
+            self.close()
+            time.sleep(1.0)
+            return b''
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) not in (3, 4):
+        sys.exit("Usage: python -m audio.relay URL PORT [MOUNT]")
+    url, port = sys.argv[1:3]
+    mount = sys.argv[3] if len(sys.argv) > 3 else urlparse.urlsplit(url).path
+    reader = MountReader(url)
+    relay = Relay(reader, ('0.0.0.0', int(port)), mount)
+    reader.track_changed = relay.track_changed
+    relay.start()
+    try:
+        while True:
+            time.sleep(60)
+            logger.info("%d listeners.", relay.listeners())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.close()
+
+
+if __name__ == '__main__':
+    main()
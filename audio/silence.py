@@ -0,0 +1,52 @@
+"""Module that finds the silence at the start and end of tracks.
+
+The edges are found with NumPy over every read at once and are stored in
+the track index as the time the audio starts and ends, so that
+:class:`files.AudioFile` can skip the silence in later plays. They are
+found by the loudness analysis, see :mod:`audio.loudness`, or while a file
+is played for the first time."""
+import logging
+
+import pcm
+from pcm import numpy
+
+
+logger = logging.getLogger('audio.silence')
+
+
+class SilenceDetector(object):
+    """Finds the first and last frame of the PCM given to :meth:`feed`
+    with a sample above `threshold` dBFS."""
+    threshold = -60.0
+    def __init__(self, sample_rate=44100, channels=2, bits_per_sample=24,
+                 threshold=None):
+        super(SilenceDetector, self).__init__()
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+        if threshold is None:
+            threshold = self.threshold
+        self.limit = (10 ** (threshold / 20.0) *
+                      2 ** (bits_per_sample - 1))
+
+        self.frames = 0
+        self.first = self.last = None
+
+    def feed(self, data):
+        """Adds interleaved PCM, a whole number of frames."""
+        samples = pcm.to_samples(data, self.bits_per_sample)
+        frames = numpy.abs(samples.reshape(-1, self.channels)).max(axis=1)
+        audible = numpy.flatnonzero(frames > self.limit)
+        if len(audible):
+            if self.first is None:
+                self.first = self.frames + int(audible[0])
+            self.last = self.frames + int(audible[-1]) + 1
+        self.frames += len(frames)
+
+    def result(self):
+        """Returns a tuple of the seconds the audio starts and ends at, a
+        file that is silent throughout is kept whole."""
+        if self.first is None:
+            return 0.0, float(self.frames) / self.sample_rate
+        return (float(self.first) / self.sample_rate,
+                float(self.last) / self.sample_rate)
@@ -0,0 +1,153 @@
+"""Module that hands the encoded stream to several consumers.
+
+A :class:`Tee` reads from an encoder on a background thread and keeps the
+chunks it read in one shared ring, every :class:`TeeReader` has its own
+position in that ring. The chunks are immutable strings that all readers
+get handed as they are, so nothing is copied per reader.
+
+Required readers, the icecast connection, hold the tee back when they
+fall behind. Other readers are skipped ahead past what dropped out of the
+ring instead, so a slow disk never stalls the stream."""
+import threading
+import collections
+import logging
+
+from pacer import monotonic
+
+
+logger = logging.getLogger('audio.tee')
+
+
+class Tee(object):
+    """Reads from `source` and publishes to readers made by
+    :meth:`add_reader`, keeping at most `capacity` bytes around."""
+    read_size = 4096
+    capacity = 1024 * 1024
+    def __init__(self, source, capacity=None):
+        super(Tee, self).__init__()
+        self.source = source
+        self.capacity = capacity or self.capacity
+
+        self.readers = []
+        self.chunks = collections.deque() # (position, data) in order
+        self.size = 0 # Bytes in `chunks`
+        self.position = 0 # Bytes published so far
+        self.condition = threading.Condition()
+        self.closed = threading.Event()
+
+    def add_reader(self, name=None, required=False):
+        """Returns a new :class:`TeeReader`, see the module docstring for
+        what `required` means."""
+        reader = TeeReader(self, name, required)
+        with self.condition:
+            reader.position = self.position
+            self.readers.append(reader)
+        return reader
+
+    def start(self):
+        self.closed.clear()
+        self.thread = threading.Thread(target=self.run, name="Stream Tee")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.closed.is_set():
+            try:
+                data = self.source.read(self.read_size)
+            except:
+                logger.exception("Failed reading from source.")
+                data = b''
+            if data:
+                self.publish(data)
+            elif self.source.alive.is_set():
+                break # The encoder was closed, nothing more is coming.
+        self.close()
+
+    def behind(self):
+        """Returns how far the slowest required reader is behind, call with
+        the condition held."""
+        positions = [reader.position for reader in self.readers
+                     if reader.required]
+        return self.position - min(positions) if positions else 0
+
+    def publish(self, data):
+        """Adds `data` to the ring, waits for required readers if they
+        would lose anything."""
+        with self.condition:
+            while (self.behind() + len(data) > self.capacity and
+                   not self.closed.is_set()):
+                self.condition.wait(1.0)
+            self.chunks.append((self.position, data))
+            self.size += len(data)
+            self.position += len(data)
+            # Chunks are dropped whole, but never one a required reader is
+            # still in the middle of.
+            floor = self.position - self.behind()
+            while (self.size > self.capacity and
+                   self.chunks[0][0] + len(self.chunks[0][1]) <= floor):
+                start, chunk = self.chunks.popleft()
+                self.size -= len(chunk)
+            self.condition.notify_all()
+
+    def read(self, reader, size, timeout):
+        """Returns at most `size` bytes from the position of `reader`,
+        an empty string on timeout or when we are closed."""
+        deadline = monotonic() + timeout
+        with self.condition:
+            while (reader.position >= self.position and
+                   not self.closed.is_set()):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if reader.position >= self.position or not self.chunks:
+                return b''
+            oldest = self.chunks[0][0]
+            if reader.position < oldest:
+                if not reader.lagging:
+                    logger.warning("Reader %s fell behind, skipping ahead.",
+                                   reader.name)
+                reader.lagging = True
+                reader.dropped += oldest - reader.position
+                reader.position = oldest
+            # Readers are mostly near the end, look from there.
+            for start, chunk in reversed(self.chunks):
+                if start <= reader.position:
+                    break
+            offset = reader.position - start
+            if offset == 0 and size >= len(chunk):
+                data = chunk
+            else:
+                data = chunk[offset:offset + size]
+            reader.position += len(data)
+            if reader.lagging and reader.position == self.position:
+                logger.info("Reader %s caught up.", reader.name)
+                reader.lagging = False
+            self.condition.notify_all()
+            return data
+
+    def close(self):
+        with self.condition:
+            self.closed.set()
+            self.condition.notify_all()
+
+
+class TeeReader(object):
+    """One consumer of a :class:`Tee`, readable like the encoder."""
+    def __init__(self, tee, name, required=False):
+        super(TeeReader, self).__init__()
+        self.tee = tee
+        self.name = name
+        self.required = required
+        self.position = 0
+        self.lagging = False
+        self.dropped = 0 # Bytes we were skipped past
+
+    def read(self, size=4096, timeout=10.0):
+        return self.tee.read(self, size, timeout)
+
+    def close(self):
+        """Stops the tee from waiting on us."""
+        with self.tee.condition:
+            self.required = False
+            self.tee.condition.notify_all()
@@ -0,0 +1,411 @@
+"""Module that decodes files in worker processes.
+
+Each worker owns a piece of shared memory that is split in slots, it
+decodes into a free slot and tells us which slot is filled over a pipe.
+The PCM itself is never pickled or sent through the pipe. Slots hold
+whole PCM frames only. A worker that dies on a corrupt file only ends that
+file, it is replaced by a new one.
+
+Workers are started as new interpreters instead of forks, we have threads
+that might hold a lock at the moment of a fork."""
+import os
+import sys
+import mmap
+import fcntl
+import socket
+import struct
+import tempfile
+import threading
+import subprocess
+import _multiprocessing
+import logging
+import signal
+
+import files
+import garbage
+
+
+logger = logging.getLogger('audio.workers')
+
+
+# Messages are a kind byte, the generation of the file and a payload.
+OPEN = 'O'    # Parent: decode the filename in the payload
+FREE = 'F'    # Parent: slot in the payload can be reused
+CANCEL = 'C'  # Parent: stop decoding the current file
+READY = 'R'   # Worker: the file is opened
+DATA = 'D'    # Worker: slot and length in the payload are filled
+END = 'E'     # Worker: no more data for this file
+ERROR = 'X'   # Worker: failed, the payload is the error message
+
+HEADER = struct.Struct('>cI')
+SLOT = struct.Struct('>II')
+
+
+def pack(kind, generation, payload=b''):
+    return HEADER.pack(kind, generation) + payload
+
+
+def unpack(message):
+    kind, generation = HEADER.unpack_from(message)
+    return kind, generation, message[HEADER.size:]
+
+
+# Shared memory lives here when we can, it is never written to disk then.
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# The directory the audio package is in, for the worker interpreters.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cloexec(fd):
+    """Keeps `fd` from being inherited by the processes we start."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def shared_memory(size):
+    """Returns (file, mmap) of `size` bytes of memory that can be handed to
+    a process we start, the file is unlinked already."""
+    memory_file = tempfile.TemporaryFile(dir=SHM_DIR)
+    memory_file.truncate(size)
+    cloexec(memory_file.fileno())
+    return memory_file, mmap.mmap(memory_file.fileno(), size)
+
+
+def interpreter(statement):
+    """Starts a new interpreter that runs `statement` with our packages
+    importable. Returns (process, connection), the other end of the
+    connection is the stdin of the process."""
+    ours, theirs = socket.socketpair()
+    connection = _multiprocessing.Connection(os.dup(ours.fileno()))
+    ours.close()
+    cloexec(connection.fileno())
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + filter(None, [environment.get('PYTHONPATH')]))
+    try:
+        process = subprocess.Popen([sys.executable, '-c', statement],
+                                   stdin=theirs.fileno(), close_fds=True,
+                                   env=environment)
+    finally:
+        theirs.close()
+    return process, connection
+
+
+def child():
+    """The entry point of a worker process started by :meth:`Worker.spawn`.
+    Its connection is stdin, the settings and the shared memory come in
+    over that."""
+    logging.basicConfig(level=logging.INFO)
+    connection = _multiprocessing.Connection(os.dup(0))
+    slots, slot_size, bits_per_sample, trim, backends = connection.recv()
+    fd = _multiprocessing.recvfd(connection.fileno())
+    memory = mmap.mmap(fd, slots * slot_size)
+    os.close(fd)
+    work(connection, memory, slots, slot_size, bits_per_sample, trim,
+         backends)
+
+
+def work(connection, memory, slots, slot_size, bits_per_sample=16,
+         trim=False, backends=None):
+    """The loop of a worker process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pending = None
+    while True:
+        try:
+            message = pending or connection.recv_bytes()
+        except (EOFError, IOError):
+            return # Our parent went away
+        pending = None
+        kind, generation, payload = unpack(message)
+        if kind == CANCEL:
+            connection.send_bytes(pack(END, generation))
+        elif kind == OPEN:
+            pending = decode(connection, memory, slots, slot_size,
+                             generation, payload.decode('utf8'),
+                             bits_per_sample, trim, backends)
+
+
+def decode(connection, memory, slots, slot_size, generation, filename,
+           bits_per_sample=16, trim=False, backends=None):
+    """Decodes `filename` into the slots until it ends or we are told to
+    stop. Returns a message meant for the main loop, if one came in."""
+    try:
+        audiofile = files.AudioFile(filename, bits_per_sample, trim,
+                                    backends)
+    except Exception as err:
+        connection.send_bytes(pack(ERROR, generation, str(err)))
+        return None
+    connection.send_bytes(pack(READY, generation))
+    free = range(slots)
+    frame_size = audiofile.channels * bits_per_sample // 8
+    partial = b'' # Bytes of a frame that isn't whole yet
+    try:
+        while True:
+            try:
+                data = audiofile.read(slot_size)
+            except ValueError as err:
+                if err.message != 'MD5 mismatch at end of stream':
+                    raise
+                data = b''
+            if not data:
+                # A partial frame at the very end is dropped.
+                connection.send_bytes(pack(END, generation))
+                return None
+            data = partial + data
+            whole = len(data) - len(data) % frame_size
+            data, partial = data[:whole], data[whole:]
+            if not data:
+                continue
+            # Larger reads than asked for are spread over several slots.
+            for offset in xrange(0, len(data), slot_size):
+                # Handle everything the parent sent without blocking, and
+                # wait for it when all slots are in use.
+                while not free or connection.poll():
+                    message = connection.recv_bytes()
+                    kind, number, payload = unpack(message)
+                    if kind == FREE and number == generation:
+                        free.append(SLOT.unpack(payload)[0])
+                    elif kind == CANCEL:
+                        connection.send_bytes(pack(END, number))
+                        return None
+                    elif kind == OPEN:
+                        return message
+                slot = free.pop(0)
+                piece = data[offset:offset + slot_size]
+                start = slot * slot_size
+                memory[start:start + len(piece)] = piece
+                connection.send_bytes(pack(DATA, generation,
+                                           SLOT.pack(slot, len(piece))))
+    except Exception as err:
+        logger.exception("Failed decoding %s.", filename.encode('utf8'))
+        connection.send_bytes(pack(ERROR, generation, str(err)))
+        return None
+    finally:
+        try:
+            audiofile.decoder.close()
+        except Exception:
+            logger.exception("Failed closing the decoder of %s.",
+                             filename.encode('utf8'))
+
+
+class Worker(object):
+    """Our end of a worker process and its shared memory."""
+    def __init__(self, slots, slot_size, bits_per_sample=16, trim=False,
+                 backends=None):
+        super(Worker, self).__init__()
+        self.slots = slots
+        self.slot_size = slot_size
+        self.bits_per_sample = bits_per_sample
+        self.trim = trim
+        self.backends = backends
+        self.file, self.memory = shared_memory(slots * slot_size)
+        self.generation = 0
+        self.spawn()
+
+    def spawn(self):
+        self.process, self.connection = interpreter(
+            'import audio.workers; audio.workers.child()')
+        self.connection.send((self.slots, self.slot_size,
+                              self.bits_per_sample, self.trim, self.backends))
+        _multiprocessing.sendfd(self.connection.fileno(),
+                                self.file.fileno())
+
+    def respawn(self):
+        """Replaces a crashed or stuck worker process."""
+        if self.process.poll() is None:
+            self.process.terminate()
+        garbage.track(self.process, "decoder worker")
+        self.connection.close()
+        self.spawn()
+
+    def send(self, kind, payload=b''):
+        try:
+            self.connection.send_bytes(pack(kind, self.generation, payload))
+        except (IOError, OSError):
+            pass # Noticed as a crash on the next receive
+
+    def receive(self, timeout=None):
+        """Returns the next (kind, payload) of the current file, stale
+        messages of earlier files are skipped. Returns None on timeout
+        and raises :class:`WorkerCrashed` when the process died."""
+        waited = 0.0
+        while timeout is None or waited < timeout:
+            try:
+                if not self.connection.poll(1.0):
+                    waited += 1.0
+                    if self.process.poll() is not None:
+                        raise WorkerCrashed(self.process.returncode)
+                    continue
+                kind, generation, payload = unpack(
+                    self.connection.recv_bytes())
+            except (EOFError, IOError):
+                raise WorkerCrashed(self.process.poll())
+            if generation == self.generation:
+                return kind, payload
+        return None
+
+
+class DecoderPool(object):
+    """A pool of `size` decoder processes, see the module docstring.
+
+    Every worker gets `slots` slots of `slot_size` bytes of shared
+    memory, rounded down to whole PCM frames. Files are decoded to
+    `bits_per_sample` depth, with their silence trimmed if `trim` is True,
+    by the decoder `backends` pick, see :func:`files.backend_names`.
+
+    A worker that takes longer than `open_timeout` to open a file or
+    `read_timeout` to fill the next slot is treated as crashed."""
+    slots = 8
+    slot_size = 65536
+    open_timeout = 30.0
+    read_timeout = 10.0
+    def __init__(self, size, slots=None, slot_size=None, bits_per_sample=16,
+                 trim=False, backends=None):
+        super(DecoderPool, self).__init__()
+        self.slots = slots or self.slots
+        self.bits_per_sample = bits_per_sample
+        self.frame_size = DecodedFile.channels * bits_per_sample // 8
+        self.slot_size = slot_size or self.slot_size
+        self.slot_size -= self.slot_size % self.frame_size
+        self.lock = threading.Lock()
+        self.closed = False
+        # Every worker, idle or not, so all of them are closed.
+        self.workers = [Worker(self.slots, self.slot_size, bits_per_sample,
+                               trim, backends)
+                        for i in xrange(size)]
+        self.idle = list(self.workers)
+        self.crashes = self.errors = self.fallbacks = 0
+
+    def open(self, filename):
+        """Returns a :class:`DecodedFile` for `filename`, or None if all
+        workers are busy. Raises :class:`files.AudioError` if the file
+        can't be decoded."""
+        with self.lock:
+            if not self.idle:
+                self.fallbacks += 1
+                return None
+            worker = self.idle.pop()
+        worker.generation += 1
+        worker.send(OPEN, filename.encode('utf8'))
+        try:
+            reply = worker.receive(self.open_timeout)
+            if reply is None:
+                raise WorkerCrashed("timeout")
+        except WorkerCrashed as err:
+            self.crashed(worker, filename, err)
+            raise files.AudioError("Decoder worker died opening: " +
+                                   filename.encode('utf8'))
+        kind, payload = reply
+        if kind != READY:
+            self.release(worker)
+            with self.lock:
+                self.errors += 1
+            raise files.AudioError("Unsupported file: " +
+                                   filename.encode('utf8') + ": " + payload)
+        return DecodedFile(self, worker, filename)
+
+    def release(self, worker):
+        with self.lock:
+            if not self.closed:
+                self.idle.append(worker)
+
+    def crashed(self, worker, filename, err):
+        """Reports a died worker and puts a new one in its place."""
+        with self.lock:
+            if self.closed:
+                return
+            self.crashes += 1
+        logger.error("Decoder worker died on %s (%s), replacing it.",
+                     filename.encode('utf8'), err)
+        worker.respawn()
+        self.release(worker)
+
+    def stats(self):
+        with self.lock:
+            return {'idle': len(self.idle), 'crashes': self.crashes,
+                    'errors': self.errors, 'fallbacks': self.fallbacks}
+
+    def close(self):
+        """Stops all workers, also those that are still decoding a file,
+        reads of those files end."""
+        with self.lock:
+            self.closed = True
+            workers, self.idle = self.workers, []
+        for worker in workers:
+            # It exits once it sees the connection closed.
+            worker.connection.close()
+            garbage.track(worker.process, "decoder worker")
+
+
+class DecodedFile(object):
+    """A file decoded by a worker, in the format of
+    :class:`files.AudioFile`."""
+    sample_rate = 44100
+    channels = 2
+    def __init__(self, pool, worker, filename):
+        super(DecodedFile, self).__init__()
+        self.pool = pool
+        self.bits_per_sample = pool.bits_per_sample
+        self.worker = worker
+        self.name = filename
+        self.slot = None
+        self.offset = self.end = 0
+        self.eof = False
+
+    def read(self, size=4096, timeout=0.0):
+        """Returns at most `size` bytes of whole frames, at least one
+        frame, an empty string at the end of the file or when the worker
+        failed on it."""
+        if self.slot is None and not self.next_slot():
+            return b''
+        frame_size = self.pool.frame_size
+        size = max(size - size % frame_size, frame_size)
+        size = min(size, self.end - self.offset)
+        data = self.worker.memory[self.offset:self.offset + size]
+        self.offset += size
+        if self.offset >= self.end:
+            self.worker.send(FREE, SLOT.pack(self.slot, 0))
+            self.slot = None
+        return data
+
+    def next_slot(self):
+        """Waits for the worker to fill a slot, returns False if no more
+        are coming."""
+        if self.eof:
+            return False
+        try:
+            reply = self.worker.receive(self.pool.read_timeout)
+            if reply is None:
+                # Alive but stuck, it is replaced like a crashed one.
+                raise WorkerCrashed("timeout")
+            kind, payload = reply
+        except WorkerCrashed as err:
+            self.eof = True
+            self.pool.crashed(self.worker, self.name, err)
+            self.worker = None
+            return False
+        if kind == DATA:
+            self.slot, length = SLOT.unpack(payload)
+            self.offset = self.slot * self.worker.slot_size
+            self.end = self.offset + length
+            return True
+        if kind == ERROR:
+            logger.error("Decoder worker failed on %s: %s",
+                         self.name.encode('utf8'), payload)
+            with self.pool.lock:
+                self.pool.errors += 1
+        self.eof = True
+        return False
+
+    def close(self):
+        if self.worker is None:
+            return
+        if not self.eof:
+            self.worker.send(CANCEL)
+        self.pool.release(self.worker)
+        self.worker = None
+
+
+class WorkerCrashed(Exception):
+    """Raised when a worker process died."""
+    pass
@@ -1,4 +1,5 @@
 import threading
+import collections
 import logging
 import time
 
@@ -6,6 +7,10 @@ import time
 logger = logging.getLogger('garbage')
 
 
+GarbageInfo = collections.namedtuple('GarbageInfo', ['kind', 'description',
+                                                     'age'])
+
+
 class Singleton(type):
     def __init__(mcs, name, bases, dict):
         super(Singleton, mcs).__init__(name, bases, dict)
@@ -17,13 +22,94 @@ class Singleton(type):
         return mcs.instance
     
     
+class Reaper(object):
+    """Waits for the child processes given to :meth:`track`.
+
+    The children are polled by a thread every `interval` seconds while
+    there are any, it sleeps otherwise. A SIGCHLD handler would only run
+    on the main thread, which is blocked serving the manager, and would
+    have to be installed by whoever imports us. Only tracked children are
+    waited for, so we never steal the exit status of a process somebody
+    else is waiting on. `callback` is called after one or more children
+    were reaped."""
+    interval = 1.0
+    def __init__(self, callback=lambda: None):
+        super(Reaper, self).__init__()
+        self.callback = callback
+        self.children = {}
+        self.lock = threading.Lock()
+
+        self.tracked = threading.Event()
+
+        self.thread = threading.Thread(target=self.run,
+                                       name="Child Reaper Thread")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def track(self, process, description=None):
+        """Waits for `process`, a :class:`subprocess.Popen`, once it
+        exits."""
+        with self.lock:
+            self.children[process.pid] = (process, description or
+                                          "pid {:d}".format(process.pid),
+                                          time.time())
+        self.tracked.set()
+
+    def run(self):
+        while True:
+            self.tracked.wait(self.interval if self.children else None)
+            self.tracked.clear()
+            self.reap()
+
+    def reap(self):
+        """Polls all tracked children once."""
+        with self.lock:
+            children = self.children.items()
+        reaped = []
+        for pid, (process, _, _) in children:
+            try:
+                if process.poll() is None:
+                    continue
+            except OSError:
+                logger.exception("Failed polling child %d.", pid)
+            reaped.append(pid)
+        if not reaped:
+            return
+        with self.lock:
+            for pid in reaped:
+                self.children.pop(pid, None)
+        try:
+            self.callback()
+        except:
+            logger.exception("Reaper callback exception.")
+
+    def info(self):
+        """Returns a list of GarbageInfo objects of the children that are
+        still running."""
+        now = time.time()
+        with self.lock:
+            return [GarbageInfo('process', description, now - since)
+                    for process, description, since
+                    in self.children.values()]
+
+
 class Collector(object):
+    """Collects :class:`Garbage` items until they report they are cleaned
+    up.
+
+    Pending items are retried every `retry_interval` seconds, and right
+    away when a child process exits. Nothing runs while there is nothing
+    pending."""
     __metaclass__ = Singleton
     _hooks = list()
+    retry_interval = 15.0
     def __init__(self):
         super(Collector, self).__init__()
         self.items = set()
+        self.lock = threading.Lock()
         
+        self.wakeup = threading.Event()
+        self.reaper = Reaper(self.wakeup.set)
         
         self.collecting = threading.Event()
         self.thread = threading.Thread(target=self.run,
@@ -32,7 +118,9 @@ class Collector(object):
         self.thread.start()
         
     def add(self, garbage):
-        self.items.add(garbage)
+        with self.lock:
+            self.items.add(garbage)
+        self.wakeup.set()
         for hook in self._hooks:
             try:
                 hook(garbage)
@@ -41,8 +129,12 @@ class Collector(object):
             
     def run(self):
         while not self.collecting.is_set():
+            self.wakeup.wait(self.retry_interval if self.items else None)
+            self.wakeup.clear()
+            with self.lock:
+                items = self.items.copy()
             removal = set()
-            for item in self.items.copy():
+            for item in items:
                 try:
                     code = item.collect() # Try collecting
                 except:
@@ -50,13 +142,18 @@ class Collector(object):
                 else:
                     if code: # If it returned True it was successful
                         removal.add(item)
-            self.items -= removal # We remove our set from the item one
-            time.sleep(15.0)
+            with self.lock:
+                self.items -= removal # We remove our set from the item one
             
     def info(self):
         """Returns a list of GarbageInfo objects containing information
         about current pending garbage."""
-        yield None # Not implemented
+        now = time.time()
+        with self.lock:
+            items = list(self.items)
+        result = [GarbageInfo(type(item).__name__, repr(item.item),
+                              now - item.created) for item in items]
+        return result + self.reaper.info()
         
     @classmethod
     def add_hook(cls, hook):
@@ -67,6 +164,7 @@ class Garbage(object):
     def __init__(self, item=None):
         super(Garbage, self).__init__()
         self.item = item
+        self.created = time.time()
         self.collector.add(self)
         
     def collect(self):
@@ -75,4 +173,9 @@ class Garbage(object):
         Should return True if the garbage got cleaned up properly,
         False if it requires another collect in the next cycle.
         """
-        raise NotImplementedError("collect method not overridden.")
\ No newline at end of file
+        raise NotImplementedError("collect method not overridden.")
+
+def track(process, description=None):
+    """Has the collector reap `process` once it exits, see
+    :meth:`Reaper.track`."""
+    Garbage.collector.reaper.track(process, description)
@@ -0,0 +1,5 @@
+"""Package with what we know about the music library on disk."""
+from __future__ import absolute_import
+
+from .index import TrackIndex, TrackInfo, probe, build, default
+from .catalog import Catalog, CatalogEntry, Scanner
@@ -0,0 +1,293 @@
+"""Module with a catalog of the music library and the scanner that fills it.
+
+The scanner walks the library, only files that are new or whose inode,
+modification time or size changed since the last scan are read again.
+Those are read by a process pool, the tags go into the catalog and the
+technical metadata into the :class:`index.TrackIndex`. Progress is
+committed as it goes, an interrupted scan picks up where it stopped.
+
+    python -m library.catalog [/path/to/music]
+"""
+from __future__ import absolute_import
+import os
+import sys
+import time
+import sqlite3
+import threading
+import collections
+import multiprocessing
+import logging
+
+import mutagen
+
+from . import index
+
+
+logger = logging.getLogger('library.catalog')
+
+
+EXTENSIONS = ('.mp3', '.flac', '.ogg', '.m4a', '.opus', '.wav')
+
+
+CatalogEntry = collections.namedtuple('CatalogEntry', [
+    'path', 'artist', 'title', 'album', 'metadata'])
+
+
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS catalog (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    artist TEXT,
+    title TEXT,
+    album TEXT,
+    metadata TEXT,
+    error TEXT,
+    scan INTEGER NOT NULL
+)""", """CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    root TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL
+)"""]
+
+
+def display(artist, title):
+    """Returns the metadata string we show for `artist` and `title`."""
+    if artist:
+        return u"{:s} - {:s}".format(artist, title or u'')
+    return title or u''
+
+
+def read_tags(filename):
+    """Returns a tuple of (filename, tags, info, error) for the scanner
+    pool. `tags` is a dict with the artist, title and album."""
+    try:
+        meta = mutagen.File(filename, easy=True)
+    except Exception as err:
+        return filename, None, None, str(err) or type(err).__name__
+    if meta is None:
+        return filename, None, None, "Unknown file type."
+    tags = {}
+    for key in ('artist', 'title', 'album'):
+        tags[key] = u", ".join(meta.get(key) or []) or None
+    return filename, tags, index.probe(filename), None
+
+
+class Catalog(object):
+    """The catalog stored in the sqlite database at `path`, which can be
+    the same database as the :class:`index.TrackIndex`."""
+    timeout = 10.0
+    def __init__(self, path):
+        super(Catalog, self).__init__()
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def connection(self):
+        """Returns the connection of the calling thread."""
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.connection = sqlite3.connect(self.path,
+                                                    timeout=self.timeout)
+        return self.local.connection
+
+    def lookup(self, filename):
+        """Returns the :class:`CatalogEntry` of `filename` or None."""
+        row = self.connection().execute(
+            "SELECT path, artist, title, album, metadata FROM catalog "
+            "WHERE path=? AND error IS NULL",
+            (index.TrackIndex.key(filename),)).fetchone()
+        return CatalogEntry(*row) if row is not None else None
+
+    def metadata(self, filename):
+        """Returns the metadata string of `filename`, None if unknown."""
+        entry = self.lookup(filename)
+        return entry.metadata if entry is not None else None
+
+    def tracks(self):
+        """Yields a :class:`CatalogEntry` for every readable file."""
+        for row in self.connection().execute(
+                "SELECT path, artist, title, album, metadata FROM catalog "
+                "WHERE error IS NULL"):
+            yield CatalogEntry(*row)
+
+
+class Scanner(object):
+    """Scans `root` into `catalog` with `processes` processes, technical
+    metadata is stored in `track_index` if given."""
+    batch = 500
+    report_every = 10.0
+    def __init__(self, catalog, root, track_index=None, processes=None):
+        super(Scanner, self).__init__()
+        self.catalog = catalog
+        self.root = index.TrackIndex.key(root)
+        self.track_index = track_index
+        self.processes = processes
+
+        self.seen = self.processed = self.removed = self.errors = 0
+
+    def start_scan(self):
+        """Returns the id of the unfinished scan of our root, or of a new
+        one."""
+        connection = self.catalog.connection()
+        row = connection.execute(
+            "SELECT id, finished FROM scans WHERE root=? ORDER BY id DESC "
+            "LIMIT 1", (self.root,)).fetchone()
+        if row is not None and row[1] is None:
+            logger.info("Resuming scan %d of %s.", row[0], self.root)
+            return row[0]
+        with connection:
+            return connection.execute(
+                "INSERT INTO scans (root, started) VALUES (?, ?)",
+                (self.root, time.time())).lastrowid
+
+    def walk(self):
+        """Yields (path, stat) of every audio file below our root."""
+        for base, dirs, names in os.walk(self.root):
+            for name in names:
+                if not name.lower().endswith(EXTENSIONS):
+                    continue
+                if not isinstance(name, unicode):
+                    logger.warning("Skipping undecodable name %r in %r.",
+                                   name, base)
+                    continue
+                path = os.path.join(base, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    continue
+
+    def changed(self, scan):
+        """Marks unchanged files as seen by `scan` and yields the paths of
+        the files that need reading."""
+        connection = self.catalog.connection()
+        unchanged = []
+        for path, stat in self.walk():
+            self.seen += 1
+            row = connection.execute(
+                "SELECT inode, mtime, size, scan FROM catalog WHERE path=?",
+                (path,)).fetchone()
+            if row is not None and row[:3] == (stat.st_ino, stat.st_mtime,
+                                               stat.st_size):
+                if row[3] != scan:
+                    unchanged.append((scan, path))
+                if len(unchanged) >= self.batch:
+                    self.mark(unchanged)
+            else:
+                yield path
+        self.mark(unchanged)
+
+    def mark(self, unchanged):
+        with self.catalog.connection() as connection:
+            connection.executemany("UPDATE catalog SET scan=? WHERE path=?",
+                                   unchanged)
+        del unchanged[:]
+
+    def store(self, scan, results):
+        """Writes a batch of results of :func:`read_tags`."""
+        rows = []
+        for path, stat, tags, info, error in results:
+            if error is not None:
+                self.errors += 1
+                tags = {}
+            metadata = (display(tags.get('artist'), tags.get('title'))
+                        if error is None else None)
+            rows.append((path, stat.st_ino, stat.st_mtime, stat.st_size,
+                         tags.get('artist'), tags.get('title'),
+                         tags.get('album'), metadata, error, scan))
+            if info is not None and self.track_index is not None:
+                self.track_index.store(path, info, stat)
+        with self.catalog.connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO catalog VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.processed += len(rows)
+
+    def run(self):
+        """Scans our root, returns a dict with statistics."""
+        scan = self.start_scan()
+        start = last_report = time.time()
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            results = []
+            for path, tags, info, error in pool.imap_unordered(
+                    read_tags, self.changed(scan), chunksize=16):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue # Gone while we were reading it
+                results.append((path, stat, tags, info, error))
+                if len(results) >= self.batch:
+                    self.store(scan, results)
+                    results = []
+                if time.time() - last_report > self.report_every:
+                    last_report = time.time()
+                    logger.info("Scanned %d file(s), read %d at %.1f "
+                                "files/sec.", self.seen, self.processed,
+                                self.processed / (last_report - start))
+            self.store(scan, results)
+        finally:
+            pool.close()
+            pool.join()
+
+        connection = self.catalog.connection()
+        with connection:
+            # Everything below our root we didn't see is gone.
+            self.removed = connection.execute(
+                "DELETE FROM catalog WHERE scan!=? AND path LIKE ? "
+                "ESCAPE '\\'", (scan, like_prefix(self.root))).rowcount
+            connection.execute("UPDATE scans SET finished=? WHERE id=?",
+                               (time.time(), scan))
+        seconds = time.time() - start
+        return {'seen': self.seen, 'processed': self.processed,
+                'removed': self.removed, 'errors': self.errors,
+                'seconds': seconds,
+                'files_per_second': (self.seen / seconds if seconds
+                                     else 0.0)}
+
+
+def like_prefix(directory):
+    """Returns a LIKE pattern that matches all paths below `directory`."""
+    escaped = (directory.rstrip(os.sep).replace('\\', '\\\\')
+               .replace('%', '\\%').replace('_', '\\_'))
+    return escaped + os.sep + '%'
+
+
+_default = {}
+_default_lock = threading.Lock()
+
+def default():
+    """Returns the :class:`Catalog` at `config.library_catalog`, or None
+    when it isn't configured."""
+    with _default_lock:
+        if 'catalog' not in _default:
+            try:
+                import config
+                path = getattr(config, 'library_catalog', None)
+            except ImportError:
+                path = None
+            _default['catalog'] = Catalog(path) if path else None
+        return _default['catalog']
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    catalog = default()
+    if catalog is None:
+        sys.exit("config.library_catalog is not set.")
+    if len(sys.argv) > 1:
+        root = sys.argv[1]
+    else:
+        import config
+        root = config.music_directory
+    stats = Scanner(catalog, root, index.default()).run()
+    logger.info("Scanned %(seen)d file(s) in %(seconds).1f seconds "
+                "(%(files_per_second).1f files/sec), read %(processed)d, "
+                "removed %(removed)d, %(errors)d error(s).", stats)
+
+
+if __name__ == '__main__':
+    main()
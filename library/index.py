@@ -0,0 +1,352 @@
+"""Module with an index of the technical metadata of music files.
+
+Finding the length of a VBR MP3 without a Xing header means reading every
+frame of it, the index keeps the result keyed by the path, modification
+time and size of the file so that is done once. The index is a sqlite
+database, run this module to fill it:
+
+    python -m library.index /path/to/music ...
+"""
+from __future__ import absolute_import
+import os
+import sys
+import Queue
+import sqlite3
+import threading
+import collections
+import multiprocessing
+import logging
+
+import mutagen
+
+from . import mp3
+
+
+logger = logging.getLogger('library.index')
+
+
+TrackInfo = collections.namedtuple('TrackInfo', [
+    'duration', 'total_frames', 'sample_rate', 'channels',
+    'bits_per_sample', 'codec'])
+
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL,
+    total_frames INTEGER,
+    sample_rate INTEGER,
+    channels INTEGER,
+    bits_per_sample INTEGER,
+    codec TEXT,
+    seek_table BLOB, -- unused, kept for older databases
+    loudness REAL,
+    peak REAL,
+    audio_start REAL,
+    audio_end REAL
+)"""
+
+# Columns added after the first version of the table, with their type.
+ADDED_COLUMNS = [('loudness', 'REAL'), ('peak', 'REAL'),
+                 ('audio_start', 'REAL'), ('audio_end', 'REAL')]
+
+
+class TrackIndex(object):
+    """The index stored in the sqlite database at `path`.
+
+    Every thread and process gets its own connection, so one instance can
+    be shared by the prefetcher and decoder workers."""
+    timeout = 10.0
+    def __init__(self, path):
+        super(TrackIndex, self).__init__()
+        self.path = path
+        self.local = threading.local()
+
+        # Files waiting to be probed in the background, see :meth:`get`.
+        self.lock = threading.Lock()
+        self.probing = set()
+        self.queue = Queue.Queue()
+        self.prober = None
+        with self.connection() as connection:
+            connection.execute(SCHEMA)
+            existing = [row[1] for row in
+                        connection.execute("PRAGMA table_info(tracks)")]
+            for name, kind in ADDED_COLUMNS:
+                if name not in existing:
+                    connection.execute("ALTER TABLE tracks ADD COLUMN "
+                                       "{:s} {:s}".format(name, kind))
+
+    def connection(self):
+        """Returns the connection of the calling thread."""
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.connection = sqlite3.connect(self.path,
+                                                    timeout=self.timeout)
+        return self.local.connection
+
+    @staticmethod
+    def key(filename):
+        if isinstance(filename, str):
+            filename = filename.decode('utf8')
+        return filename
+
+    def lookup(self, filename):
+        """Returns the :class:`TrackInfo` of `filename`, None if it isn't
+        indexed or the file changed since."""
+        try:
+            stat = os.stat(filename)
+            row = self.connection().execute(
+                "SELECT mtime, size, duration, total_frames, sample_rate, "
+                "channels, bits_per_sample, codec FROM tracks "
+                "WHERE path=?", (self.key(filename),)).fetchone()
+        except (OSError, sqlite3.Error):
+            return None
+        if row is None or row[0] != stat.st_mtime or row[1] != stat.st_size:
+            return None
+        return TrackInfo(*row[2:])
+
+    def store(self, filename, info, stat=None):
+        """Stores `info` as the metadata of `filename` as it is now. The
+        loudness and silence edges are kept if the file didn't change."""
+        try:
+            stat = stat or os.stat(filename)
+            with self.connection() as connection:
+                old = connection.execute(
+                    "SELECT loudness, peak, audio_start, audio_end FROM "
+                    "tracks WHERE path=? AND mtime=? AND size=?",
+                    (self.key(filename), stat.st_mtime,
+                     stat.st_size)).fetchone()
+                connection.execute(
+                    "INSERT OR REPLACE INTO tracks VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.key(filename), stat.st_mtime, stat.st_size) +
+                    tuple(info) + (None,) + (old or (None,) * 4))
+        except (OSError, sqlite3.Error):
+            logger.exception("Failed indexing %r.", filename)
+
+    def loudness(self, filename):
+        """Returns a tuple of (integrated loudness in LUFS, sample peak)
+        of `filename`, None if it wasn't analyzed since it last changed."""
+        try:
+            stat = os.stat(filename)
+            row = self.connection().execute(
+                "SELECT loudness, peak FROM tracks WHERE path=? AND mtime=? "
+                "AND size=? AND loudness IS NOT NULL",
+                (self.key(filename), stat.st_mtime,
+                 stat.st_size)).fetchone()
+        except (OSError, sqlite3.Error):
+            return None
+        return row
+
+    def store_loudness(self, filename, loudness, peak):
+        """Stores the analysis of `filename`, which has to be indexed."""
+        try:
+            with self.connection() as connection:
+                connection.execute(
+                    "UPDATE tracks SET loudness=?, peak=? WHERE path=?",
+                    (loudness, peak, self.key(filename)))
+        except sqlite3.Error:
+            logger.exception("Failed storing loudness of %r.", filename)
+
+    def edges(self, filename):
+        """Returns a tuple of the seconds the audio of `filename` starts
+        and ends at, None if they aren't known since it last changed."""
+        try:
+            stat = os.stat(filename)
+            row = self.connection().execute(
+                "SELECT audio_start, audio_end FROM tracks WHERE path=? AND "
+                "mtime=? AND size=? AND audio_start IS NOT NULL",
+                (self.key(filename), stat.st_mtime,
+                 stat.st_size)).fetchone()
+        except (OSError, sqlite3.Error):
+            return None
+        return row
+
+    def store_edges(self, filename, start, end):
+        """Stores the silence edges of `filename`, which has to be
+        indexed."""
+        try:
+            with self.connection() as connection:
+                connection.execute(
+                    "UPDATE tracks SET audio_start=?, audio_end=? WHERE "
+                    "path=?", (start, end, self.key(filename)))
+        except sqlite3.Error:
+            logger.exception("Failed storing silence of %r.", filename)
+
+    def unanalyzed(self):
+        """Returns the paths of indexed files that weren't analyzed, those
+        have no silence edges. Silent files have no loudness either."""
+        return [row[0] for row in self.connection().execute(
+            "SELECT path FROM tracks WHERE audio_start IS NULL")]
+
+    def get(self, filename):
+        """Returns the :class:`TrackInfo` of `filename`, None if it isn't
+        indexed yet. Probing can mean reading all of the file, so it is
+        done in the background and known the next time."""
+        info = self.lookup(filename)
+        if info is None:
+            self.probe_later(filename)
+        return info
+
+    def probe_later(self, filename):
+        """Probes and stores `filename` on a background thread."""
+        with self.lock:
+            if filename in self.probing:
+                return
+            self.probing.add(filename)
+            if self.prober is None or not self.prober.is_alive():
+                self.prober = threading.Thread(target=self.run_prober,
+                                               name="Index Prober")
+                self.prober.daemon = True
+                self.prober.start()
+        self.queue.put(filename)
+
+    def run_prober(self):
+        while True:
+            filename = self.queue.get()
+            try:
+                info = probe(filename)
+                if info is not None:
+                    self.store(filename, info)
+            except Exception:
+                logger.exception("Failed probing %r.", filename)
+            finally:
+                with self.lock:
+                    self.probing.discard(filename)
+
+    def prune(self):
+        """Removes entries of files that don't exist anymore."""
+        connection = self.connection()
+        paths = [row[0] for row in connection.execute(
+            "SELECT path FROM tracks")]
+        gone = [(path,) for path in paths if not os.path.exists(path)]
+        with connection:
+            connection.executemany("DELETE FROM tracks WHERE path=?", gone)
+        return len(gone)
+
+
+def mp3_samples(filename):
+    """Walks the frames of an MP3 file, returns the amount of samples in
+    it or None if it isn't a Layer III file. Only the frame headers are
+    read, seeking past the frame data in between."""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = mp3.id3v2_size(f.read(10))
+        f.seek(offset)
+        frame = f.read(1024)
+        header = mp3.parse_header(frame[:4])
+        if header is None:
+            return None
+        if mp3.is_info_frame(frame, header):
+            offset += header.length
+        samples = 0
+        while True:
+            f.seek(offset)
+            header = mp3.parse_header(f.read(4))
+            if header is None or offset + header.length > size:
+                break
+            samples += header.samples
+            offset += header.length
+        return samples
+
+
+def probe(filename):
+    """Reads the technical metadata of `filename`, returns a
+    :class:`TrackInfo` or None if it isn't an audio file we know."""
+    try:
+        audio = mutagen.File(filename)
+    except Exception:
+        logger.exception("Failed probing %r.", filename)
+        return None
+    if audio is None:
+        return None
+    info = audio.info
+    codec = type(audio).__name__.lower()
+    sample_rate = getattr(info, 'sample_rate', 0)
+    channels = getattr(info, 'channels', 2)
+    bits_per_sample = getattr(info, 'bits_per_sample', 16)
+    duration = info.length
+    total_frames = getattr(info, 'total_samples', None)
+    if codec in ('mp3', 'easymp3'):
+        codec = 'mp3'
+        walked = mp3_samples(filename)
+        if walked is not None:
+            # Exact, mutagen guesses the length of VBR files without a
+            # Xing header from the first frame.
+            total_frames = walked
+            if sample_rate:
+                duration = float(total_frames) / sample_rate
+    if not total_frames and sample_rate:
+        total_frames = int(round(duration * sample_rate))
+    return TrackInfo(duration, total_frames, sample_rate, channels,
+                     bits_per_sample, codec)
+
+
+def probe_stat(filename):
+    """Returns a tuple of (filename, stat, info) for the builder pool."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return filename, None, None
+    return filename, stat, probe(filename)
+
+
+def build(index, filenames, processes=None):
+    """Probes every file in `filenames` that isn't indexed yet with a pool
+    of `processes` processes and stores the results. Returns the amount of
+    files that got indexed."""
+    missing = [filename for filename in filenames
+               if index.lookup(filename) is None]
+    if not missing:
+        return 0
+    pool = multiprocessing.Pool(processes)
+    indexed = 0
+    try:
+        for filename, stat, info in pool.imap_unordered(probe_stat, missing,
+                                                        chunksize=16):
+            if info is not None:
+                index.store(filename, info, stat)
+                indexed += 1
+    finally:
+        pool.close()
+        pool.join()
+    return indexed
+
+
+def walk(directories):
+    """Yields the paths of all files below `directories`."""
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                yield os.path.join(root, name)
+
+
+_default = {}
+_default_lock = threading.Lock()
+
+def default():
+    """Returns the :class:`TrackIndex` at `config.track_index`, or None
+    when it isn't configured."""
+    with _default_lock:
+        if 'index' not in _default:
+            try:
+                import config
+                path = getattr(config, 'track_index', None)
+            except ImportError:
+                path = None
+            _default['index'] = TrackIndex(path) if path else None
+        return _default['index']
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    index = default()
+    if index is None:
+        sys.exit("config.track_index is not set.")
+    indexed = build(index, list(walk(sys.argv[1:])))
+    logger.info("Indexed %d file(s), pruned %d.", indexed, index.prune())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Module that parses MP3 frame headers.
+
+It is shared by the index, which counts the frames of MP3 files, and
+:mod:`audio.mp3`, which sends them as they are."""
+from __future__ import absolute_import
+import collections
+
+
+# Bitrates in kbps by MPEG version, for Layer III only.
+BITRATES = {
+    1: [None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+        None],
+    2: [None, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160,
+        None],
+}
+BITRATES[2.5] = BITRATES[2]
+
+SAMPLE_RATES = {
+    1: [44100, 48000, 32000, None],
+    2: [22050, 24000, 16000, None],
+    2.5: [11025, 12000, 8000, None],
+}
+
+VERSIONS = {0: 2.5, 2: 2, 3: 1}
+
+MONO = 3
+
+
+FrameHeader = collections.namedtuple('FrameHeader', [
+    'version', 'bitrate', 'sample_rate', 'padding', 'channel_mode',
+    'length', 'samples'])
+
+
+def parse_header(data):
+    """Parses the four bytes in `data` as a Layer III frame header.
+
+    Returns a :class:`FrameHeader` or None if it isn't a valid header."""
+    if len(data) < 4:
+        return None
+    b1, b2, b3 = ord(data[1]), ord(data[2]), ord(data[3])
+    if ord(data[0]) != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = VERSIONS.get((b1 >> 3) & 0x03)
+    if version is None or (b1 >> 1) & 0x03 != 1:
+        # Reserved version or not Layer III
+        return None
+    bitrate = BITRATES[version][b2 >> 4]
+    sample_rate = SAMPLE_RATES[version][(b2 >> 2) & 0x03]
+    if bitrate is None or sample_rate is None:
+        return None
+    padding = (b2 >> 1) & 0x01
+    channel_mode = b3 >> 6
+    if version == 1:
+        length = 144000 * bitrate // sample_rate + padding
+        samples = 1152
+    else:
+        length = 72000 * bitrate // sample_rate + padding
+        samples = 576
+    return FrameHeader(version, bitrate, sample_rate, padding,
+                       channel_mode, length, samples)
+
+
+def id3v2_size(data):
+    """Returns the size of the ID3v2 tag at the start of `data`, 0 if
+    there is none. `data` needs to be at least 10 bytes."""
+    if len(data) < 10 or data[:3] != 'ID3':
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (ord(byte) & 0x7F)
+    footer = 10 if ord(data[5]) & 0x10 else 0
+    return 10 + size + footer
+
+
+def is_info_frame(frame, header):
+    """Returns True if `frame` is a Xing/Info/VBRI frame and not audio."""
+    if header.version == 1:
+        side_info = 17 if header.channel_mode == MONO else 32
+    else:
+        side_info = 9 if header.channel_mode == MONO else 17
+    tag = frame[4 + side_info:8 + side_info]
+    return tag in ('Xing', 'Info') or frame[36:40] == 'VBRI'
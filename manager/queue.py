@@ -29,4 +29,4 @@ class QSong(Song):
 legacy_queue.Song = Song
 legacy_queue.QSong = QSong
 legacy_queue.QueueError = QueueError
-Queue = lambda: legacy_queue.Queue(config.queue_url)
+Queue = lambda url=None: legacy_queue.Queue(url or config.queue_url)
@@ -5,11 +5,15 @@ import logging
 import mutagen
 import requests
 
+import library
+
 from .util import MySQLNormalCursor, MySQLCursor, unix_to_text, search
 import config
 
 
 class Song(object):
+    _update_hooks = []
+
     def __init__(self, id=None, meta=None, length=None, filename=None):
         super(Song, self).__init__()
         if (not isinstance(id, (int, long, type(None)))):
@@ -82,6 +86,17 @@ class Song(object):
                 # Update the search index if we need to.
                 if key == "lp" and self.afk:
                     self.update_index()
+        for hook in self._update_hooks:
+            try:
+                hook(self, kwargs)
+            except:
+                logging.exception("Song update hook failed")
+
+    @classmethod
+    def add_update_hook(cls, hook):
+        """Adds a hook that is called with the song and the keyword
+        arguments every time :meth:`update` is called."""
+        cls._update_hooks.append(hook)
 
     @staticmethod
     def create_digest(metadata):
@@ -419,6 +434,11 @@ class Song(object):
     @staticmethod
     def get_length(song):
         if (song.filename is not None):
+            # The catalog scanner stores durations in the track index
+            index = library.default()
+            info = index.get(song.filename) if index is not None else None
+            if (info is not None):
+                return info.duration
             try:
                 length = mutagen.File(song.filename).info.length
             except (IOError, ValueError):
@@ -448,8 +468,11 @@ class Song(object):
                 artist = row['artist']
                 title = row['track']
                 path = join(config.music_directory, row['path'])
-                meta = title if artist == u'' \
-                    else artist + u' - ' + title
+                catalog = library.catalog.default()
+                meta = catalog.metadata(path) if catalog is not None else None
+                if (meta is None):
+                    meta = title if artist == u'' \
+                        else artist + u' - ' + title
                 return (path, meta)
             else:
                 return (None, None)
@@ -34,6 +34,7 @@ class Status(object):
     __metaclass__ = bootstrap.Singleton
     _timeout = bootstrap.Switch(True, 0)
     _handlers = []
+    _listener_sources = []
     _last_listeners = 0
 
     @property
@@ -113,6 +114,15 @@ class Status(object):
     def status(self):
         import streamstatus
         self._status = streamstatus.get_status(config.master_server)
+        relayed = 0
+        for source in self._listener_sources:
+            try:
+                relayed += source()
+            except:
+                logging.exception("Listener source failed")
+        if relayed:
+            self._status['listeners'] = (int(self._status.get('listeners', 0))
+                                         + relayed)
         self._timeout.reset(9)
         for handle in self._handlers:
             try:
@@ -129,6 +139,11 @@ class Status(object):
         """
         self._handlers.append(handle)
 
+    def add_listener_source(self, source):
+        """Adds a function that returns the amount of listeners we serve
+        ourselves, these are added to the listeners of the status."""
+        self._listener_sources.append(source)
+
     def update(self):
         """Updates the database with current collected info"""
         with MySQLNormalCursor() as cur:
@@ -289,9 +304,10 @@ class NP(Song):
             if (current.length == 0):
                 current.update(length=(time.time() - current._start))
 
-        # New stuff
-        current.start = int(time.time())
-        current.end = int(time.time()) + song.length
+        # New stuff, this is called when the first frame of the song is
+        # played so the time is kept as precise as we have it.
+        current.start = time.time()
+        current.end = current.start + song.length
 
         # tunein
         def tunein(song):
@@ -0,0 +1,49 @@
+import time
+import threading
+import unittest
+
+from audio import Prefetcher
+
+
+class SlowSource(object):
+    """Returns the names in `names` one per call, sleeping `delays` seconds
+    for the calls that have one."""
+    def __init__(self, names, delays):
+        self.names = list(names)
+        self.delays = delays
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.delays.get(call, 0.0))
+        return self.names.pop(0) if self.names else None
+
+
+class PrefetcherOrderTest(unittest.TestCase):
+    def make(self, source):
+        prefetcher = Prefetcher(source)
+        prefetcher.timeout = 0.1
+        prefetcher.start()
+        self.addCleanup(prefetcher.close)
+        return prefetcher
+
+    def test_slow_open_keeps_order(self):
+        # The second open takes longer than get waits for it.
+        source = SlowSource(['track1', 'track2', 'track3'], {2: 0.5})
+        prefetcher = self.make(source)
+        self.assertEqual([prefetcher.get() for i in xrange(3)],
+                         ['track1', 'track2', 'track3'])
+
+    def test_runs_dry(self):
+        source = SlowSource(['track1', 'track2'], {})
+        prefetcher = self.make(source)
+        self.assertEqual(prefetcher.get(), 'track1')
+        self.assertEqual(prefetcher.get(), 'track2')
+        self.assertEqual(prefetcher.get(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()